@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+'''Load generator for measuring what a server can take.
+
+Opens many headless clients (botfarm.py's bots) against a running server and
+plays them with the AutoUI or IntelligentUI decision logic. At the end it
+writes a JSON report: hands and rounds per second, latency percentiles for
+each step of a hand, and the server's CPU time and memory if we were told
+its pid (or started it ourselves with --spawn).
+
+The latencies are timed from the client side:
+    join   [join] sent -> our own [join] comes back
+    ante   [ante] sent -> [deal]
+    turn   [turn] sent -> the [stat] for that action
+    endg   our last action (or [ante], if we had none) -> [endg]
+    round  [ante] received -> [endg]
+ante and endg include waiting on the other players at the table.
+
+The bots' names and decisions come from --seed. The server shuffles on
+its own, so two runs only match as far as the cards allow.
+'''
+import os
+import sys
+import json
+import random
+import signal
+import argparse
+import subprocess
+from time import time, sleep
+from botfarm import FarmBot, BotFarm, quiet
+from client_ui import AutoUI, IntelligentUI
+
+
+def percentile(ordered, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not ordered:
+        return None
+    rank = int(round(fraction * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class ProcStats(object):
+    '''CPU time and memory of another process, read out of /proc.'''
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = float(os.sysconf('SC_CLK_TCK'))
+
+    def cpu_seconds(self):
+        try:
+            with open('/proc/{}/stat'.format(self.pid)) as stat_f:
+                #the command name can hold spaces, so count from the end of it
+                fields = stat_f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / self.tick #utime + stime
+
+    def memory_kb(self):
+        '''(resident, peak resident) in kB.'''
+        found = {}
+        try:
+            with open('/proc/{}/status'.format(self.pid)) as status_f:
+                for line in status_f:
+                    if line.startswith(('VmRSS:', 'VmHWM:')):
+                        found[line[:5]] = int(line.split()[1])
+        except IOError:
+            pass
+        return found.get('VmRSS'), found.get('VmHWM')
+
+
+class BenchBot(FarmBot):
+    '''A FarmBot that notes when things happen, for the latency figures.'''
+
+    def __init__(self, farm, name, ui):
+        FarmBot.__init__(self, farm, name, ui)
+        self.sent = {} #what we're waiting on: step:time
+        self.round_start = None
+
+    def send(self, msg, step=None):
+        if step is not None:
+            self.sent[step] = time()
+        FarmBot.send(self, msg, step)
+
+    def answered(self, step):
+        sent = self.sent.pop(step, None)
+        if sent is not None:
+            self.farm.latencies[step].append(time() - sent)
+
+    def on_join(self, id_, timeout, cash, seat):
+        if id_ == self.name and 'join' in self.sent:
+            self.answered('join')
+            self.farm.joined = time()
+        FarmBot.on_join(self, id_, timeout, cash, seat)
+
+    def on_ante(self, min_bet):
+        if self.seated:
+            self.round_start = time()
+        FarmBot.on_ante(self, min_bet)
+        if 'ante' in self.sent:
+            self.sent['endg'] = self.sent['ante']
+
+    def on_deal(self, dealer_card, shuffled, seats):
+        self.answered('ante')
+        FarmBot.on_deal(self, dealer_card, shuffled, seats)
+
+    def on_turn(self, id_):
+        FarmBot.on_turn(self, id_)
+        if id_ == self.name and 'turn' in self.sent:
+            self.sent['endg'] = self.sent['turn']
+
+    def on_stat(self, id_, action, card, busted, bet):
+        if id_ == self.name:
+            self.answered('turn')
+        FarmBot.on_stat(self, id_, action, card, busted, bet)
+
+    def on_endg(self, seats):
+        if self.seat is not None:
+            self.answered('endg')
+            self.farm.latencies['round'].append(time() - self.round_start)
+            #one bot per table counts the round: whoever sits furthest left
+            if all(info is None for info in seats[:self.seat]):
+                self.farm.rounds += 1
+        FarmBot.on_endg(self, seats)
+
+
+class Bench(BotFarm):
+    bot_class = BenchBot
+
+    def __init__(self, host='', port=36709, clients=100, duration=30, ui='intelligent',
+            seed=0, server_pid=None, framed=False):
+        BotFarm.__init__(self, host, port, {'auto': AutoUI, 'intelligent': IntelligentUI}[ui], framed=framed)
+        self.num_clients = clients
+        self.duration = duration
+        self.seed = seed
+        self.server = ProcStats(server_pid) if server_pid else None
+        self.latencies = dict((step, []) for step in ['join', 'ante', 'turn', 'endg', 'round'])
+        self.rounds = 0
+        self.joined = None #when the last bot got in
+
+    def run(self):
+        random.seed(self.seed)
+        start_cpu = self.server.cpu_seconds() if self.server else None
+        start = time()
+        self.add_bots(self.num_clients, 'bench')
+        BotFarm.run(self, max(start + self.duration - time(), 0))
+        finish = time()
+        end_cpu = self.server.cpu_seconds() if self.server else None
+        rss, peak_rss = self.server.memory_kb() if self.server else (None, None)
+        self.close()
+
+        elapsed = finish - start
+        report = {
+            'config': {
+                'host': self.host, 'port': self.port, 'clients': self.num_clients,
+                'duration': self.duration, 'ui': self.ui.__name__, 'seed': self.seed,
+                'framing': 'bnry' if self.framed else 'text'},
+            'join_seconds': None if self.joined is None else self.joined - start,
+            'elapsed_seconds': elapsed,
+            'hands': self.hands,
+            'rounds': self.rounds,
+            'hands_per_sec': self.hands / elapsed,
+            'rounds_per_sec': self.rounds / elapsed,
+            'errors': self.errors,
+            'disconnects': self.dropped,
+            'latency_ms': {},
+            'server': None,
+            }
+        for step, samples in self.latencies.items():
+            samples.sort()
+            report['latency_ms'][step] = {
+                'count': len(samples),
+                'p50': _ms(percentile(samples, 0.5)),
+                'p99': _ms(percentile(samples, 0.99)),
+                'p999': _ms(percentile(samples, 0.999)),
+                'max': _ms(samples[-1] if samples else None)}
+        if self.server:
+            cpu = None if start_cpu is None or end_cpu is None else end_cpu - start_cpu
+            report['server'] = {
+                'pid': self.server.pid,
+                'cpu_seconds': cpu,
+                'cpu_percent': None if cpu is None else 100 * cpu / (finish - start),
+                'rss_kb': rss,
+                'peak_rss_kb': peak_rss}
+        return report
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Play many bots against a blackjack server and report how it holds up')
+    parser.add_argument(
+            '-s','--server',
+            default='',
+            help='the host where the server resides',
+            metavar='host',
+            dest='host')
+    parser.add_argument(
+            '-p','--port',
+            default=36709,
+            type=int,
+            help='the port where the server is listening',
+            metavar='port',
+            dest='port')
+    parser.add_argument(
+            '-c','--clients',
+            default=100,
+            type=int,
+            help='how many bots to connect',
+            metavar='clients',
+            dest='clients')
+    parser.add_argument(
+            '-d','--duration',
+            default=30,
+            type=float,
+            help='how many seconds to play for, counting from the first connect',
+            metavar='seconds',
+            dest='duration')
+    parser.add_argument(
+            '-u','--ui',
+            default='intelligent',
+            choices=['auto', 'intelligent'],
+            help='which bot makes the decisions',
+            dest='ui')
+    parser.add_argument(
+            '--seed',
+            default=0,
+            type=int,
+            help='seed for the bots\' random choices',
+            dest='seed')
+    parser.add_argument(
+            '--binary',
+            action='store_true',
+            help='have the bots ask for binary frames rather than text',
+            dest='framed')
+    parser.add_argument(
+            '--server-pid',
+            default=None,
+            type=int,
+            help='pid of the server, to report its cpu time and memory',
+            metavar='pid',
+            dest='server_pid')
+    parser.add_argument(
+            '--spawn',
+            default=None,
+            help='start server.py with these arguments (quoted) and stop it afterwards',
+            metavar='server_args',
+            dest='spawn')
+    parser.add_argument(
+            '-o','--output',
+            default=None,
+            help='write the json report here as well as to the terminal',
+            metavar='file',
+            dest='output')
+    args = vars(parser.parse_args())
+    output = args.pop('output')
+    spawn = args.pop('spawn')
+
+    #every bot is a file descriptor
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+    server = None
+    if spawn is not None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        server = subprocess.Popen(
+                [sys.executable, os.path.join(here, 'server.py'), '-p', str(args['port'])] + spawn.split(),
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        args['server_pid'] = server.pid
+        sleep(1) #give it time to bind
+
+    try:
+        with quiet():
+            report = Bench(**args).run()
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if output is not None:
+        with open(output, 'w') as output_f:
+            json.dump(report, output_f, indent=2, sort_keys=True)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+'''Many bot players in one process.
+
+A BotFarm connects any number of FarmBots to a server. Each bot has its own
+socket, MessageBuffer, hand and ShoeTracker, and all of them are played from
+one non-blocking Reactor loop, so a bot costs a few objects rather than a
+Python interpreter. Decisions come from AutoUI or IntelligentUI, whose witty
+lines and compiled strategy tables are loaded once and shared by every bot.
+
+Unlike BlackjackClient, a bot only keeps what its UI needs: its own hand
+and the dealer's. Everybody else's cards just go into its shoe tracker.
+
+With framed set, bots join asking for the binary frames of wire.py, which
+are a good deal smaller than the text messages. With autoplay set, each bot
+sends an [auto] with its UI's strategy once it has joined, and the server
+plays its hands for it from then on; the bots just watch.
+'''
+import os
+import sys
+import random
+import argparse
+import resource
+import socket as s
+from time import time
+from reactor import Reactor
+from utils import MessageBuffer, MessageBufferException, BlackjackHand, ShoeTracker, CARD_CODES
+from wire import FrameBuffer, client_frame
+from client_ui import AutoUI, IntelligentUI, strategy_text, parse_strategy_text, compile_strategy
+
+DEALER = 'SERVER      '
+TEXT_FORMATS = {'ante': '[ante|{:0>10}]', 'turn': '[turn|{}]', 'insu': '[insu|{:0>10}]', 'exit': '[exit]', 'text': '{}'}
+
+
+class _Player(object):
+    '''What the UIs expect in players[id]: something with a hand.'''
+    def __init__(self, hand):
+        self.hand = hand
+
+
+class FarmBot(object):
+    '''One headless player, driven by its farm's reactor.'''
+
+    def __init__(self, farm, name, ui):
+        self.farm = farm
+        self.name = name
+        self.sock = None
+        self.ui = ui(lambda line: None, name=name)
+        self.shoe = ShoeTracker(farm.num_decks)
+        self.ui.shoe = self.shoe
+        self.me = _Player(BlackjackHand())
+        self.dealer = _Player(BlackjackHand())
+        self.ui.players = {name: self.me, DEALER: self.dealer}
+        self.split_store = None
+        self.seated = False
+        self.seat = None #in the current round
+        self.framed = False #whether the server has switched us to frames
+        self.autoplay = False #whether we've handed our decisions to the server
+
+    def connect(self, host, port):
+        '''Start connecting. The join goes out once the socket is writable,
+        so bots that got in early are already playing while the rest wait
+        on the server's accept queue.'''
+        self.sock = s.socket(s.AF_INET, s.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.mbuffer = MessageBuffer(self.sock)
+        self.mbuffer.asked_for_frames = self.farm.framed
+        self.sock.connect_ex((host or 'localhost', port))
+        self.farm.reactor.add_writer(self.sock, self.connected)
+
+    def connected(self):
+        self.farm.reactor.remove_writer(self.sock)
+        if self.sock.getsockopt(s.SOL_SOCKET, s.SO_ERROR):
+            return self.farm.drop_bot(self, 'could not connect')
+        self.farm.reactor.add_reader(self.sock, self.process_messages)
+        self.send('[join|{}{}]'.format(self.name, '|bnry' if self.farm.framed else ''), 'join')
+
+    def message(self, m_type, arg=None):
+        '''The bytes for a message of ours, in whichever framing we are using.'''
+        if self.framed:
+            return client_frame(m_type, arg)
+        return TEXT_FORMATS[m_type].format(arg)
+
+    def send(self, msg, step=None):
+        '''step names what msg is for ('join', 'ante' or 'turn'), for
+        subclasses that keep time.'''
+        try:
+            self.sock.sendall(msg)
+        except s.error:
+            self.farm.drop_bot(self, 'send failed')
+
+    def process_messages(self):
+        try:
+            self.mbuffer.update()
+        except MessageBufferException:
+            return self.farm.drop_bot(self, 'server closed the connection')
+        #text messages go to the handle_ methods, which parse them for the
+        #on_ methods; frames come off the FrameBuffer ready for those. After a
+        #[bnry] self.mbuffer is a new one, with whatever came in behind it
+        while self.mbuffer.messages and self.sock is not None:
+            m_type, mess_args = self.mbuffer.messages.popleft()
+            handler = getattr(self, ('on_' if self.framed else 'handle_') + m_type, None)
+            if handler is not None:
+                handler(*mess_args)
+
+    def handle_bnry(self, number):
+        self.framed = True
+        self.mbuffer = FrameBuffer(self.sock, str(self.mbuffer._buffer))
+
+    def handle_join(self, id_, timeout, cash, seat):
+        self.on_join(id_, int(timeout), int(cash), int(seat))
+
+    def handle_errr(self, strike, reason):
+        self.on_errr(int(strike), reason)
+
+    def handle_ante(self, min_bet):
+        self.on_ante(int(min_bet))
+
+    def handle_deal(self, dealer_card, shuf, *player_info):
+        seats = []
+        for info in player_info:
+            if info:
+                id_, cash, card1, card2 = info.split(',')
+                seats.append((id_, int(cash), CARD_CODES[card1], CARD_CODES[card2]))
+            else:
+                seats.append(None)
+        self.on_deal(CARD_CODES[dealer_card], shuf == 'shufy', seats)
+
+    def handle_turn(self, id_):
+        self.on_turn(id_)
+
+    def handle_stat(self, id_, action, card, bust, bet):
+        self.on_stat(id_, action, None if card == 'xx' else CARD_CODES[card], bust == 'busty', int(bet))
+
+    def handle_endg(self, *player_info):
+        seats = []
+        for info in player_info:
+            if info:
+                id_, result, cash = info.split(',')
+                seats.append((id_, result, int(cash)))
+            else:
+                seats.append(None)
+        self.on_endg(seats)
+
+    def on_join(self, id_, timeout, cash, seat):
+        if id_ == self.name:
+            self.seated = seat != 0 #the lobby hears the antes too
+            if self.farm.autoplay and not self.autoplay:
+                self.autoplay = True
+                self.send(self.message('text', '[auto|{:0>10}|none|{}]'.format(self.farm.min_bet, self.farm.strategy)))
+
+    def on_errr(self, strike, reason):
+        self.farm.errors += 1
+
+    def on_ante(self, min_bet):
+        if not self.seated or self.autoplay:
+            return
+        self.ui.first_turn = True
+        self.send(self.message('ante', self.ui.get_ante(min_bet)), 'ante')
+
+    def on_deal(self, dealer_card, shuffled, seats):
+        if shuffled:
+            self.shoe.reset()
+        see = self.shoe.see
+        see(dealer_card)
+        self.dealer.hand = BlackjackHand([dealer_card])
+        self.split_store = None
+        self.seat = None
+        for ix, info in enumerate(seats):
+            if info is not None:
+                id_, cash, card1, card2 = info
+                see(card1)
+                see(card2)
+                if id_ == self.name:
+                    self.seat = ix
+                    self.me.hand = BlackjackHand([card1, card2])
+        if self.seat is not None and self.dealer.hand.value() == 11 and not self.autoplay:
+            self.send(self.message('insu', self.ui.get_insurance()))
+
+    def on_turn(self, id_):
+        if id_ == self.name and not self.autoplay:
+            self.send(self.message('turn', self.ui.get_turn_action()), 'turn')
+
+    def on_stat(self, id_, action, card, busted, bet):
+        if card is not None:
+            self.shoe.see(card)
+        if id_ == DEALER:
+            if card is not None:
+                self.dealer.hand.add(card)
+            return
+        if id_ != self.name:
+            return
+        hand = self.me.hand
+        if action == 'splt':
+            self.split_store = hand.split()
+        if card is not None:
+            hand.add(card)
+        if (action in ['stay', 'down'] or hand.value() >= 21) and self.split_store is not None:
+            #on to the second half of the split
+            self.me.hand = BlackjackHand([self.split_store])
+            self.split_store = None
+
+    def on_endg(self, seats):
+        if self.seat is None:
+            return #we sat this one out
+        self.farm.hands += 1
+        self.seat = None
+
+
+class BotFarm(object):
+    bot_class = FarmBot
+
+    def __init__(self, host='', port=36709, ui=IntelligentUI, num_decks=2, framed=False, autoplay=False, min_bet=4):
+        self.host = host
+        self.port = port
+        self.ui = ui
+        self.num_decks = num_decks
+        self.framed = framed
+        self.autoplay = autoplay
+        self.min_bet = min_bet #the standing ante, when autoplay is set
+        #what the server should play for an autoplay bot: the tables its UI
+        #plays by, which __init__ puts on the instance in place of the class's
+        if issubclass(ui, IntelligentUI):
+            player = ui(lambda line: None)
+            self.strategy = strategy_text(player.split_strategies,
+                    player.ace_present_strategies, player.general_strategies)
+            if compile_strategy(*parse_strategy_text(self.strategy)) != player.decisions:
+                raise ValueError("{} has moves a strategy's text can't carry".format(ui.__name__))
+        else:
+            self.strategy = 'auto'
+        self.reactor = Reactor()
+        self.bots = []
+        self.hands = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def add_bots(self, count, prefix='farm'):
+        '''Connect count more bots, named prefix and then a number.'''
+        digits = 12 - len(prefix)
+        for number in range(len(self.bots), len(self.bots) + count):
+            bot = self.bot_class(self, '{}{:0>{}}'.format(prefix, number, digits)[:12], self.ui)
+            bot.connect(self.host, self.port)
+            self.bots.append(bot)
+
+    def drop_bot(self, bot, reason):
+        if bot.sock is None:
+            return
+        self.reactor.remove(bot.sock)
+        bot.sock.close()
+        bot.sock = None
+        if reason is not None:
+            self.dropped += 1
+
+    def connected(self):
+        return len(self.reactor)
+
+    def run(self, duration=None, report=None, report_every=10):
+        '''Play until duration seconds have gone by (for ever if None) or
+        every bot is gone. report, if given, is called every report_every
+        seconds.'''
+        start = time()
+        end = None if duration is None else start + duration
+        next_report = None if report is None else start + report_every
+        while self.connected():
+            deadlines = [deadline for deadline in (end, next_report) if deadline is not None]
+            self.reactor.poll(max(min(deadlines) - time(), 0) if deadlines else None)
+            now = time()
+            if next_report is not None and now >= next_report:
+                report(self, now - start)
+                next_report = now + report_every
+            if end is not None and now >= end:
+                break
+
+    def close(self):
+        for bot in self.bots:
+            if bot.sock is not None:
+                try:
+                    bot.sock.sendall(bot.message('exit'))
+                except s.error:
+                    pass
+                self.drop_bot(bot, None)
+
+
+class quiet(object):
+    '''The UIs print everything they do. Send it nowhere while we play.'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def print_report(farm, elapsed):
+    sys.stderr.write('{:.0f}s: {} bots connected, {} dropped, {} hands ({:.1f}/s), {} errors, {} MB peak\n'.format(
+        elapsed, farm.connected(), farm.dropped, farm.hands, farm.hands / elapsed, farm.errors,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Play lots of bots against a blackjack server from one process')
+    parser.add_argument(
+            '-s','--server',
+            default='',
+            help='the host where the server resides',
+            metavar='host',
+            dest='host')
+    parser.add_argument(
+            '-p','--port',
+            default=36709,
+            type=int,
+            help='the port where the server is listening',
+            metavar='port',
+            dest='port')
+    parser.add_argument(
+            '-b','--bots',
+            default=100,
+            type=int,
+            help='how many bots to connect',
+            metavar='bots',
+            dest='bots')
+    parser.add_argument(
+            '-u','--ui',
+            default='intelligent',
+            choices=['auto', 'intelligent'],
+            help='which bot makes the decisions',
+            dest='ui')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help="the number of decks in the server's shoe",
+            metavar='num_decks',
+            dest='num_decks')
+    parser.add_argument(
+            '--binary',
+            action='store_true',
+            help='have the bots ask for binary frames rather than text',
+            dest='framed')
+    parser.add_argument(
+            '--autoplay',
+            action='store_true',
+            help="have the server play the bots' hands for them, with standing orders sent after they join",
+            dest='autoplay')
+    parser.add_argument(
+            '--prefix',
+            default='farm',
+            help='bot names are this followed by a number',
+            dest='prefix')
+    parser.add_argument(
+            '--duration',
+            default=None,
+            type=float,
+            help='stop after this many seconds (default: run until ctrl-c)',
+            metavar='seconds',
+            dest='duration')
+    parser.add_argument(
+            '--seed',
+            default=None,
+            type=int,
+            help="seed for the bots' random choices",
+            dest='seed')
+    parser.add_argument(
+            '-v', '--verbose',
+            action='store_true',
+            help='let the UIs print what they are doing',
+            dest='verbose')
+    args = parser.parse_args()
+    if len(args.prefix) > 8:
+        parser.error('keep the prefix to 8 characters, so the numbers fit in a name')
+
+    #every bot is a file descriptor
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except ValueError:
+        pass
+
+    random.seed(args.seed)
+    farm = BotFarm(args.host, args.port, {'auto': AutoUI, 'intelligent': IntelligentUI}[args.ui], args.num_decks, args.framed, args.autoplay)
+    farm.add_bots(args.bots, args.prefix)
+    start = time()
+    try:
+        if args.verbose:
+            farm.run(args.duration, print_report)
+        else:
+            with quiet():
+                farm.run(args.duration, print_report)
+    except KeyboardInterrupt:
+        pass
+    farm.close()
+    print_report(farm, time() - start)
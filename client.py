@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import socket as s
-from utils import MessageBuffer, ChatHandler, BlackjackHand, BlackjackPlayer, escape_chars, colors, validate_name
+from utils import MessageBuffer, ChatHandler, BlackjackHand, BlackjackPlayer, ShoeTracker, CARD_CODES, escape_chars, colors, validate_name
 from client_ui import ConsoleUI, AutoUI, IntelligentUI
 from select import select
 from collections import defaultdict
@@ -15,16 +15,20 @@ class BlackjackClient(object):
 
     MAX_PLAYERS = 6
 
-    def __init__(self, host='', port=36709, name=None, ui = ConsoleUI):
+    def __init__(self, host='', port=36709, name=None, ui = ConsoleUI, num_decks=2):
         
         self.host = host
         self.port = port
         self.ui = ui(self.send_chat)
+        #every card we see comes out of here; the ui can read it too
+        self.shoe = ShoeTracker(num_decks)
+        self.ui.shoe = self.shoe
 
         if name is None:
             self.name = validate_name(self.ui.get_player_name())
         else:
             self.name = validate_name(name)
+            self.ui.name = self.name
 
 
         self.m_handlers = defaultdict(lambda: self.handle_default)
@@ -73,6 +77,7 @@ class BlackjackClient(object):
         self.logger.addHandler(c_handler)
         self.game_in_progress = False
         self.players = False
+        self.seat_to_name = []
         self.location='lobby'
 
     def send(self, msg):
@@ -80,16 +85,27 @@ class BlackjackClient(object):
         self.server.sendall(msg)
 
     def process_messages(self, expected_types, ignored_types=[]):
-        self.s_buffer.update()
-        while self.s_buffer.messages:
-            m_type, mess_args = self.s_buffer.messages.popleft()
-            if m_type in expected_types: 
-                self.m_handlers[m_type](*mess_args)
-            elif m_type in ignored_types:
-                self.logger.debug('ignoring message: {} with args {}'.format(m_type, mess_args))
+        '''Handle the next buffered message, or wait for input if there is none.
+        Messages are handled one at a time so that the calling loop notices
+        a change of phase before the next one (say, an ante right behind an endg).'''
+        if not self.s_buffer.messages:
+            return self.wait_for_input()
+        m_type, mess_args = self.s_buffer.messages.popleft()
+        if m_type in expected_types: 
+            self.m_handlers[m_type](*mess_args)
+        elif m_type in ignored_types:
+            self.logger.debug('ignoring message: {} with args {}'.format(m_type, mess_args))
+        else:
+            self.logger.error('Unexpected message: {} with args {}'.format(m_type, mess_args))
+            self.exit(ret_code=127)
+
+    def wait_for_input(self):
+        input_socks, _, _ = select(self.watched_socks, [], [])
+        for stream in input_socks:
+            if stream == self.server:
+                self.s_buffer.update()
             else:
-                self.logger.error('Unexpected message: {} with args {}'.format(m_type, mess_args))
-                self.exit(ret_code=127)
+                self.ui.send_chat()
 
     def exit(self,signum=None, frame=None, ret_code=0):
         self.send('[exit]')
@@ -98,9 +114,10 @@ class BlackjackClient(object):
         self.logger.error('uknown message, args: {}'.format(args))
 
     def handle_join(self, id, timeout,cash, seat_number):
-        self.timeout = timeout
-        self.cash = cash
-        self.location = 'lobby' if seat_number=='0' else 'table'
+        if id == self.name:
+            self.timeout = timeout
+            self.cash = cash
+            self.location = 'lobby' if seat_number=='0' else 'table'
         self.ui.new_join(id, timeout, cash, seat_number)
 
     def handle_ante(self, min_bet):
@@ -111,24 +128,31 @@ class BlackjackClient(object):
     def handle_exit(self, player_name):
         if self.players and player_name in self.players:
             del self.players[player_name]
-        self.seat_to_name.remove(player_name)
+        if player_name in self.seat_to_name:
+            #keep the other seats where they are
+            self.seat_to_name[self.seat_to_name.index(player_name)] = None
         self.ui.display_exit(player_name)
 
     def handle_deal(self, dealer_card, shuf, *player_info):
+        if shuf == 'shufy':
+            self.shoe.reset()
+        self.shoe.see(CARD_CODES[dealer_card])
         self.players = {}
         self.seat_to_name = [None]
         self.players['SERVER      '] = BlackjackPlayer(
                 id = 'SERVER      ', 
-                cards = [dealer_card], 
+                cards = [CARD_CODES[dealer_card]], 
                 cash = None, 
                 seat = self.MAX_PLAYERS + 1)
         for ix, info in enumerate(player_info):
             if info:
                 id_, cash, card1, card2 = info.split(',')
                 self.logger.debug('adding "{}" to players'.format(id_))
+                self.shoe.see(CARD_CODES[card1])
+                self.shoe.see(CARD_CODES[card2])
                 self.players[id_] = BlackjackPlayer(
                         id=id_,
-                        cards = [card1,card2],
+                        cards = [CARD_CODES[card1], CARD_CODES[card2]],
                         cash = int(cash),
                         seat = ix)
                 self.seat_to_name.append(id_)
@@ -150,16 +174,16 @@ class BlackjackClient(object):
 
     def handle_stat(self, id, action, card, bust, bet):
         if action == 'splt':
-            self.players[id].split_store = self.players[id].hand.cards[1]
-            del self.players[id].hand.cards[1]
+            self.players[id].split_store = self.players[id].hand.split()
         if card != 'xx':
-            self.players[id].hand.cards.append(card)
+            self.players[id].hand.add(CARD_CODES[card])
+            self.shoe.see(CARD_CODES[card])
         self.ui.display_stat(id,action,card,bust,bet)
         if action in ['stay','down'] or self.players[id].hand.value() >= 21:
             #end of their turn, unless they split
-            if self.players[id].split_store:
-                self.players[id].hand.cards = [self.players[id].split_store]
-                self.players[id].split_store = False
+            if self.players[id].split_store is not None:
+                self.players[id].hand = BlackjackHand([self.players[id].split_store])
+                self.players[id].split_store = None
 
 
     def handle_endg(self, *player_info):
@@ -199,22 +223,12 @@ class BlackjackClient(object):
     def wait_for_ante(self):
         self.logger.debug('top of wait_for_ante')
         while not self.game_in_progress:
-            input_socks, _, _ = select(self.watched_socks, [], [])
-            for stream in input_socks:
-                if stream == self.server:
-                    self.process_messages(['chat','exit','join','ante','deal'])
-                else:
-                    self.ui.send_chat()
+            self.process_messages(['chat','exit','join','ante','deal'])
 
     def wait_for_deal(self):
         self.logger.debug('top of wait_for_deal')
         while not self.players:
-            input_socks, _, _ = select(self.watched_socks, [], [])
-            for stream in input_socks:
-                if stream == self.server:
-                    self.process_messages(['chat','exit','join','deal','turn'])
-                else:
-                    self.ui.send_chat()
+            self.process_messages(['chat','exit','join','deal','turn'])
         if self.players['SERVER      '].hand.value() == 11:
             #we have to opportunity to buy insurance
             amount = self.ui.get_insurance()
@@ -223,23 +237,13 @@ class BlackjackClient(object):
     def play_out_turns(self):
         self.logger.debug('top of play_out_turns')
         while self.game_in_progress:
-            input_socks, _, _ = select(self.watched_socks, [], [])
-            for stream in input_socks:
-                if stream == self.server:
-                    self.process_messages(['chat','exit','join','turn','stat','endg'])
-                else:
-                    self.ui.send_chat()
+            self.process_messages(['chat','exit','join','turn','stat','endg'])
         
     def wait_to_play(self):
         self.logger.debug('top of wait_to_play')
         while self.location == 'lobby':
-            input_socks, _,_ = select(self.watched_socks, [], [])
-            for stream in input_socks:
-                if stream == self.server:
-                    self.process_messages(ignored_types=self.all_messages,
-                            expected_types=['chat','exit','join'])
-                else:
-                    self.ui.send_chat()
+            self.process_messages(ignored_types=self.all_messages,
+                    expected_types=['chat','exit','join'])
 
     def main(self):
         self.join()
@@ -280,6 +284,13 @@ if __name__=='__main__':
             help='type of user interface. Options are "console" and "auto"',
             metavar='ui_type',
             dest='ui')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help="the number of decks in the server's shoe",
+            metavar='num_decks',
+            dest='num_decks')
     ui_map = {
             'console':ConsoleUI,
             'auto':AutoUI,
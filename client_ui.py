@@ -3,7 +3,70 @@ import random
 import pickle
 import strategy
 from collections import defaultdict
-from utils import escape_chars, colors,BlackjackHand,validate_name
+from utils import escape_chars, colors,validate_name,dealer_hits,RANK_CHARS,CARD_NAMES,CARD_VALUES
+PAIR, ACE_PRESENT, GENERAL = range(3) #the hand classes in a compiled strategy
+STRATEGY_ROWS = 32 #pair rank, other card sum or card sum; all less than this
+_compiled = {} #(ids of the three tables):compile_strategy's list, shared between UIs
+
+def compile_strategy(split_strategies, ace_present_strategies, general_strategies):
+    '''Flatten IntelligentUI's strategy dicts into one list, indexed by
+        ((hand_class * STRATEGY_ROWS + row) * 11 + dealer_value) * 2 + first_turn
+    where row is the pair's rank (0-12, so J isn't T) for PAIR, the sum of
+    the cards that aren't aces for ACE_PRESENT, and the hand's value for
+    GENERAL. Doubling down is only allowed on the first turn, so the
+    first_turn=0 entries already have the fallback in place of 'down'. Rows
+    the dicts don't have are None.'''
+    decisions = [None] * (3 * STRATEGY_ROWS * 11 * 2)
+    tables = [
+        (PAIR, dict((RANK_CHARS.index(key), by_dealer) for key, by_dealer in split_strategies.items())),
+        (ACE_PRESENT, ace_present_strategies),
+        (GENERAL, general_strategies)]
+    for hand_class, strategies in tables:
+        for row, by_dealer in strategies.items():
+            for dealer_value, dealer_card in enumerate('123456789T', 1):
+                index = ((hand_class * STRATEGY_ROWS + row) * 11 + dealer_value) * 2
+                preference = by_dealer[dealer_card]
+                decisions[index + 1] = preference
+                if preference == 'down' and hand_class == ACE_PRESENT:
+                    preference = 'stay' if row >= 7 else 'hitt'
+                elif preference == 'down':
+                    preference = 'hitt'
+                decisions[index] = preference
+    return decisions
+
+#the rows of a strategy's text form: every pair rank, ace present rows 0-10, and card sums 4-21
+STRATEGY_TEXT_ROWS = [(PAIR, range(13)), (ACE_PRESENT, range(11)), (GENERAL, range(4, 22))]
+ACTION_LETTERS = {'hitt': 'h', 'stay': 's', 'down': 'd', 'splt': 'p', None: '-'}
+LETTER_ACTIONS = dict((letter, action) for action, letter in ACTION_LETTERS.items())
+STRATEGY_TEXT_LEN = sum(len(rows) for hand_class, rows in STRATEGY_TEXT_ROWS) * 10
+
+def strategy_text(split_strategies, ace_present_strategies, general_strategies):
+    '''The strategy dicts as one letter (h, s, d, p, or - for no preference)
+    per row of STRATEGY_TEXT_ROWS and dealer card, ace to ten: short enough
+    to send to the server in an [auto].'''
+    decisions = compile_strategy(split_strategies, ace_present_strategies, general_strategies)
+    return ''.join(ACTION_LETTERS[decisions[((hand_class * STRATEGY_ROWS + row) * 11 + dealer_value) * 2 + 1]]
+            for hand_class, rows in STRATEGY_TEXT_ROWS for row in rows for dealer_value in range(1, 11))
+
+def parse_strategy_text(text):
+    '''strategy_text's letters back into (split, ace present, general) dicts.
+    Raises ValueError if text isn't one. A row is all letters or all -, so
+    a hand either has a move for every dealer card or none at all.'''
+    if len(text) != STRATEGY_TEXT_LEN:
+        raise ValueError('a strategy has {} letters, not {}'.format(STRATEGY_TEXT_LEN, len(text)))
+    tables = ({}, {}, {})
+    letters = iter(text)
+    for hand_class, rows in STRATEGY_TEXT_ROWS:
+        for row in rows:
+            try:
+                by_dealer = dict((dealer_card, LETTER_ACTIONS[next(letters)]) for dealer_card in '123456789T')
+            except KeyError as e:
+                raise ValueError('{!r} is not one of the letters for an action'.format(e.args[0]))
+            if all(by_dealer.values()):
+                tables[hand_class][RANK_CHARS[row] if hand_class == PAIR else row] = by_dealer
+            elif any(by_dealer.values()):
+                raise ValueError('a row has a - as well as moves')
+    return tables
 
 class ConsoleUI(object):
 
@@ -17,6 +80,7 @@ class ConsoleUI(object):
         self.chat_at_stdin = True
         self.name = None if name is None else validate_name(name)
         self.players = {}
+        self.shoe = None #the client's ShoeTracker
 
     def show_chat(self, id_, text):
         print(colors.YELLOW + '{id_}> {text}'.format(
@@ -71,14 +135,14 @@ class ConsoleUI(object):
     def deal(self, shuf):
         print(colors.OKGREEN + 'Cards are dealt: (dealer {} before this hand)'.format(
             'shuffled' if shuf == 'shufy' else 'did not shuffle') + colors.ENDC)
-        print (colors.OKGREEN + 'Dealer: {}'.format(self.players['SERVER      '].hand.cards) + colors.ENDC)
+        print (colors.OKGREEN + 'Dealer: {}'.format(self.players['SERVER      '].hand.names()) + colors.ENDC)
         for name in self.seat_to_name:
             if name is None: 
                 continue
             print(colors.OKGREEN + '{name} (${cash}): {cards}'.format(
                 name=name,
                 cash=self.players[name].cash,
-                cards=self.players[name].hand.cards) + colors.ENDC)
+                cards=self.players[name].hand.names()) + colors.ENDC)
 
     def get_turn_action(self):
         valid_moves = ['hitt','stay','down','splt']
@@ -115,12 +179,15 @@ class ConsoleUI(object):
 class AutoUI(ConsoleUI):
     possible_names = ['Brian']
     
+    witty_things = None #read once, and shared by every bot in the process
+
     def __init__(self, *args, **kwargs):
         ConsoleUI.__init__(self, *args, **kwargs)
         self.first_turn = True
         #we only want to split or double down on the first turn
-        with open('witty_things.txt','r') as f:
-            self.witty_things = pickle.load(f)
+        if AutoUI.witty_things is None:
+            with open('witty_things.txt','r') as f:
+                AutoUI.witty_things = pickle.load(f)
 
     def send_chat(self):
         chat_line = sys.stdin.readline().strip('\r\n')
@@ -150,8 +217,7 @@ class AutoUI(ConsoleUI):
 
     def get_turn_action(self):
         my_hand = self.players[self.name].hand
-        ace_present = '1' in [card[0] for card in my_hand.cards]
-        if my_hand.value() <= 16 or (ace_present and my_hand.value() <= 17):
+        if dealer_hits(my_hand):
             action = 'hitt'
         else:
             action = 'stay'
@@ -279,53 +345,58 @@ class IntelligentUI(AutoUI):
         self.split_strategies = strategy.split_strategies
         self.ace_present_strategies =strategy.ace_present_strategies
         self.general_strategies = strategy.general_strategies
-         
+        tables = (self.split_strategies, self.ace_present_strategies, self.general_strategies)
+        key = tuple(id(table) for table in tables)
+        if key not in _compiled:
+            _compiled[key] = compile_strategy(*tables)
+        self.decisions = _compiled[key]
+
     def strategy(self, dealer_card, my_hand):
-        my_hand = BlackjackHand(my_hand.cards) #make a local copy
-        #replace J,Q,K with their value
-        if dealer_card in ['J','Q','K']:
-            dealer_card = 'T'
-        if self.first_turn and my_hand.cards[0][0] == my_hand.cards[1][0]:
+        '''dealer_card is the dealer's face up card, as an int.'''
+        decisions = self.decisions
+        dealer_value = CARD_VALUES[dealer_card]
+        first_turn = 1 if self.first_turn else 0
+        if first_turn and my_hand.pair is not None:
             #possible split
-            if my_hand.cards[0][0] in self.split_strategies:
-                return self.split_strategies[my_hand.cards[0][0]][dealer_card]
-
-        for ix, card in enumerate(my_hand.cards):
-            if card[0] in ['J','Q','K']:
-                my_hand.cards[ix] = 'T' + card[1]
-
-
-        if '1' in [card[0] for card in my_hand.cards]:
-            #ace is present
-            other_cards = sum(map(int,
-                map(lambda c: '10' if c=='T' else c,
-                    filter(lambda c: c != '1', 
-                        map(lambda c: c[0], my_hand.cards)))))
-            if other_cards in self.ace_present_strategies :
-                preference = self.ace_present_strategies[other_cards][dealer_card]
-                if not self.first_turn and preference == 'down':
-                    return 'stay' if other_cards >= 7 else 'hitt'
+            preference = decisions[((PAIR * STRATEGY_ROWS + my_hand.pair) * 11 + dealer_value) * 2 + 1]
+            if preference is not None:
                 return preference
+
+        if my_hand.aces:
+            #every ace is left out of the other cards, however many there are
+            other_cards = my_hand.hard - my_hand.aces
+            if other_cards < STRATEGY_ROWS:
+                preference = decisions[((ACE_PRESENT * STRATEGY_ROWS + other_cards) * 11 + dealer_value) * 2 + first_turn]
+                if preference is not None:
+                    return preference
         card_sum = my_hand.value()
-        if card_sum in self.general_strategies:
-            preference = self.general_strategies[card_sum][dealer_card]
-            if not self.first_turn and preference == 'down':
-                return 'hitt'
-            return preference
-        else:
-            print colors.FAIL + "I don't know what to do!!!"
-            print 'my_hand={}'.format(my_hand)
-            print 'dealer_card={}'.format(dealer_card)
-            print colors.ENDC
-            return 'stay'
+        if card_sum < STRATEGY_ROWS:
+            preference = decisions[((GENERAL * STRATEGY_ROWS + card_sum) * 11 + dealer_value) * 2 + first_turn]
+            if preference is not None:
+                return preference
+        return self.unknown_hand(dealer_card, my_hand)
+
+    def unknown_hand(self, dealer_card, my_hand):
+        '''What to do when the tables have nothing for a hand.'''
+        print colors.FAIL + "I don't know what to do!!!"
+        print 'my_hand={}'.format(my_hand.names())
+        print 'dealer_card={}'.format(CARD_NAMES[dealer_card])
+        print colors.ENDC
+        return 'stay'
 
     def get_insurance(self):
-        print colors.OKBLUE + 'What insurance would you like?' + colors.ENDC, 0
-        return 0
+        #insurance pays 2 to 1, so it's worth the most we can buy when more
+        #than a third of the cards the hole card could be are tens
+        shoe = self.shoe
+        insu = 0
+        if shoe is not None and shoe.cards_left and shoe.remaining[9] * 3 > shoe.cards_left:
+            insu = self.bet / 2
+        print colors.OKBLUE + 'What insurance would you like?' + colors.ENDC, insu
+        return insu
 
     def get_turn_action(self):
         my_hand = self.players[self.name].hand
-        dealer_card = self.players['SERVER      '].hand.cards[0][0]
+        dealer_card = self.players['SERVER      '].hand.cards[0]
         action = self.strategy(dealer_card, my_hand)
         print colors.OKBLUE + "It's your turn! you have {}".format(my_hand.value()) + colors.ENDC, action
         self.first_turn = False
@@ -0,0 +1,102 @@
+'''Exact odds of how the dealer's hand will end.
+
+For a face up card and what is left in the shoe, DealerOdds works out the
+chance of each of the dealer's final outcomes: standing on 17 to 21,
+busting, or a two card blackjack. The dealer plays by utils.dealer_hits
+(hitting 16 and below, and 17 with an ace) unless hit_soft_17 is off, when
+they stand on any 17. They draw without replacement, and the hole card
+comes out of the same shoe.
+
+A shoe is described by its composition: a tuple of how many cards of each
+value are left, aces first and all the tens together, so
+shoe_composition() for a fresh two deck shoe is
+    (8, 8, 8, 8, 8, 8, 8, 8, 8, 32)
+Results are cached by (upcard, composition), keeping the most recently
+used maxsize of them.
+'''
+from collections import OrderedDict
+from utils import CARD_VALUES
+
+OUTCOMES = [17, 18, 19, 20, 21, 'bust', 'blackjack']
+BUST = 5
+BLACKJACK = 6
+
+
+def shoe_composition(num_decks=2, seen=()):
+    '''The composition of a shoe of num_decks decks with the cards in seen
+    (ints, as utils deals them) taken out.'''
+    counts = [4 * num_decks] * 9 + [16 * num_decks]
+    for card in seen:
+        counts[CARD_VALUES[card] - 1] -= 1
+    return tuple(counts)
+
+
+class DealerOdds(object):
+    def __init__(self, maxsize=4096, hit_soft_17=True):
+        self.maxsize = maxsize
+        self.hit_soft_17 = hit_soft_17
+        self.cache = OrderedDict() #(upcard value, composition):probabilities
+        self.hits = 0
+        self.misses = 0
+
+    def outcomes(self, upcard, composition):
+        '''A tuple of probabilities, in the order of OUTCOMES, for a dealer
+        showing a card of value upcard (1 for an ace, 10 for a face). The
+        upcard must already be out of composition.'''
+        key = (upcard, composition)
+        odds = self.cache.pop(key, None)
+        if odds is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            odds = self._outcomes(upcard, composition)
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False) #the least recently used
+        self.cache[key] = odds
+        return odds
+
+    def outcome_dict(self, upcard, composition):
+        return dict(zip(OUTCOMES, self.outcomes(upcard, composition)))
+
+    def _outcomes(self, upcard, composition):
+        total = sum(composition)
+        odds = [0.0] * len(OUTCOMES)
+        memo = {}
+        for value in range(1, 11):
+            count = composition[value - 1]
+            if not count:
+                continue
+            chance = float(count) / total
+            if (upcard == 1 and value == 10) or (upcard == 10 and value == 1):
+                odds[BLACKJACK] += chance
+                continue
+            rest = composition[:value - 1] + (count - 1,) + composition[value:]
+            after = self._draw(upcard + value, upcard == 1 or value == 1, rest, total - 1, memo)
+            for outcome in range(BLACKJACK):
+                odds[outcome] += chance * after[outcome]
+        return tuple(odds)
+
+    def _draw(self, hard, ace, composition, total, memo):
+        '''Outcome odds for a dealer holding hard (aces counted as 1), who
+        will draw from composition.'''
+        key = (hard, ace, composition)
+        if key in memo:
+            return memo[key]
+        value = hard + 10 if ace and hard <= 11 else hard
+        odds = [0.0] * BLACKJACK
+        if value > 21:
+            odds[BUST] = 1.0
+        elif value > 17 or (value == 17 and not (ace and self.hit_soft_17)):
+            odds[value - 17] = 1.0
+        else:
+            for card_value in range(1, 11):
+                count = composition[card_value - 1]
+                if not count:
+                    continue
+                chance = float(count) / total
+                rest = composition[:card_value - 1] + (count - 1,) + composition[card_value:]
+                after = self._draw(hard + card_value, ace or card_value == 1, rest, total - 1, memo)
+                for outcome in range(BLACKJACK):
+                    odds[outcome] += chance * after[outcome]
+        memo[key] = odds
+        return odds
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+'''The rules of the game without the network.
+
+The scoring rules (dealer_hits, score and settle in utils) are the ones
+the server's tables use, so simulated results hold for real games. A BlackjackEngine deals hands between Policy
+objects in the same order as a table would:
+    -a shoe of two decks by default, shuffled when the cut card comes out
+    -antes, then two cards to the dealer and two to each player
+    -insurance when the dealer shows an ace; a dealer blackjack ends the hand there
+    -the dealer draws out their hand before anyone plays (hitting soft 17)
+    -each player in seat order hits, stays, doubles down on their first move,
+     or splits a pair once
+    -payout
+
+Like the server, a hand's score is 2.5x the bet for a 21, 2x for a win, the
+bet lost for a loss, and nothing for a tie; and the player is paid on the
+sign of their score (both halves of a split added up), so a win of any kind
+returns twice the bet.
+
+Running this file simulates a number of hands and prints each policy's
+results and the house edge.
+'''
+import random
+import argparse
+from time import time
+from utils import BlackjackShoe, BlackjackHand, BlackjackError, ACE, card_rank, dealer_hits, score, settle
+from ledger import STARTING_CASH
+from client_ui import IntelligentUI, compile_strategy
+import strategy
+import optimal_strategy
+
+MIN_BET = 4
+MAX_STRIKES = 3
+
+
+class Policy(object):
+    '''Makes a simulated player's decisions. This one bets the minimum,
+    never insures, and always stays; override whichever parts you like.
+
+    hand is the player's BlackjackHand, which the policy mustn't change,
+    and dealer_card is the dealer's face up card.'''
+    name = 'stay'
+
+    def __init__(self, rng=random):
+        self.rng = rng
+
+    def ante(self, min_bet, cash):
+        return min_bet
+
+    def insurance(self, bet, cash):
+        return 0
+
+    def turn(self, hand, dealer_card, first_turn):
+        return 'stay'
+
+
+class AutoPolicy(Policy):
+    '''AutoUI's decisions: play like the dealer, buy random insurance.'''
+    name = 'auto'
+
+    def insurance(self, bet, cash):
+        return min(self.rng.randint(0, bet/2), cash)
+
+    def turn(self, hand, dealer_card, first_turn):
+        return 'hitt' if dealer_hits(hand) else 'stay'
+
+
+class _TablesUI(IntelligentUI):
+    '''Just enough IntelligentUI for strategy(): it stays, without a word,
+    on a hand the tables don't cover. A server plays policies for its
+    players, and a table from a player mustn't get to print on its console.'''
+    def unknown_hand(self, dealer_card, my_hand):
+        return 'stay'
+
+
+class IntelligentPolicy(Policy):
+    '''IntelligentUI's strategy tables.'''
+    name = 'intelligent'
+
+    def __init__(self, rng=random):
+        Policy.__init__(self, rng)
+        #skip the UI's __init__; it wants a chat callback and witty_things.txt,
+        #and strategy() only needs the tables
+        self.ui = _TablesUI.__new__(_TablesUI)
+        self.ui.split_strategies, self.ui.ace_present_strategies, self.ui.general_strategies = self.strategies()
+        self.ui.decisions = compile_strategy(self.ui.split_strategies,
+                self.ui.ace_present_strategies, self.ui.general_strategies)
+
+    def strategies(self):
+        return strategy.split_strategies, strategy.ace_present_strategies, strategy.general_strategies
+
+    def turn(self, hand, dealer_card, first_turn):
+        self.ui.first_turn = first_turn
+        return self.ui.strategy(dealer_card, hand)
+
+
+class OptimalPolicy(IntelligentPolicy):
+    '''IntelligentUI playing optimal_strategy's tables for the default rules.'''
+    name = 'optimal'
+
+    def strategies(self):
+        return optimal_strategy.optimal_strategies()
+
+
+class TablePolicy(IntelligentPolicy):
+    '''IntelligentUI playing tables of the caller's, (split, ace present,
+    general) dicts like client_ui.parse_strategy_text's.'''
+    name = 'table'
+
+    def __init__(self, tables, rng=random):
+        self.tables = tables
+        IntelligentPolicy.__init__(self, rng)
+
+    def strategies(self):
+        return self.tables
+
+
+class StandingOrders(Policy):
+    '''A server player's [auto]: the same ante every hand (or all their cash,
+    if they have less), half their bet in insurance whenever it's offered if
+    insure is set, and strategy's turns.'''
+    name = 'standing orders'
+
+    def __init__(self, amount, insure, strategy, rng=random):
+        Policy.__init__(self, rng)
+        self.amount = amount
+        self.insure = insure
+        self.strategy = strategy
+
+    def ante(self, min_bet, cash):
+        return max(min(self.amount, cash), min_bet)
+
+    def insurance(self, bet, cash):
+        return min(bet/2, cash) if self.insure else 0
+
+    def turn(self, hand, dealer_card, first_turn):
+        return self.strategy.turn(hand, dealer_card, first_turn)
+
+policies = {
+        'stay': Policy,
+        'auto': AutoPolicy,
+        'intelligent': IntelligentPolicy,
+        'optimal': OptimalPolicy,
+        }
+
+
+class SimPlayer(object):
+    def __init__(self, policy, cash):
+        self.policy = policy
+        self.cash = cash
+        self.hands = 0
+        self.staked = 0 #antes, double downs and insurance
+        self.net = 0 #what they've won (or lost) overall
+        self.rebuys = 0
+        self.strikes = 0 #moves the server would have refused
+        self.dropped = 0 #hands lost to MAX_STRIKES refusals in a row
+        self.results = {'won': 0, 'los': 0, 'tie': 0}
+
+
+class BlackjackEngine(object):
+    '''Plays hands between one SimPlayer per seat. Players who can't make the
+    minimum bet are bought back in with starting_cash if rebuy is set, and
+    sit out otherwise.
+
+    A turn the server would refuse (doubling after the first move, say) is
+    a strike, and the policy is asked again; MAX_STRIKES in a row forfeits
+    the hand, as being dropped from the server would. A bad ante or
+    insurance amount raises a BlackjackError.'''
+
+    def __init__(self, policies, rng=None, min_bet=MIN_BET, starting_cash=STARTING_CASH, rebuy=True,
+            num_decks=2, penetration=0.75):
+        self.rng = random.Random() if rng is None else rng
+        self.shoe = BlackjackShoe(num_decks, penetration, self.rng)
+        self.min_bet = min_bet
+        self.starting_cash = starting_cash
+        self.rebuy = rebuy
+        self.players = [SimPlayer(policy, starting_cash) for policy in policies]
+        self.hands_played = 0
+
+    def play(self, num_hands):
+        for hand in xrange(num_hands):
+            self.play_hand()
+
+    def play_hand(self):
+        players = []
+        bets = {}
+        for player in self.players:
+            if player.cash < self.min_bet and self.rebuy:
+                player.cash = self.starting_cash
+                player.rebuys += 1
+            if player.cash < self.min_bet:
+                continue
+            bet = player.policy.ante(self.min_bet, player.cash)
+            if bet < self.min_bet or bet > player.cash:
+                raise BlackjackError('{} bet {} with {} in cash'.format(player.policy.name, bet, player.cash))
+            self.charge(player, bet)
+            bets[player] = bet
+            players.append(player)
+        if not players:
+            return
+        self.hands_played += 1
+
+        self.shoe.start_hand()
+        dealer = BlackjackHand(self.shoe.deal(2))
+        dealer_card = dealer.cards[0]
+        hands = dict((player, BlackjackHand(self.shoe.deal(2))) for player in players)
+        results = dict((player, 0) for player in players)
+
+        if card_rank(dealer_card) == ACE:
+            dealer_blackjack = dealer.value() == 21
+            for player in players:
+                amount = player.policy.insurance(bets[player], player.cash)
+                if amount > bets[player]/2 or amount > player.cash:
+                    raise BlackjackError('{} asked for {} insurance on a bet of {}'.format(player.policy.name, amount, bets[player]))
+                if amount:
+                    self.charge(player, amount)
+                    if dealer_blackjack:
+                        self.pay(player, 3*amount)
+            if dealer_blackjack:
+                for player in players:
+                    results[player] += score(hands[player].value(), 21, bets[player])
+                return self.payout(players, bets, results)
+
+        while dealer_hits(dealer):
+            dealer.add(self.shoe.deal(1)[0])
+        dealer_value = dealer.value()
+
+        for player in players:
+            results[player], bets[player] = self.play_turns(player, hands[player], bets[player], dealer_card, dealer_value)
+        self.payout(players, bets, results)
+
+    def play_turns(self, player, hand, bet, dealer_card, dealer_value):
+        '''Play out one player's hand (or pair of hands, if they split).
+        Returns their summed score and their bet, which doubling changes.'''
+        result = 0
+        split_store = None
+        first_turn = True
+        strikes = 0
+        while True:
+            action = player.policy.turn(hand, dealer_card, first_turn)
+            first_turn = False
+            if not self.allowed(action, player, hand, bet, split_store):
+                #the server would give them a strike and ask again
+                player.strikes += 1
+                strikes += 1
+                if strikes >= MAX_STRIKES:
+                    player.dropped += 1
+                    return None, bet
+                continue
+            strikes = 0
+            if action == 'hitt':
+                hand.add(self.shoe.deal(1)[0])
+                done = hand.value() >= 21
+            elif action == 'stay':
+                done = True
+            elif action == 'down':
+                hand.add(self.shoe.deal(1)[0])
+                self.charge(player, bet)
+                bet *= 2
+                done = True
+            else: #splt
+                split_store = hand.split()
+                hand.add(self.shoe.deal(1)[0])
+                done = False
+            if not done:
+                continue
+            result += score(hand.value(), dealer_value, bet)
+            if split_store is None:
+                return result, bet
+            #on to the second half of the split, which starts with a hit
+            hand = BlackjackHand([split_store, self.shoe.deal(1)[0]])
+            split_store = None
+            if hand.value() >= 21:
+                return result + score(hand.value(), dealer_value, bet), bet
+
+    def allowed(self, action, player, hand, bet, split_store):
+        if action in ['hitt', 'stay']:
+            return True
+        if action not in ['down', 'splt'] or len(hand.cards) > 2 or split_store is not None:
+            return False
+        if action == 'down':
+            return player.cash >= bet
+        return hand.pair is not None
+
+    def payout(self, players, bets, results):
+        for player in players:
+            if results[player] is None:
+                player.results['los'] += 1 #struck out, and the house keeps the bet
+                player.hands += 1
+                continue
+            outcome, credit = settle(results[player], bets[player])
+            self.pay(player, credit)
+            player.results[outcome] += 1
+            player.hands += 1
+
+    def charge(self, player, amount):
+        player.cash -= amount
+        player.staked += amount
+        player.net -= amount
+
+    def pay(self, player, amount):
+        player.cash += amount
+        player.net += amount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate hands of blackjack between bots, with no server')
+    parser.add_argument(
+            '-n','--hands',
+            default=100000,
+            type=int,
+            help='how many hands to deal',
+            metavar='hands',
+            dest='hands')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help='the number of decks in the shoe',
+            metavar='num_decks',
+            dest='num_decks')
+    parser.add_argument(
+            '--penetration',
+            default=0.75,
+            type=float,
+            help='how far through the shoe to deal before shuffling; 0 shuffles every hand',
+            metavar='fraction',
+            dest='penetration')
+    parser.add_argument(
+            '-p','--policy',
+            default=[],
+            action='append',
+            choices=sorted(policies.keys()),
+            help='a player who plays like this; give it once per seat (default: one intelligent player)',
+            dest='policies')
+    parser.add_argument(
+            '--seed',
+            default=None,
+            type=int,
+            help='seed for the shuffles and any random choices',
+            dest='seed')
+    args = parser.parse_args()
+    if len(args.policies) > 6:
+        parser.error('there are only 6 seats at a table')
+
+    rng = random.Random(args.seed)
+    engine = BlackjackEngine([policies[name](rng) for name in args.policies or ['intelligent']], rng,
+            num_decks=args.num_decks, penetration=args.penetration)
+    start = time()
+    engine.play(args.hands)
+    elapsed = time() - start
+    print('{} hands in {:.2f}s ({:.0f} hands/s)'.format(engine.hands_played, elapsed, engine.hands_played / elapsed))
+    staked = net = 0
+    for seat, player in enumerate(engine.players, 1):
+        print('seat {} ({}): {} won, {} lost, {} tied, staked {}, net {:+}, {} rebuys, {} strikes, return {:+.3%}'.format(
+            seat, player.policy.name,
+            player.results['won'], player.results['los'], player.results['tie'],
+            player.staked, player.net, player.rebuys, player.strikes,
+            float(player.net) / player.staked if player.staked else 0))
+        staked += player.staked
+        net += player.net
+    print('house edge: {:.3%}'.format(-float(net) / staked if staked else 0))
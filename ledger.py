@@ -0,0 +1,167 @@
+'''Durable player balances.
+
+Every change to a balance is a numbered record in an append-only log:
+    seq|id|amount
+Records are collected in memory and written with one fsync per commit.
+Left to itself commit does something at most once per commit_interval,
+but the server forces one before each pass of its loop writes to the
+clients (see BlackjackServer.serve), so the group is whatever one pass
+did; either way a busy server pays for far fewer fsyncs than bets.
+
+Every snapshot_every records the balances are written out whole (to a
+temporary file that is then renamed over the old snapshot) and the log
+starts again. The game can't stop for that, so the log is renamed out of
+the way and a fresh one started, and a background thread writes a copy
+of the balances and then deletes the old log. On startup the snapshot is
+read and the records after it, in the old log if there is one and then
+the log, are replayed.
+'''
+import os
+import json
+import logging
+import threading
+from time import time
+
+ACCOUNTS_FILE = 'blackjack_accounts'
+LEDGER_FILE = 'blackjack_ledger'
+STARTING_CASH = 1000
+
+logger = logging.getLogger('blackjack.ledger')
+
+
+class AccountLedger(object):
+    def __init__(self, snapshot_path=ACCOUNTS_FILE, log_path=LEDGER_FILE,
+            commit_interval=0.01, snapshot_every=10000):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.old_log_path = log_path + '.old' #the log before the snapshot being written
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+
+        self.accounts = {} #id:cash pairs
+        self.seq = 0 #number of the last record
+        self.pending = [] #records that haven't been written yet
+        self.last_commit = 0
+        self.since_snapshot = 0 #records in the log file
+        self._snapshotter = None #the thread writing a snapshot, if one is
+        self._load_snapshot()
+        self._replay(self.old_log_path)
+        self._replay(self.log_path)
+        self.log = open(self.log_path, 'a')
+        if os.path.exists(self.old_log_path):
+            self.snapshot() #we stopped before the last one was written
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as snapshot_f:
+                data = json.load(snapshot_f)
+        except IOError:
+            return # don't worry if the file isn't there.
+        if 'seq' in data:
+            #ids are always twelve characters, so this can't be a player
+            self.seq = data['seq']
+            data = data['accounts']
+        #otherwise it's a plain id:cash file from before there was a ledger
+        for id_ in data:
+            self.accounts[id_] = int(data[id_])
+
+    def _replay(self, path):
+        try:
+            log_f = open(path, 'r+')
+        except IOError:
+            return
+        with log_f:
+            good_bytes = 0
+            for line in iter(log_f.readline, ''):
+                if not line.endswith('\n'):
+                    break #we crashed part way through writing this one
+                seq, id_, amount = line[:-1].split('|')
+                good_bytes += len(line)
+                if int(seq) <= self.seq:
+                    continue #already in the snapshot
+                self._apply(id_, int(amount))
+                self.seq = int(seq)
+                self.since_snapshot += 1
+            #don't leave a torn record for the next one to be appended to
+            log_f.truncate(good_bytes)
+        if self.since_snapshot:
+            logger.info('replayed %d ledger records from %s', self.since_snapshot, path)
+
+    def _apply(self, id_, amount):
+        self.accounts[id_] = self.accounts.get(id_, STARTING_CASH) + amount
+
+    def claim(self, id_):
+        '''The balance for id_. New players start with STARTING_CASH.'''
+        return self.accounts.setdefault(id_, STARTING_CASH)
+
+    def release(self, id_):
+        pass #the balance stays here for when they come back
+
+    def change(self, id_, amount):
+        '''Add amount (negative for a debit) to id_'s balance.'''
+        self._apply(id_, amount)
+        self.seq += 1
+        self.pending.append('{}|{}|{}\n'.format(self.seq, id_, amount))
+
+    def due(self):
+        '''When commit next has something to do, or None.'''
+        if not self.pending:
+            return None
+        return self.last_commit + self.commit_interval
+
+    def commit(self, force=False):
+        '''Make the pending records durable, unless we committed less than
+        commit_interval ago (see due).'''
+        if not self.pending or (not force and time() < self.due()):
+            return
+        self.log.write(''.join(self.pending))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.since_snapshot += len(self.pending)
+        self.pending = []
+        self.last_commit = time()
+        if self.since_snapshot >= self.snapshot_every and not self.snapshotting():
+            self.snapshot_in_background()
+
+    def snapshotting(self):
+        return self._snapshotter is not None and self._snapshotter.is_alive()
+
+    def snapshot_in_background(self):
+        '''Start a fresh log and have a thread write the snapshot that makes
+        the old one unnecessary. Costs the game a copy of the balances.'''
+        if os.path.exists(self.old_log_path):
+            #an earlier snapshot failed; its old log still counts, so don't lose it
+            return self.snapshot()
+        self.log.close()
+        os.rename(self.log_path, self.old_log_path)
+        self.log = open(self.log_path, 'a')
+        self.since_snapshot = 0
+        self._snapshotter = threading.Thread(target=self._write_snapshot,
+                args=(self.seq, dict(self.accounts)), name='snapshot')
+        self._snapshotter.daemon = True
+        self._snapshotter.start()
+
+    def _write_snapshot(self, seq, accounts):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as snapshot_f:
+            json.dump({'seq': seq, 'accounts': accounts}, snapshot_f)
+            snapshot_f.flush()
+            os.fsync(snapshot_f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        #records up to seq are skipped on replay now, so losing this to a crash is harmless
+        if os.path.exists(self.old_log_path):
+            os.remove(self.old_log_path)
+
+    def snapshot(self):
+        '''Write out every balance and start a fresh log, here and now.
+        Everything in the log must have been committed.'''
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        self._write_snapshot(self.seq, self.accounts)
+        self.log.truncate(0)
+        self.since_snapshot = 0
+
+    def close(self):
+        self.commit(force=True)
+        self.snapshot()
+        self.log.close()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''Work out the best strategy tables for the server's rules.
+
+For every dealer upcard and every two card hand a player can be dealt, the
+value of staying, hitting, doubling down and (for pairs) splitting is
+found by recursion over what the player can draw, without replacement,
+against DealerOdds' exact dealer outcomes. A hand is settled the way the
+tables settle it: on the sign of its score, so any win pays the bet, and a
+split is won or lost on the sum of both halves' scores. When the dealer
+shows an ace, players only get to act if the dealer has no blackjack, so
+the dealer's odds there are taken given that.
+
+Some things are held fixed to keep this quick:
+    -the dealer's odds are for the shoe as it is after the first four cards
+     (the upcard and the player's two), not redone as the player draws
+    -both halves of a split are played from that same shoe, by hitting or
+     staying, whichever is best for the half on its own
+
+IntelligentUI's tables go by totals rather than by cards, so each row
+takes the action that is best over all the two card hands in it, weighted
+by how likely each is. Later moves use the same rows (see compile_strategy).
+
+Running this file prints a strategy.py for the given rules, or with --text
+the tables as a server's [auto] takes them.
+'''
+import argparse
+from collections import defaultdict
+from time import time
+from utils import RANK_CHARS, score
+from dealer_odds import DealerOdds, shoe_composition, BLACKJACK
+from client_ui import strategy_text
+
+DEALER_CARDS = '123456789T'
+ACTIONS = ['stay', 'hitt', 'down', 'splt'] #ties go to the earlier one
+
+#a finished hand's total is its category minus 16, anything under 17 being
+#the same as 16 and anything over 21 (a bust) being 22.
+#SCORES[hand][dealer] is utils.score for a bet of 1, with the dealer's
+#categories 17-21 and bust
+SCORES = [[score(hand + 16, dealer + 17, 1) for dealer in range(6)] for hand in range(7)]
+NET = [[cmp(result, 0) for result in row] for row in SCORES]
+
+_tables = {} #(num_decks, hit_soft_17):(split, ace_present, general)
+
+
+CATEGORIES = [min(max(value, 16), 22) - 16 for value in range(32)]
+CARD_VALUES = range(1, 11)
+
+
+def draw(composition, value):
+    '''composition with one card of value taken out'''
+    return composition[:value - 1] + (composition[value - 1] - 1,) + composition[value:]
+
+
+class HandOdds(object):
+    '''The values of a player's moves against one dealer upcard, with the
+    dealer's final outcomes fixed at dealer (chances of 17-21 and bust).'''
+
+    def __init__(self, dealer):
+        self.dealer = dealer
+        self.stand = [sum(chance * net for chance, net in zip(dealer, NET[hand])) for hand in range(7)]
+        self.memo = {}
+
+    def play(self, hard, ace, composition):
+        '''(expected net, chances of each final category) for a hand that
+        hits or stays, whichever is better, from here on.'''
+        key = (hard, ace, composition)
+        memo = self.memo
+        if key in memo:
+            return memo[key]
+        value = hard + 10 if ace and hard <= 11 else hard
+        finals = [0.0] * 7
+        finals[CATEGORIES[value]] = 1.0
+        best = (self.stand[CATEGORIES[value]], finals)
+        if value < 21:
+            hit = self.hit(hard, ace, composition)
+            if hit[0] > best[0]:
+                best = hit
+        memo[key] = best
+        return best
+
+    def hit(self, hard, ace, composition):
+        '''(expected net, chances of each final category) for taking one
+        card, then playing on'''
+        total = float(sum(composition))
+        ev = 0.0
+        finals = [0.0] * 7
+        for card_value in CARD_VALUES:
+            count = composition[card_value - 1]
+            if not count:
+                continue
+            chance = count / total
+            after_ev, after_finals = self.play(hard + card_value, ace or card_value == 1, draw(composition, card_value))
+            ev += chance * after_ev
+            finals = [final + chance * after for final, after in zip(finals, after_finals)]
+        return ev, finals
+
+    def down(self, hard, ace, composition):
+        '''the expected net of doubling: twice that of one card and staying'''
+        total = sum(composition)
+        ev = 0.0
+        for card_value in range(1, 11):
+            if composition[card_value - 1]:
+                chance = float(composition[card_value - 1]) / total
+                new_hard = hard + card_value
+                new_ace = ace or card_value == 1
+                ev += chance * self.stand[CATEGORIES[new_hard + 10 if new_ace and new_hard <= 11 else new_hard]]
+        return 2 * ev
+
+    def split(self, pair_value, composition):
+        '''the expected net of splitting a pair, settled on both halves
+        together'''
+        total = sum(composition)
+        half = [0.0] * 7
+        for card_value in range(1, 11):
+            if composition[card_value - 1]:
+                chance = float(composition[card_value - 1]) / total
+                finals = self.play(pair_value + card_value, pair_value == 1 or card_value == 1, draw(composition, card_value))[1]
+                for hand in range(7):
+                    half[hand] += chance * finals[hand]
+        ev = 0.0
+        for dealer, dealer_chance in enumerate(self.dealer):
+            for first in range(7):
+                for second in range(7):
+                    ev += dealer_chance * half[first] * half[second] * cmp(SCORES[first][dealer] + SCORES[second][dealer], 0)
+        return ev
+
+
+def best_moves(num_decks=2, hit_soft_17=True):
+    '''{(table, row, dealer card): {action: weighted expected net}} for
+    table one of 'split', 'ace_present' and 'general'.'''
+    odds = DealerOdds(hit_soft_17=hit_soft_17)
+    moves = defaultdict(lambda: defaultdict(float))
+    for upcard in range(1, 11):
+        dealer_card = DEALER_CARDS[upcard - 1]
+        shoe = draw(shoe_composition(num_decks), upcard)
+        total = sum(shoe)
+        for first in range(1, 11):
+            for second in range(first, 11):
+                if not shoe[first - 1] or not shoe[second - 1] - (first == second):
+                    continue
+                chance = float(shoe[first - 1]) / total * (shoe[second - 1] - (first == second)) / (total - 1)
+                if first != second:
+                    chance *= 2
+                rest = draw(draw(shoe, first), second)
+                dealer = list(odds.outcomes(upcard, rest))
+                if upcard == 1:
+                    no_blackjack = 1 - dealer[BLACKJACK]
+                    dealer = [dealer_chance / no_blackjack for dealer_chance in dealer[:BLACKJACK]]
+                else:
+                    dealer[4] += dealer[BLACKJACK] #a ten showing doesn't end the hand
+                    dealer = dealer[:BLACKJACK]
+                hand = HandOdds(dealer)
+
+                hard = first + second
+                ace = first == 1
+                values = {
+                    'stay': hand.stand[CATEGORIES[hard + 10 if ace and hard <= 11 else hard]],
+                    'hitt': hand.hit(hard, ace, rest)[0],
+                    'down': hand.down(hard, ace, rest),
+                    }
+                if first == second:
+                    pair = dict(values, splt=hand.split(first, rest))
+                    for action, ev in pair.items():
+                        moves[('split', first, dealer_card)][action] += ev
+                if ace:
+                    key = ('ace_present', second if second != 1 else 0, dealer_card)
+                else:
+                    key = ('general', hard, dealer_card)
+                for action, ev in values.items():
+                    moves[key][action] += chance * ev
+    return moves
+
+
+def optimal_strategies(num_decks=2, hit_soft_17=True):
+    '''(split_strategies, ace_present_strategies, general_strategies) in
+    the shape IntelligentUI uses, as plain dicts with every dealer card.
+    Worked out once per set of rules.'''
+    rules = (num_decks, hit_soft_17)
+    if rules not in _tables:
+        split = {}
+        ace_present = {}
+        general = {}
+        tables = {'split': split, 'ace_present': ace_present, 'general': general}
+        for (table, row, dealer_card), values in best_moves(num_decks, hit_soft_17).items():
+            best = max(ACTIONS, key=lambda action: (values.get(action, float('-inf')), -ACTIONS.index(action)))
+            if table == 'split':
+                #one row per rank with this value, so a pair of jacks is found as well as a pair of tens
+                for rank in RANK_CHARS[row - 1:] if row == 10 else RANK_CHARS[row - 1]:
+                    split.setdefault(rank, {})[dealer_card] = best
+            else:
+                tables[table].setdefault(row, {})[dealer_card] = best
+        general[21] = dict((dealer_card, 'stay') for dealer_card in DEALER_CARDS)
+        _tables[rules] = (split, ace_present, general)
+    return _tables[rules]
+
+
+def format_table(name, comment, table):
+    lines = ['{} = {{{}'.format(name, comment)]
+    rows = sorted(table.items(), key=lambda item: RANK_CHARS.index(item[0]) if name == 'split_strategies' else item[0])
+    for row, by_dealer in rows:
+        actions = [by_dealer[dealer_card] for dealer_card in DEALER_CARDS]
+        default = max(ACTIONS, key=actions.count)
+        exceptions = ['                {!r}:{!r}'.format(dealer_card, by_dealer[dealer_card])
+                for dealer_card in DEALER_CARDS if by_dealer[dealer_card] != default]
+        if exceptions:
+            lines.append('            {!r}:defaultdict(lambda: {!r}, {{'.format(row, default))
+            lines.append(',\n'.join(exceptions) + '}),')
+        else:
+            lines.append('            {!r}:defaultdict(lambda: {!r}),'.format(row, default))
+    lines[-1] = lines[-1].rstrip(',')
+    lines.append('            }')
+    return '\n'.join(lines)
+
+
+def format_strategies(strategies):
+    '''strategy.py's source for a set of tables'''
+    split, ace_present, general = strategies
+    return '\n'.join([
+        'from collections import defaultdict',
+        format_table('split_strategies', ' #doubled_card:{dealer_card:action}', split),
+        format_table('ace_present_strategies', '#othercardsum:{dealer_card:action}', ace_present),
+        format_table('general_strategies', '#cardsum:{dealer_card:action}', general),
+        ''])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print a strategy.py with the best tables for a set of rules')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help='the number of decks in the shoe',
+            metavar='num_decks',
+            dest='num_decks')
+    parser.add_argument(
+            '--stand-soft-17',
+            action='store_false',
+            help='the dealer stands on every 17 (the server hits 17 with an ace)',
+            dest='hit_soft_17')
+    parser.add_argument(
+            '--text',
+            action='store_true',
+            help="print the tables as the letters a server's [auto] takes, rather than as a strategy.py",
+            dest='text')
+    args = parser.parse_args()
+
+    start = time()
+    strategies = optimal_strategies(args.num_decks, args.hit_soft_17)
+    if args.text:
+        print(strategy_text(*strategies))
+    else:
+        print('#made by optimal_strategy.py for {} decks, dealer {} soft 17, in {:.1f}s'.format(
+            args.num_decks, 'hits' if args.hit_soft_17 else 'stands on', time() - start))
+        print(format_strategies(strategies))
@@ -0,0 +1,190 @@
+import select
+import errno
+import heapq
+import logging
+from itertools import count
+from time import time
+
+logger = logging.getLogger('blackjack.reactor')
+
+
+class Reactor(object):
+    '''Watches sockets and calls back when they are ready, so one loop can look
+    after every socket in the process. Uses epoll where the platform has it,
+    then poll, then plain select. Only the sockets that are actually ready
+    cost anything on a wakeup with the first two.
+
+    Sockets are remembered by their file descriptor at registration time, so
+    they can still be removed after they have been closed.'''
+
+    def __init__(self):
+        self.readers = {} #fd:callback
+        self.writers = {} #fd:callback
+        self.fds = {} #sock:fd pairs
+        self._registered = set() #fds the poller knows about
+        if hasattr(select, 'epoll'):
+            self.kind = 'epoll'
+            self._poller = select.epoll()
+            self._read_mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._write_mask = select.EPOLLOUT
+        elif hasattr(select, 'poll'):
+            self.kind = 'poll'
+            self._poller = select.poll()
+            self._read_mask = select.POLLIN | select.POLLERR | select.POLLHUP
+            self._write_mask = select.POLLOUT
+        else:
+            self.kind = 'select'
+            self._poller = None
+            self._read_mask = 1
+            self._write_mask = 2
+
+    def __len__(self):
+        return len(self.fds)
+
+    def add_reader(self, sock, callback):
+        fd = self.fds.setdefault(sock, sock.fileno())
+        already_watching = fd in self.readers
+        self.readers[fd] = callback
+        if not already_watching:
+            self._update(fd)
+
+    def remove_reader(self, sock):
+        if sock in self.fds and self.readers.pop(self.fds[sock], None) is not None:
+            self._update(self.fds[sock])
+
+    def add_writer(self, sock, callback):
+        fd = self.fds.setdefault(sock, sock.fileno())
+        already_watching = fd in self.writers
+        self.writers[fd] = callback
+        if not already_watching:
+            self._update(fd)
+
+    def remove_writer(self, sock):
+        if sock in self.fds and self.writers.pop(self.fds[sock], None) is not None:
+            self._update(self.fds[sock])
+
+    def remove(self, sock):
+        '''Stop watching sock altogether. Safe to call on a closed socket.'''
+        fd = self.fds.pop(sock, None)
+        if fd is None:
+            return
+        self.readers.pop(fd, None)
+        self.writers.pop(fd, None)
+        self._unregister(fd)
+
+    def _update(self, fd):
+        if self._poller is None:
+            return
+        mask = 0
+        if fd in self.readers:
+            mask |= self._read_mask
+        if fd in self.writers:
+            mask |= self._write_mask
+        if not mask:
+            self._unregister(fd)
+        elif fd in self._registered:
+            self._poller.modify(fd, mask)
+        else:
+            self._poller.register(fd, mask)
+            self._registered.add(fd)
+
+    def _unregister(self, fd):
+        if fd not in self._registered:
+            return
+        self._registered.discard(fd)
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass #it was never registered, or the socket is already closed
+
+    def poll(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None) and run the callbacks
+        of every socket that became ready.'''
+        try:
+            if self.kind == 'epoll':
+                events = self._poller.poll(-1 if timeout is None else timeout)
+            elif self.kind == 'poll':
+                events = self._poller.poll(None if timeout is None else int(timeout * 1000))
+            else:
+                events = self._select(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, mask in events:
+            if mask & ~self._write_mask and fd in self.readers:
+                self.readers[fd]()
+            #the read callback may have removed this socket
+            if mask & self._write_mask and fd in self.writers:
+                self.writers[fd]()
+
+    def _select(self, timeout):
+        readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+        events = dict((fd, self._read_mask) for fd in readable)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | self._write_mask
+        return events.items()
+
+
+class Timers(object):
+    '''Deadlines for the same loop as a Reactor: at most one per key, each
+    with a callback that run calls with the key once it has passed. They
+    sit in a heap, so setting one and running the next is O(log n) and
+    finding the earliest O(1) however many there are.
+
+    Setting a key again or cancelling it leaves its old entry in the heap,
+    to be skipped when it comes up; the heap is rebuilt without them if
+    they come to outnumber the live ones.'''
+
+    def __init__(self):
+        self._heap = [] #(deadline, order set, key)
+        self._timers = {} #key:(deadline, callback)
+        self._order = count()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def set(self, key, deadline, callback):
+        if self._timers.get(key, (None,))[0] == deadline:
+            self._timers[key] = (deadline, callback)
+            return #already in the heap
+        self._timers[key] = (deadline, callback)
+        heapq.heappush(self._heap, (deadline, next(self._order), key))
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            self._heap = [(deadline, next(self._order), key) for key, (deadline, callback) in self._timers.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key):
+        self._timers.pop(key, None)
+
+    def _live(self, entry):
+        deadline, order, key = entry
+        return self._timers.get(key, (None,))[0] == deadline
+
+    def next(self):
+        '''The earliest deadline, or None if there are none.'''
+        heap = self._heap
+        while heap and not self._live(heap[0]):
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def timeout(self):
+        '''How long a Reactor may poll before the next deadline: None for
+        as long as it likes.'''
+        deadline = self.next()
+        return None if deadline is None else max(deadline - time(), 0)
+
+    def run(self, now=None):
+        '''Call back every timer whose deadline has passed, earliest first.
+        Callbacks may set and cancel timers, this one included.'''
+        now = time() if now is None else now
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if self._live(entry):
+                key = entry[2]
+                deadline, callback = self._timers.pop(key)
+                callback(key)
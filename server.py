@@ -1,17 +1,32 @@
 #!/usr/bin/env python
 import socket as s
 import traceback
-from select import select
-from utils import MessageBuffer, MessageBufferException, ChatHandler, BlackjackDeck, BlackjackHand, BlackjackError, escape_chars, colors, validate_name
-from collections import deque, defaultdict
+import errno
+from utils import MessageBuffer, MessageBufferException, ChatHandler, QueueHandler, BlackjackError, escape_chars, colors, validate_name
+from table import BlackjackTable
+from wire import FrameBuffer, encode, name_frame, DEALER_NUMBER
+from engine import TablePolicy, StandingOrders, policies
+from client_ui import parse_strategy_text, STRATEGY_TEXT_LEN
+from reactor import Reactor, Timers
+from workers import run_workers
+from ledger import AccountLedger
+from collections import deque
 from time import time
 import signal
 import sys
 import argparse
-import json
 import logging
 import string
+import struct
+import heapq
 
+#the strategies an [auto] can name. The optimal tables take seconds to work
+#out, which the server can't spare; clients can send them as text instead
+AUTO_STRATEGIES = ['stay', 'auto', 'intelligent']
+INSURANCE_RULES = ['none', 'half']
+#the start of Linux's struct tcp_info. For a listening socket, unacked is
+#how many connections are waiting to be accepted and sacked the backlog
+TCP_INFO_HEAD = struct.Struct('8B6I')
 
 class Client(object):
     def __init__(self, sock):
@@ -19,13 +34,21 @@ class Client(object):
         self.mbuffer = MessageBuffer(sock)
         self.strikes = 0
         self.id_ = ''
+        self.outbox = bytearray() #bytes we owe this client, written out as the socket allows
+        self.framed = False #whether they asked for binary frames (see wire.py) rather than text
+        self.watching = None #the table they are spectating, if they are
+        self.stale = False #whether a spectator needs a whole snapshot rather than the changes
+        self.orders = None #an engine.StandingOrders the table plays for them with, after an [auto]
 
     #def __del__(self):
     #    del self.mbuffer
 
 
 class BlackjackServer(object):
-    def __init__(self, port=36709, timeout=30, join_wait=30, max_tcp=None):
+    def __init__(self, port=36709, timeout=30, join_wait=30, max_tcp=None, num_tables=1, max_backlog=65536, coordinator=None,
+            log_level='DEBUG', async_logging=False, wire_log_every=1, chat_notice_rate=10,
+            num_decks=2, penetration=0.75, spectator_interval=0.25, idle_timeout=None,
+            listen_backlog=128, accept_batch=64):
         self.MAX_PLAYERS = 6
         self.MIN_BET = 4
         self.MAX_STRIKES = 3
@@ -35,34 +58,45 @@ class BlackjackServer(object):
         self.port = port
         self.timeout = timeout
         self.join_wait = join_wait
-        self.max_tcp = max_tcp
-        self.accounts = {}
-        #persistent accounts
-        try:
-            with open('blackjack_accounts','r') as account_f:
-                self.accounts.update(json.load(account_f))
-                for k in self.accounts:
-                    self.accounts[k] = int(self.accounts[k])
-        except IOError:
-            pass # don't worry if the file isn't there.
+        self.max_tcp = max_tcp #connections past this many are turned away
+        self.accept_batch = accept_batch #most connections to accept in one go, so games aren't held up
+        self.turned_away = 0 #connections refused for being over max_tcp
+        self.idle_timeout = idle_timeout #seconds a connection may go without joining or watching
+        self.max_backlog = max_backlog #bytes a client may fall behind before we drop them
+        self.num_decks = num_decks
+        self.penetration = penetration #how far into the shoe the cut card goes
+        #when we are one of several worker processes, the accounts live with
+        #the coordinator, and we only hold the ones of players connected to us.
+        self.coordinator = coordinator
+        #persistent accounts. Every change goes through self.ledger.change,
+        #self.accounts is for looking balances up.
+        self.ledger = AccountLedger() if coordinator is None else coordinator
+        self.accounts = self.ledger.accounts
 
         #the chat handler depends on self.clients, so it is very important to
         #define self.clients first
         self.clients = {} #sock:Client pairs
 
-        #TODO add a special client sock here to implement the gui. This can be 
-        #a dumb client who never manages to get out of the lobby queue, (because they're not in it)
-        #but receives all the messages that the clients do.
+        #spectators (a gui, say) send [watc|table] rather than joining. They
+        #aren't sent anything as it happens: every spectator_interval seconds
+        #each table's messages since last time go out to its spectators in
+        #one batch, see fan_out.
+        self.spectators = set() #the socks of every spectator, at any table
+        self.spectator_interval = spectator_interval
+        self.next_fan_out = time()
 
 
         #logging stuff
+        log_level = getattr(logging, log_level)
         self.logger = logging.getLogger('blackjack')
-        self.logger.setLevel(logging.DEBUG)
+        #the chat handler always wants INFO
+        self.logger.setLevel(min(log_level, logging.INFO))
+        MessageBuffer.log_every = wire_log_every
 
         fh = logging.FileHandler('server.log')
-        fh.setLevel(logging.DEBUG)
+        fh.setLevel(log_level)
         ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
+        ch.setLevel(log_level)
         # create formatter and add it to the handlers
         format_style = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         formatter = logging.Formatter(colors.DIM + format_style + colors.ENDC)
@@ -70,11 +104,17 @@ class BlackjackServer(object):
         fh.setFormatter(formatter_no_color)
         ch.setFormatter(formatter)
         # add the handlers to the logger
-        self.logger.addHandler(fh)
-        self.logger.addHandler(ch)
+        if async_logging:
+            #the file and the terminal get written from another thread
+            qh = QueueHandler([fh, ch])
+            qh.setLevel(log_level)
+            self.logger.addHandler(qh)
+        else:
+            self.logger.addHandler(fh)
+            self.logger.addHandler(ch)
 
 
-        c_handler = ChatHandler(self.broadcast, 'SERVER')
+        c_handler = ChatHandler(self.broadcast, 'SERVER', rate=chat_notice_rate)
         c_handler.setLevel(logging.INFO)
         c_handler.setFormatter(formatter_no_color)
         self.logger.addHandler(c_handler)
@@ -86,75 +126,205 @@ class BlackjackServer(object):
         self.m_handlers['turn'] = self.handle_turn
         self.m_handlers['insu'] = self.handle_insu
         self.m_handlers['ante'] = self.handle_ante
+        self.m_handlers['watc'] = self.handle_watch
+        self.m_handlers['auto'] = self.handle_auto
+        #the named strategies hold no state of their own, so players share them
+        self.auto_strategies = dict((name, policies[name]()) for name in AUTO_STRATEGIES)
 
         self.server = s.socket(s.AF_INET, s.SOCK_STREAM)
         self.server.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+        if self.coordinator is not None:
+            #the other workers listen on this port too; the kernel spreads connections between us
+            self.server.setsockopt(s.SOL_SOCKET, s.SO_REUSEPORT, 1)
         self.server.bind((self.host,self.port))
-        self.server.listen(5) #what is this?
+        #connections the kernel will hold for us until we get round to accepting them
+        self.server.listen(listen_backlog)
+        self.server.setblocking(0)
 
         signal.signal(signal.SIGINT, self.sighandler)
 
-        self.watched_socks = [self.server]
-        self.bets = {} #sock:ante pairs. These are updated for a split or down
-        self.occupied_seats = {} #sock:seat_number pairs; the current players
-        self.hands = {} #sock:BlackjackHand pairs, plus one 'dealer':BlackjackHand
-        self.insu = defaultdict(lambda: 0) #The amount of insurance we owe everyone.
-        self.results = defaultdict(lambda : 0) #a dollar score for each player. 
-        #positive is a win, negative a tie 
-        self.deck = BlackjackDeck() 
+        self.reactor = Reactor()
+        #every deadline the loop has to wake up for: each table's (keyed by
+        #the table), the spectators' next batch, the ledger's next commit,
+        #and connections that have yet to join (keyed by their sock)
+        self.timers = Timers()
+        self.reactor.add_reader(self.server, self.accept_clients)
         self.lobby = deque() 
-        self.state='waiting to start game'
-        self.game_in_progress = False
-        self.split_store = False 
-
-    def broadcast(self, msg):
-        self.logger.debug('sending message: {}'.format(msg))
-        clients = self.clients.keys()
+        self.seated_at = {} #sock:BlackjackTable pairs; everyone sitting at a table
+        self.unseated = set() #the other clients: the lobby, watchers, and people who haven't joined
+        self.socks_by_id = {} #id:sock pairs for everyone who has joined
+        #everyone who has joined also gets a number, which stands in for
+        #their id in binary frames
+        self.numbers = {'SERVER      ': DEALER_NUMBER} #id:number pairs
+        self.free_numbers = [] #given up by players who left
+        self.next_number = DEALER_NUMBER + 1
+        #each table has its own deck, seats, bets and state.
+        self.tables = [BlackjackTable(self, number) for number in range(1, num_tables + 1)]
+        self.open_tables = [] #(number, table) heap of tables that may be able to seat someone
+        for table in self.tables:
+            self.table_opened(table)
+        self.games = {} #table:generator pairs, see BlackjackTable.play
+        self.awake = set() #tables that have something new to look at
+        self.unflushed = set() #clients with messages queued since the last flush_all
+
+    def broadcast(self, msg, table=None):
+        '''Send msg to every client. If a table is given, players seated at
+        the other tables are skipped; they have their own game to follow.'''
+        self.logger.debug('sending message: %s', msg)
+        if table is None:
+            clients = self.clients.keys()
+            if self.spectators:
+                clients = [client for client in clients if client not in self.spectators]
+        else:
+            clients = table.players() + list(self.unseated)
+            if table.spectators:
+                table.changes.append(msg)
+        frames = None #msg as binary frames, made the first time someone wants them
         for client in clients:
-            try:
-                if client in clients:
-                    client.sendall(msg)
+            if client in self.clients:
+                if self.clients[client].framed:
+                    if frames is None:
+                        frames = encode(msg, self.numbers)
+                    self.send(client, frames, framed=True)
                 else:
-                    self.logger.debug('static iteration on a dynamic list')
-            except Exception as e:
+                    self.send(client, msg)
+            else:
+                self.logger.debug('static iteration on a dynamic list')
+
+    def send(self, sock, msg, framed=False):
+        '''Queue msg for sock. Nothing is written until flush_all, so all the
+        messages one event produces (a hit that busts, the split that follows,
+        the dealer's whole turn) go out to each client in a single write.
+        msg is text, which is turned into frames for clients that want them,
+        unless framed says it already has been.'''
+        client = self.clients.get(sock)
+        if client is None:
+            return
+        if client.framed and not framed:
+            msg = encode(msg, self.numbers)
+        client.outbox += msg
+        self.unflushed.add(sock)
+
+    def flush_all(self):
+        if self.ledger.pending:
+            return #nothing goes out until the balances in it are on disk, see serve
+        #dropping a slow client broadcasts their exit, which queues more
+        while self.unflushed:
+            self.flush(self.unflushed.pop())
+
+    def flush(self, sock):
+        '''Write as much of the outbox as the socket will take without
+        blocking. The rest goes out when the socket is writable again. A
+        client that lets more than max_backlog bytes pile up is dropped, so
+        one slow reader can't hold up the table.'''
+        client = self.clients.get(sock)
+        if client is None or not client.outbox:
+            return
+        if self.ledger.pending:
+            #wait for the commit; flush_all will be back for this
+            self.reactor.remove_writer(sock)
+            self.unflushed.add(sock)
+            return
+        try:
+            sent = sock.send(client.outbox)
+        except s.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
                 self.logger.debug(traceback.format_exc())
-                self.drop_client(client, reason='here in broadcast, sock appears to be closed')
-
-    def empty_seat(self):
-        return min(set(range(1,self.MAX_PLAYERS + 1)).difference(
-            {seat for sock,seat in self.occupied_seats.iteritems() }))
-
-    def handle_join(self, sock, id_):
+                return self.drop_client(sock, reason='here in flush, sock appears to be closed')
+            sent = 0
+        del client.outbox[:sent]
+        if len(client.outbox) > self.max_backlog:
+            self.drop_client(sock, reason='too far behind reading messages ({} bytes queued)'.format(
+                len(client.outbox)))
+        elif client.outbox:
+            self.reactor.add_writer(sock, lambda: self.flush(sock))
+        else:
+            self.reactor.remove_writer(sock)
+
+    def table_opened(self, table):
+        '''Called when table might be able to seat someone new. Tables that
+        turn out to be full or mid-game are weeded out by open_table.'''
+        if not table.listed:
+            heapq.heappush(self.open_tables, (table.number, table))
+            table.listed = True
+
+    def open_table(self):
+        '''The first table that is between games and has a free seat, or None.'''
+        while self.open_tables:
+            number, table = self.open_tables[0]
+            if not table.game_in_progress and table.has_free_seat():
+                return table
+            heapq.heappop(self.open_tables)
+            table.listed = False
+        return None
+
+    def handle_join(self, sock, id_, framing=None):
+        '''[join|id], or [join|id|bnry] to switch to binary frames once joined.'''
+        if framing not in (None, 'bnry'):
+            return self.scold(sock, 'The only framing on offer is "bnry"; leave it out for text.')
         if id_ != validate_name(id_):
             return self.scold(sock, 'Id must be twelve characters long, right padded with spaces if necessary. You gave "{name}", try "{name:<12}"'.format(name=id_))
         #split this to a handle_join, midgame, and a handle_join
-        if id_ in [self.clients[client].id_ for client in self.clients]:
-            if sock == [client for client in self.clients if self.clients[client].id_==id_][0]:
-                return self.scold(sock, "You've already joined!")
+        if sock in self.clients and self.clients[sock].id_:
+            return self.scold(sock, "You've already joined!")
+        if id_ in self.socks_by_id:
             return self.scold(sock, "ID {} is already in use.".format(id_))
         if id_ == 'SERVER      ':
             return self.scold(sock, '"SERVER      " is a reserved name and cannot be used.')
         if not (all(c in (string.ascii_letters + string.digits + ' ') for c in id_) and
                 id_[0] in string.ascii_letters):
-            self.logger.debug('invalid name : "{}"'.format(id_))
+            self.logger.debug('invalid name : "%s"', id_)
             return self.scold(sock, "ID must be alphanumeric and start with a letter.")
         if sock not in self.clients:
             return False #they've already left
 
+        if not self.free_numbers and self.next_number >= 0xffff:
+            return self.scold(sock, "The server is full.", fatal=True)
+        if not self.open_account(id_):
+            return self.scold(sock, "ID {} is already in use.".format(id_))
         self.clients[sock].id_ = id_
-        self.accounts[id_] = self.accounts.get(id_, 1000) #default to 1000
-        if not self.game_in_progress and len(self.occupied_seats) < 6 and self.accounts[id_] > self.MIN_BET:
-            location = 'tabl'
-            empty_seat = self.empty_seat()
-            self.occupied_seats[sock] = empty_seat
+        self.socks_by_id[id_] = sock
+        self.timers.cancel(sock) #no longer idle
+        if self.free_numbers:
+            self.numbers[id_] = self.free_numbers.pop()
+        else:
+            self.numbers[id_] = self.next_number
+            self.next_number += 1
+        #clients on frames hear who the number is now, since they may never see them join
+        name = name_frame(self.numbers[id_], id_)
+        for other_sock, other in self.clients.items():
+            if other.framed:
+                self.send(other_sock, name, framed=True)
+        if framing is not None:
+            self.start_frames(sock)
+        table = self.open_table() if self.accounts[id_] > self.MIN_BET else None
+        if table is not None:
+            table.seat(sock)
         else:
-            location = 'lbby'
             self.lobby.append(sock)
-        self.broadcast('[join|{id_}|{timeout}|{cash:0>10}|{seat}]'.format(
-            id_=id_,
-            timeout=self.timeout,
-            cash=self.accounts[id_],
-            seat=0 if sock not in self.occupied_seats else self.occupied_seats[sock]))
+            self.broadcast('[join|{id_}|{timeout}|{cash:0>10}|0]'.format(
+                id_=id_,
+                timeout=self.timeout,
+                cash=self.accounts[id_]))
+
+    def start_frames(self, sock):
+        '''Tell sock's client their number with a [bnry], the last text they
+        get, then who everyone else is. From here on it's frames both ways.'''
+        client = self.clients[sock]
+        self.send(sock, '[bnry|{}]'.format(self.numbers[client.id_]))
+        client.outbox += ''.join(name_frame(number, id_) for id_, number in self.numbers.iteritems()
+                if id_ != client.id_ and id_ in self.socks_by_id)
+        client.framed = True
+        #they were told to wait for the [bnry], so anything still in the old buffer is junk
+        client.mbuffer = FrameBuffer(sock, from_server=False)
+
+    def open_account(self, id_):
+        '''Make sure self.accounts has a balance for id_. False if another worker has that player.'''
+        return self.ledger.claim(id_) is not None
+
+    def close_account(self, id_):
+        if id_ in self.accounts:
+            self.ledger.release(id_)
 
     def handle_chat(self, sock, text):
         if len(text)> self.MAX_CHAT_LEN:
@@ -170,365 +340,235 @@ class BlackjackServer(object):
     def handle_exit(self,sock):
         self.drop_client(sock,reason='They sent an exit')
 
+    def handle_auto(self, sock, ante=None, insurance=None, strategy=None):
+        '''[auto|ante|insurance|strategy]: from now on the table makes sock's
+        decisions as they come up, without asking them. [auto] on its own
+        goes back to asking.'''
+        client = self.clients[sock]
+        if not client.id_:
+            return self.scold(sock, reason='You must first join with a player ID.')
+        if ante is None:
+            client.orders = None
+            return True
+        if strategy is None:
+            return self.scold(sock, 'Send [auto|ante|insurance|strategy], or [auto] to play your own hands again.')
+        try:
+            amount = int(ante)
+        except ValueError:
+            amount = 0
+        if amount < self.MIN_BET:
+            return self.scold(sock, 'The standing ante must be an integer, at least {}.'.format(self.MIN_BET))
+        if insurance not in INSURANCE_RULES:
+            return self.scold(sock, 'Insurance is one of {}.'.format(INSURANCE_RULES))
+        if strategy in self.auto_strategies:
+            policy = self.auto_strategies[strategy]
+        else:
+            try:
+                policy = TablePolicy(parse_strategy_text(strategy))
+            except ValueError:
+                return self.scold(sock, 'The strategy is one of {} or a table of {} letters, see protocol.txt.'.format(
+                    AUTO_STRATEGIES, STRATEGY_TEXT_LEN))
+        client.orders = StandingOrders(amount, insurance == 'half', policy)
+        return True
+
+    def handle_watch(self, sock, number):
+        '''[watc|table]: spectate a table, or move on to another one.'''
+        client = self.clients[sock]
+        if client.id_:
+            return self.scold(sock, "Players can't spectate. You hear about the tables from the lobby anyway.")
+        try:
+            table_num = int(number)
+        except ValueError:
+            table_num = 0
+        if not 1 <= table_num <= len(self.tables):
+            return self.scold(sock, 'There is no table {}. They are numbered 1 to {}.'.format(number, len(self.tables)))
+        table = self.tables[table_num - 1]
+        if client.watching is not None:
+            self.stop_watching(sock)
+        self.unseated.discard(sock)
+        self.spectators.add(sock)
+        if not table.spectators:
+            del table.changes[:] #nobody was keeping track
+        table.spectators.add(sock)
+        client.watching = table
+        client.stale = True #a snapshot goes out with the next batch
+        self.timers.cancel(sock) #no longer idle
+        if 'fan out' not in self.timers:
+            self.timers.set('fan out', self.next_fan_out, self.fan_out)
+        return True
+
+    def stop_watching(self, sock):
+        table = self.clients[sock].watching
+        table.spectators.discard(sock)
+        self.spectators.discard(sock)
+        self.clients[sock].watching = None
+
+    def fan_out(self, key=None):
+        '''Send each table's spectators what happened there since last time.
+        That is one string per table, however many are watching. Somebody
+        who hasn't finished reading the last batch is skipped; once they
+        have, they get a snapshot of the table as it is then, so nobody
+        falls behind by more than a batch. Runs off self.timers every
+        spectator_interval while anyone is watching.'''
+        for table in self.tables:
+            if not table.spectators:
+                continue
+            changes = ''.join(table.changes)
+            del table.changes[:]
+            snapshot = None
+            for sock in table.spectators:
+                client = self.clients[sock]
+                if client.outbox:
+                    client.stale = True
+                elif client.stale:
+                    if snapshot is None:
+                        snapshot = table.snapshot()
+                    client.stale = False
+                    self.send(sock, snapshot)
+                elif changes:
+                    self.send(sock, changes)
+        self.next_fan_out = time() + self.spectator_interval
+        if self.spectators:
+            self.timers.set('fan out', self.next_fan_out, self.fan_out)
+
     def drop_client(self, sock, reason=None):
         save_id = 'an unknown client'
+        table = self.seated_at.get(sock)
+        self.reactor.remove(sock)
+        self.timers.cancel(sock)
+        if 'accept' in self.timers:
+            self.resume_accepting() #that's a file descriptor free
         if sock in self.clients:
+            if self.clients[sock].watching is not None:
+                self.stop_watching(sock)
             save_id = self.clients[sock].id_
+            outbox = self.clients[sock].outbox
             del self.clients[sock]
-            self.broadcast('[exit|{id_}]'.format(id_=save_id))
-        self.logger.info('dropping {}, id: {} because: {}'.format(sock, save_id, reason if reason is not None else '(no reason given)'))
-        if sock in self.watched_socks:
-            self.watched_socks.remove(sock)
-        if sock in self.occupied_seats:
-            del self.occupied_seats[sock]
-        if sock in self.insu:
-            del self.insu[sock]
-        if sock in self.bets:
-            del self.bets[sock]
+            if self.socks_by_id.get(save_id) is sock:
+                del self.socks_by_id[save_id]
+            self.unseated.discard(sock)
+            self.broadcast('[exit|{id_}]'.format(id_=save_id), table=table)
+            if save_id in self.numbers and save_id not in self.socks_by_id:
+                self.free_numbers.append(self.numbers.pop(save_id))
+            try:
+                #one last try to get them whatever we still owed them (their last errr, say)
+                if outbox and self.ledger.pending:
+                    self.ledger.commit(force=True)
+                sock.send(outbox)
+                sock.close()
+            except s.error:
+                pass
+        self.logger.info('dropping %s, id: %s because: %s', sock, save_id, reason if reason is not None else '(no reason given)')
+        self.close_account(save_id)
+        if table is not None:
+            del self.seated_at[sock]
+            table.drop_player(sock)
+            self.wake(table)
 
     def sighandler(self, signum, frame):
         print('Shutting down server...')
         for client in self.clients:
             client.close()
         self.server.close()
-        with open('blackjack_accounts','w') as account_f:
-            json.dump(self.accounts,account_f)
+        self.ledger.close()
         exit(0)
 
-    def accept_client(self):
-        client, address = self.server.accept()
-        self.watched_socks.append(client)
-        self.clients[client] = Client(client)
-        self.logger.debug('accepted client with sock {}'.format(client))
-
-    def wait_for_players(self):
-        while not self.occupied_seats:
-            print('waiting for clients to join...')
-            inputready, _, _ = select(self.watched_socks, [], [])
-            for sock in inputready:
-                if sock == self.server:
-                    self.accept_client()
-                elif sock in self.lobby or sock in self.occupied_seats:
-                    self.process_messages(sock, allowed_types=['chat','exit'])
-                else:
-                    self.process_messages(sock, allowed_types=['join'])
-        print('waiting for more players...')
-        start = time()
-        while time() - start < self.join_wait and self.occupied_seats and len(self.occupied_seats) < self.MAX_PLAYERS:
-            this_timeout = max(self.join_wait - (time() - start), 0) 
-            inputready, _, _ = select(self.watched_socks, [], [], this_timeout)
-            for sock in inputready:
-                if sock == self.server:
-                    self.accept_client()
-                elif sock in self.occupied_seats:
-                    self.process_messages(sock, allowed_types=['chat','exit'])
-                else:
-                    self.process_messages(sock, allowed_types=['join'])
-
-    def get_antes(self):
-        if not self.occupied_seats:
-            return self.drop_game()
-        self.state = 'waiting for antes'
-        self.logger.debug('state is {}'.format(self.state))
-        self.broadcast('[ante|{:0>10}]'.format(self.MIN_BET))
-        start = time()
-        while time() - start < self.timeout and len(self.bets) < len(self.occupied_seats):
-            this_timeout = max(self.timeout - (time() - start), 0)
-            inputready, _, _ = select(self.watched_socks, [], [], this_timeout)
-            for sock in inputready:
-                if sock == self.server:
-                    self.accept_client()
-                elif sock in self.occupied_seats:
-                    self.process_messages(sock,['chat','exit','ante'])
-                else:
-                    self.process_messages(sock,['join','chat','exit'])
-        for no_ante_player in (set(self.occupied_seats.keys()) - set(self.bets.keys())):
-            self.drop_client(no_ante_player, reason='failed to send an ante')
-
-    def deal(self, shuf=True):
-        if not self.occupied_seats:
-            return self.drop_game()
-        if shuf:
-            self.deck.shuffle()
-
-        self.hands['dealer'] = BlackjackHand(self.deck.deal(2))
-        msg = ['[deal']
-        msg.append(self.hands['dealer'].cards[0]) # only reveal one dealer card
-        msg.append('shufy' if shuf else 'shufn')
-
-        for seat_num in range(1,self.MAX_PLAYERS + 1):
-            seated_player = [sock for sock,seat in self.occupied_seats.iteritems() if seat == seat_num]
-            if seated_player == []:
-                msg.append('')
-            else:
-                player = seated_player[0]
-                self.hands[player] = BlackjackHand(self.deck.deal(2))
-                player_id = self.clients[player].id_
-                msg.append('{id_:<12},{cash:0>10},{cards[0]},{cards[1]}'.format(
-                    id_=player_id, 
-                    cash=self.accounts[player_id],
-                    cards=self.hands[player].cards))
-        msg[-1] += ']' #closing brace to message
-        self.broadcast('|'.join(msg))
-        if self.hands['dealer'].cards[0][0] == '1': #dealer has ace showing
-            self.wait_for_insurance()
-            if self.hands['dealer'].value() == 21:
-                #game can end now
-                for player in self.occupied_seats:
-                    self.evaluate_hand(player)
-                self.payout()
-                self.drop_game()
-
-           
-    def wait_for_insurance(self):
-        self.state='waiting for insurace'
-        self.logger.debug('state is {}'.format(self.state))
-        start = time()
-        while time() - start < self.timeout and len(self.insu) < len(self.occupied_seats):
-            this_timeout = max(self.timeout - (time() - start), 0)
-            inputready, _, _ = select(self.watched_socks, [], [], this_timeout)
-            for sock in inputready:
-                if sock == self.server:
-                    self.accept_client()
-                elif sock in self.occupied_seats:
-                    self.process_messages(sock,['chat','exit','insu'])
-                else:
-                    self.process_messages(sock,['join','chat','exit'])
-
-    def play_out_turns(self):
-        if not self.occupied_seats:
-            return self.drop_game()
-        dealer_moves = self.play_dealer_turn() #find out what the dealer will have at the end of the game
-        #Now we can modify everyone's cash in situ, rather than waiting till the end.
-
-        for player in sorted(self.occupied_seats, key=lambda p: self.occupied_seats[p]):
-            self.player_done = False
-            self.split_store = False
-            while not self.player_done and player in self.occupied_seats:
-                self.broadcast('[turn|{:<12}]'.format(self.clients[player].id_))
-                start = time()
-                self.player_moved = False
-                while time() - start < self.timeout and not self.player_moved and player in self.occupied_seats:
-                    this_timeout = max(self.timeout - (time() - start), 0)
-                    inputready, _, _ = select(self.watched_socks, [], [], this_timeout)
-                    for sock in inputready:
-                        if sock == self.server:
-                            self.accept_client()
-                        elif sock == player:
-                            self.process_messages(player,['chat','exit','turn'])
-                        else:
-                            self.process_messages(sock, ['join','chat','exit'])
-                if not self.player_moved:
-                    self.drop_client(player, 'timeout waiting for turn')
-        #disclose dealer moves here:
-        for move in dealer_moves:
-            self.broadcast(move)
-
-    def play_dealer_turn(self):
-        #send the stat message for the dealer's second card
-        dealer_moves = ['[turn|SERVER      ]']
-        msg = '[stat|SERVER      |{action}|{card}|{bust}|0000000000]'
-        dealer_moves.append(msg.format(
-                action='hitt',
-                card=self.hands['dealer'].cards[1],
-                bust='bustn'))
-        my_hand = self.hands['dealer']
-        while True:
-            if my_hand.value() <= 16 or ('1' in [card[0] for card in my_hand.cards] and my_hand.value() <= 17):
-                new_card = self.deck.deal(1)[0]
-                my_hand.cards.append(new_card)
-                val = my_hand.value()
-                dealer_moves.append('[turn|SERVER      ]')
-                dealer_moves.append(msg.format(
-                    action='hitt',
-                    card=new_card,
-                    bust='bustn' if val <= 21 else 'busty'))
-                if val > 21:
-                    break #bust!
+    def accept_queue_depth(self):
+        '''How many connections are waiting for us to accept them, or None
+        if the platform won't say.'''
+        if not hasattr(s, 'TCP_INFO'):
+            return None
+        try:
+            info = self.server.getsockopt(s.IPPROTO_TCP, s.TCP_INFO, TCP_INFO_HEAD.size)
+        except s.error:
+            return None
+        return TCP_INFO_HEAD.unpack(info)[12]
+
+    def accept_clients(self):
+        '''Accept whatever connections are waiting, up to accept_batch of
+        them; the reactor calls again next time round for any more, once
+        the tables have had a look in.'''
+        for _ in xrange(self.accept_batch):
+            try:
+                client, address = self.server.accept()
+            except s.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return #that was all of them
+                if e.args[0] == errno.ECONNABORTED:
+                    continue #gone before we got to it; on to the next
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    return self.pause_accepting(e)
+                raise
+            if self.max_tcp is not None and len(self.clients) >= self.max_tcp:
+                self.turn_away(client)
             else:
-                dealer_moves.append('[turn|SERVER      ]')
-                dealer_moves.append(msg.format(
-                    action='stay',
-                    card='xx',
-                    bust='bustn'))
-                break
-        return dealer_moves
-                
-
-
-    def handle_turn(self,sock,action):
-        action_handlers = {
-                'hitt':self.action_hitt,
-                'stay':self.action_stay,
-                'down':self.action_down,
-                'splt':self.action_split
-            }
-        self.player_moved = True
-        if action in action_handlers:
-            return action_handlers[action](sock)
-        else:
-            return self.scold(sock, 'Invalid action. Valid actions are hitt, stay, down, or splt.')
-
-
-    def action_hitt(self,player):
-        new_card = self.deck.deal(1)[0]
-        player_id = self.clients[player].id_
-
-        self.hands[player].cards.append(new_card)
-        
-        hand_value = self.hands[player].value()
-                
-        msg = '[stat|{id_}|hitt|{card}|{bust}|{bet}]'.format(
-                id_=player_id,
-                card=new_card,
-                bust = 'busty' if hand_value > 21 else 'bustn',
-                bet = self.bets[player])
-        self.broadcast(msg)
-        if hand_value >= 21:
-            self.player_done = True
-            self.evaluate_hand(player)
-        return True
-
-    def evaluate_hand(self,player):
-        hand_value = self.hands[player].value()
-        player_id = self.clients[player].id_
-        dealer_hand = self.hands['dealer'].value()
-        self.logger.debug('player has {} dealer has {}'.format(hand_value, dealer_hand))
-
-        if hand_value > 21 or (dealer_hand <= 21 and dealer_hand > hand_value): #lose!
-            self.results[player_id] -= self.bets[player]
-            self.logger.debug('{} lost'.format(player_id))
-        elif hand_value == 21 and dealer_hand != 21:
-            self.results[player_id] += 2.5*self.bets[player]
-            #from spec: "If a player gets a blackjack (and beat the dealer) they win 1.5x their initial bet in addition to their initial bet"
-            self.logger.debug('{} won'.format(player_id))
-        elif hand_value > dealer_hand or dealer_hand > 21:
-            self.results[player_id] += 2*self.bets[player]
-            self.logger.debug('{} won'.format(player_id))
-        else:#tie
-            self.logger.debug('{} tied'.format(player_id))
-
-        if self.split_store:
-            self.player_done = False
-            self.logger.debug('player has finished the first half of a split turn.' + 
-                    'their hand WAS {}'.format(self.hands[player].cards))
-            self.hands[player].cards = [self.split_store]
-            self.split_store = False
-            self.logger.debug('now it is {}'.format(self.hands[player].cards))
-            self.action_hitt(player)
-            
-    def action_stay(self,player):
-        self.player_done = True
-        msg = '[stat|{id_}|stay|xx|bustn|{bet}]'.format(
-                id_=self.clients[player].id_,
-                bet=self.bets[player])
-        self.broadcast(msg)
-        self.evaluate_hand(player)
-        return True
-
-    def action_down(self,player):
-        if len(self.hands[player].cards) > 2 or self.split_store:
-            return self.scold(player, 'Cannot "double" after first turn.')
-        player_id = self.clients[player].id_
-        if self.accounts[player_id] < self.bets[player]:
-            return self.scold(player, "You don't have enough cash to double down")
-
-        new_card = self.deck.deal(1)[0]
-        self.hands[player].cards.append(new_card)
-        self.logger.debug('inside action_down, taking extra {}. accounts : {} -> {}'.format(
-            self.bets[player], self.accounts[player_id], self.accounts[player_id] - self.bets[player]))
-        self.accounts[player_id] -= self.bets[player]
-        self.logger.debug('doubling bet: {} -> {}'.format(
-            self.bets[player],
-            self.bets[player]*2))
-        self.bets[player] *= 2
-        msg = '[stat|{id_}|down|{card}|{bust}|{bet}]'.format(
-                id_=player_id,
-                card=new_card,
-                bust= 'busty' if self.hands[player].value() > 21 else 'bustn',
-                bet=self.bets[player])
-        self.broadcast(msg)
-        self.player_done = True
-        self.evaluate_hand(player)
-        return True
-
-    def action_split(self,player):
-        if len(self.hands[player].cards) > 2 or self.split_store:
-            return self.scold(player, 'Cannot "split" after first turn.') 
-        if self.hands[player].cards[0][0] != self.hands[player].cards[1][0]:
-            return self.scold(player, 'Card values must be equal to split.')
-
-        player_id = self.clients[player].id_
-        self.split_store = self.hands[player].cards[1]
-        new_card = self.deck.deal(1)[0]
-        self.hands[player].cards[1] = new_card
-        msg = '[stat|{id_}|splt|{card}|bustn|{bet}]'.format(
-            id_=player_id,
-            card = new_card,
-            bet = self.bets[player])
-        self.broadcast(msg)
-        return True
-
-
+                self.accept_client(client)
+        self.logger.debug('took %d connections off the accept queue in one go, %s still waiting; %d connected, %d turned away so far',
+                self.accept_batch, self.accept_queue_depth(), len(self.clients), self.turned_away)
+
+    def pause_accepting(self, error):
+        '''Out of file descriptors. The listening socket would stay readable,
+        and the loop spin on it, so stop watching it until a client leaves,
+        or for a second if none do (it may not be our clients using them).'''
+        print('could not accept a connection ({}), pausing until a client leaves'.format(error))
+        self.reactor.remove_reader(self.server)
+        self.timers.set('accept', time() + 1, self.resume_accepting)
+
+    def resume_accepting(self, key=None):
+        self.timers.cancel('accept')
+        self.reactor.add_reader(self.server, self.accept_clients)
+
+    def turn_away(self, client):
+        '''Tell a connection we have no room for so, as best we can without
+        waiting on it, and hang up.'''
+        self.turned_away += 1
+        try:
+            client.setblocking(0)
+            client.send('[errr|1|The server is full. Try again later.]')
+        except s.error:
+            pass
+        client.close()
+
+    def accept_client(self, client):
+        client.setblocking(0)
+        #we batch messages ourselves (see send), so don't let Nagle hold the batches back
+        client.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        self.clients[client] = Client(client)
+        self.unseated.add(client)
+        self.reactor.add_reader(client, lambda: self.process_messages(client))
+        if self.idle_timeout is not None:
+            self.timers.set(client, time() + self.idle_timeout, self.drop_idle)
+        self.logger.debug('accepted client with sock %s', client)
 
-    def payout(self):
-        msg = ['[endg']
-        #pay out insurance
-        for sock in self.insu:
-            if sock not in self.clients:
-                continue #if you leave, you lose
-            player_id = self.clients[sock].id_
-            #insurance is already tripled.
-            self.accounts[player_id] += self.insu[sock]
+    def drop_idle(self, sock):
+        if sock in self.clients:
+            self.scold(sock, 'You have to join or watch a table within {} seconds.'.format(self.idle_timeout), fatal=True)
 
-        for seat_num in range(1,self.MAX_PLAYERS + 1):
-            seated_player = [sock for sock,seat in self.occupied_seats.iteritems() if seat == seat_num]
-            if seated_player == []:
-                msg.append('')
-                continue
-            player = seated_player[0]
-            player_id = self.clients[player].id_
-            player_val = self.results[player_id]
-            if player_val > 0:
-                result = 'won'
-                self.accounts[player_id] += 2*self.bets[player]
-            elif player_val < 0:
-                result = 'los'
-                #we've already taken their money
-            else:
-                result = 'tie'
-                self.accounts[player_id] += self.bets[player]
-            msg.append('{id_:<12},{result},{cash:0>10}'.format(
-                id_=player_id,
-                result=result,
-                cash=self.accounts[player_id]))
-        msg[-1] += ']'
-        self.broadcast('|'.join(msg))
+    def handle_turn(self, sock, action):
+        return self.seated_at[sock].handle_turn(sock, action)
 
     def handle_insu(self, sock, amount):
-        try:
-            amount = int(amount)
-        except:
-            return self.scold(sock, "That's not a number!")
-        if amount > self.bets[sock]/2:
-            return self.scold(sock, "Amount must be an integer, no more than half your bet, and less than or equal to your cash.")
-        player_id = self.clients[sock].id_
-        if amount > self.accounts[player_id]:
-            return self.scold(sock, "You don't have enough money to buy that much insurance")
-        self.accounts[player_id] -= amount
-        if len(self.hands['dealer'].cards) == 2 and self.hands['dealer'].value() == 21:
-            #this is the amount we will pay that player in insurance
-            self.insu[sock] = 3*amount
-        else:
-            self.insu[sock] = 0
-        return True
+        return self.seated_at[sock].handle_insu(sock, amount)
 
-    def process_messages(self, sock, allowed_types):
+    def handle_ante(self, sock, amount):
+        return self.seated_at[sock].handle_ante(sock, amount)
+
+    def process_messages(self, sock):
+        table = self.seated_at.get(sock)
+        if table is not None:
+            allowed_types = table.allowed_types(sock)
+            state = table.state
+        elif self.clients[sock].watching is not None:
+            allowed_types = ['watc','exit']
+            state = 'spectating'
+        else:
+            allowed_types = ['join','chat','exit','watc','auto']
+            state = 'in the lobby'
         try:
             self.clients[sock].mbuffer.update()
             message_queue = self.clients[sock].mbuffer.messages
             while len(message_queue) > 0 and sock in self.clients:
-                m_type, mess_args = self.clients[sock].mbuffer.messages.popleft()
+                m_type, mess_args = message_queue.popleft()
                 if m_type in allowed_types:
                     try:
                         if self.m_handlers[m_type](sock, *mess_args):
@@ -536,96 +576,64 @@ class BlackjackServer(object):
                     except TypeError:
                         self.scold(sock, "Too many pipes!")
                     except Exception as e:
-                        self.logger.error('tried to process message {}|{} and hit exception:\n{}'.format(m_type, mess_args, traceback.format_exc()))
+                        self.logger.error('tried to process message %s|%s and hit exception:\n%s', m_type, mess_args, traceback.format_exc())
                 else:
-                    self.scold(sock, 'Only {} are valid commands while state is {}'.format(allowed_types, self.state) +
+                    self.scold(sock, 'Only {} are valid commands while state is {}'.format(allowed_types, state) +
                             ' You sent a "{}"'.format(m_type))
         except MessageBufferException:
             self.drop_client(sock, reason='here in process_messages. socket is closed')
         except KeyError:
             self.drop_client(sock, reason='sock was closed, but not removed from list')
+        if table is not None:
+            #whatever they sent might be what the table is waiting for
+            self.wake(table)
 
         
-    def handle_ante(self, sock, amount):
-        try:
-            amount = int(amount)
-        except ValueError:
-            return self.scold(sock, "amount must be an integer, at least {}, and less than or equal to your cash.".format(self.MIN_BET))
-        if amount < self.MIN_BET or amount > self.accounts[self.clients[sock].id_]:
-            return self.scold(sock, "amount must be an integer, at least {}, and less than or equal to your cash.".format(self.MIN_BET))
-
-        self.bets[sock] = amount
-        self.accounts[self.clients[sock].id_] -= amount
-        #take the money right away. pay up if they win.
-        return True
+    def wake(self, table):
+        '''Have table look at its game again once the current events are handled.'''
+        self.awake.add(table)
+
+    def run_tables(self):
+        while self.awake:
+            table = self.awake.pop()
+            #run the table's game up to the next thing it has to wait for
+            deadline = self.games[table].next()
+            if deadline is None:
+                self.timers.cancel(table)
+            else:
+                self.timers.set(table, deadline, self.wake)
 
     def serve(self):
+        for table in self.tables:
+            self.games[table] = table.play()
+            self.wake(table)
         while True:
-            self.wait_for_players()
-            self.game_in_progress = True
-            self.get_antes()
-            if self.game_in_progress:
-                self.deal()
-            if self.game_in_progress:
-                self.play_out_turns()
-            if self.game_in_progress:
-                self.payout()
-            if self.game_in_progress:
-                self.drop_game()
-
-    def remove_from_game(self,player):
-        self.logger.debug('moving player {} from game to lobby'.format(
-            self.clients[player].id_))
-        for d in [self.occupied_seats, self.bets, self.hands, self.insu, self.results]:
-            if player in d:
-                del d[player]
-        self.broadcast('[join|{id_}|{timeout}|{cash}|0]'.format(
-                id_=self.clients[player].id_,
-                timeout=self.timeout,
-                cash=self.accounts[self.clients[player].id_]))
+            self.timers.run()
+            self.run_tables()
+            #balances are durable before anyone hears about them. If this
+            #pass has something to tell anyone, its changes are committed
+            #now, before the flush, rather than at the next group commit;
+            #the group is then everything one pass did. Outboxes wait (see
+            #flush) for any changes still pending
+            self.ledger.commit(force=bool(self.unflushed))
+            due = self.ledger.due()
+            if due is not None:
+                self.timers.set('ledger', due, lambda key: self.ledger.commit())
+            self.flush_all()
+            self.reactor.poll(self.timers.timeout())
 
     def forgive(self, player):
         self.clients[player].strikes = 0
 
-    def drop_game(self):
-        self.game_in_progress = False
-        self.logger.info('starting a new game...')
-        self.bets = {}
-        self.hands = {}
-        self.insu = {}
-        self.results = defaultdict(lambda : 0)
-        self.split_store = False
-        players = self.occupied_seats.keys()
-        for player in players:
-            if self.accounts[self.clients[player].id_] < self.MIN_BET:
-                #this player can't afford to play, but they could still watch
-                self.remove_from_game(player)
-
-        while len(self.occupied_seats) < self.MAX_PLAYERS and len(self.lobby) > 0:
-            new_player = self.lobby.popleft()
-            if new_player in self.clients and self.accounts[self.clients[new_player].id_] < self.MIN_BET:
-                #This player can't afford to play, but they could still watch.
-                continue
-            elif new_player not in self.clients:
-                #this player has disconnected
-                continue
-            seat_num = self.empty_seat()
-            self.occupied_seats[new_player] = seat_num
-            self.broadcast('[join|{id_}|{timeout}|{cash}|{seat_num}]'.format(
-                id_=self.clients[new_player].id_,
-                timeout=self.timeout,
-                cash=self.accounts[self.clients[new_player].id_],
-                seat_num=seat_num))
-            
     def scold(self, sock, reason, fatal=False):
         try:
             self.clients[sock].strikes += 1
             msg = '[errr|{strike}|{reason}]'.format(
                 strike=self.clients[sock].strikes,
                 reason=reason.translate(escape_chars))
-            self.logger.debug('sending {} regarding {}'.format(msg, self.clients[sock].id_))
-            sock.sendall(msg)
-            if self.clients[sock].strikes >= self.MAX_STRIKES:
+            self.logger.debug('sending %s regarding %s', msg, self.clients[sock].id_)
+            self.send(sock, msg)
+            if sock in self.clients and self.clients[sock].strikes >= self.MAX_STRIKES:
                 self.drop_client(sock, reason='too many strikes')
             elif fatal:
                 self.drop_client(sock,reason='fatal error "{}"'.format(reason))
@@ -662,10 +670,105 @@ if __name__ == '__main__':
     parser.add_argument(
             '-m', '--max-connections',
             default=None,
-            help='Maximum number of TCP connections to maintain',
+            type=int,
+            help='Maximum number of TCP connections to maintain (in each worker); any more are turned away',
             metavar='num_connections',
             dest='max_tcp')
+    parser.add_argument(
+            '--listen-backlog',
+            default=128,
+            type=int,
+            help='how many connections the kernel may queue up for us to accept (capped by net.core.somaxconn)',
+            metavar='num_connections',
+            dest='listen_backlog')
+    parser.add_argument(
+            '--accept-batch',
+            default=64,
+            type=int,
+            help='the most connections to accept before giving the games a turn',
+            metavar='num_connections',
+            dest='accept_batch')
+    parser.add_argument(
+            '-n', '--tables',
+            default=1,
+            type=int,
+            help='the number of tables to run at once',
+            metavar='num_tables',
+            dest='num_tables')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help='the number of decks in each shoe',
+            metavar='num_decks',
+            dest='num_decks')
+    parser.add_argument(
+            '--penetration',
+            default=0.75,
+            type=float,
+            help='how far through the shoe to deal before shuffling; 0 shuffles every hand',
+            metavar='fraction',
+            dest='penetration')
+    parser.add_argument(
+            '-b', '--max-backlog',
+            default=65536,
+            type=int,
+            help='bytes of unread messages a client may fall behind before it is dropped',
+            metavar='num_bytes',
+            dest='max_backlog')
+    parser.add_argument(
+            '-w', '--workers',
+            default=1,
+            type=int,
+            help='the number of processes to share the port between',
+            metavar='num_workers',
+            dest='num_workers')
+    parser.add_argument(
+            '-l', '--log-level',
+            default='DEBUG',
+            choices=['DEBUG','INFO','WARNING','ERROR'],
+            help='the least important messages to write to server.log and the terminal',
+            dest='log_level')
+    parser.add_argument(
+            '-a', '--async-logging',
+            action='store_true',
+            help='write server.log and the terminal from a background thread',
+            dest='async_logging')
+    parser.add_argument(
+            '--wire-log-every',
+            default=1,
+            type=int,
+            help='log every nth recv from a client at DEBUG, 0 for none',
+            metavar='n',
+            dest='wire_log_every')
+    parser.add_argument(
+            '--spectator-interval',
+            default=0.25,
+            type=float,
+            help='seconds between the batches of news sent to spectators',
+            metavar='secs',
+            dest='spectator_interval')
+    parser.add_argument(
+            '--chat-notice-rate',
+            default=10,
+            type=float,
+            help='the most server notices per second to relay into the chat',
+            metavar='per_sec',
+            dest='chat_notice_rate')
+    parser.add_argument(
+            '--idle-timeout',
+            default=None,
+            type=float,
+            help='drop connections that have not joined or started watching after this long (default: never)',
+            metavar='secs',
+            dest='idle_timeout')
 
     args = vars(parser.parse_args())
-    BlackjackServer(**args).serve()
+    num_workers = args.pop('num_workers')
+    if num_workers > 1:
+        if not hasattr(s, 'SO_REUSEPORT'):
+            parser.error('--workers needs a platform with SO_REUSEPORT')
+        run_workers(BlackjackServer, num_workers, args)
+    else:
+        BlackjackServer(**args).serve()
         
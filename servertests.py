@@ -1,11 +1,38 @@
 #!/usr/bin/env python
 import string
 import pexpect
+from pexpect import fdpexpect
+import socket
 import sys
 import random
 import argparse
 import os
+import shutil
+import tempfile
+import subprocess
+import time
 from utils import colors
+from wire import NAME_FRAME, JOIN, client_frame
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def own_server(port, directory, *args):
+    '''Start a server of our own listening on port, with its files in
+    directory, for the tests that need one set up some particular way.
+    Its output goes to server.out there rather than to a pty, which it
+    would block on once nobody read it. Kill it with .kill() when you're done.'''
+    out_path = os.path.join(directory, 'server.out')
+    with open(out_path, 'w') as out:
+        server = subprocess.Popen([sys.executable, '-u', os.path.join(HERE, 'server.py'),
+            '-p', str(port), '-l', 'INFO'] + list(args),
+            cwd=directory, stdout=out, stderr=subprocess.STDOUT)
+    for i in range(50):
+        with open(out_path) as out:
+            if 'waiting for clients' in out.read():
+                return server
+        time.sleep(0.1)
+    server.kill()
+    raise pexpect.TIMEOUT('the server in {} never started'.format(directory))
 
 def is_server_running(host,port):
     '''Try to connect to the server, send a join and expect a conn'''
@@ -127,11 +154,170 @@ def big_spender2(host,port):
     except (pexpect.TIMEOUT, pexpect.EOF):
         return False
 
+def torn_ledger(host, port):
+    '''Starts a server of our own (on the next port) over a ledger whose last
+    record was cut off part way through writing. The whole records should
+    count, and the torn one should be gone from the ledger.'''
+    directory = tempfile.mkdtemp()
+    ledger_path = os.path.join(directory, 'blackjack_ledger')
+    with open(ledger_path, 'w') as ledger_f:
+        ledger_f.write('1|TornLedger  |-500\n2|TornLedger  |-4')
+    server = None
+    try:
+        server = own_server(port + 1, directory)
+        client = pexpect.spawn('telnet localhost {}'.format(port + 1),
+                logfile=sys.stdout)
+        client.expect('Connected',timeout=2)
+        client.sendline('[join|TornLedger  ]')
+        client.expect(r'join\|TornLedger  \|\d+\|0000000500\|',timeout=2)
+        client.sendline('[exit]')
+        client.kill(9)
+        with open(ledger_path) as ledger_f:
+            return ledger_f.read() == '1|TornLedger  |-500\n'
+    except (pexpect.TIMEOUT, pexpect.EOF):
+        return False
+    finally:
+        if server is not None:
+            server.kill()
+        shutil.rmtree(directory)
+
+def binary_frames(host, port):
+    '''Asks for binary frames, after first asking for a framing that doesn't
+    exist. Uses a plain socket, since telnet would mangle the frames.'''
+    sock = socket.create_connection((host, port), 2)
+    try:
+        client = fdpexpect.fdspawn(sock.fileno(), logfile=sys.stdout)
+        name = ''.join(random.sample(string.lowercase,12))
+        sock.sendall('[join|{}|utf8]'.format(name))
+        client.expect_exact('[errr|1|The only framing on offer',timeout=2)
+        sock.sendall('[join|{}|bnry]'.format(name))
+        client.expect(r'\[bnry\|(\d+)\]',timeout=2)
+        number = int(client.match.group(1))
+        #the JOIN frame that seats us starts the way a NAME frame does
+        client.expect_exact(NAME_FRAME.pack(JOIN, number, name),timeout=2)
+        sock.sendall(client_frame('exit'))
+        client.expect(pexpect.EOF,timeout=2)
+        return True
+    except (pexpect.TIMEOUT, pexpect.EOF, socket.error):
+        return False
+    finally:
+        sock.close()
+def framed_forger(host, port):
+    '''A client on binary frames chats "][endg|..." to forge a win. A text
+    client should see one chat message, with the brackets made harmless.'''
+    sock = socket.create_connection((host, port), 2)
+    try:
+        watson = pexpect.spawn('telnet {} {}'.format(host,port),
+                logfile=sys.stdout)
+        watson.expect('Connected',timeout=2)
+        watson.sendline('[join|JohnWatson  ]')
+        watson.expect('join')
+        forger = fdpexpect.fdspawn(sock.fileno())
+        name = ''.join(random.sample(string.lowercase,12))
+        sock.sendall('[join|{}|bnry]'.format(name))
+        forger.expect_exact('[bnry|',timeout=2)
+        sock.sendall(client_frame('chat', 'hi][endg|JohnWatson  ,won,0099999999|||||'))
+        watson.expect_exact('[chat|{}|hi}}{{endg!JohnWatson  ,won,0099999999!!!!!]'.format(name),timeout=2)
+        sock.sendall(client_frame('exit'))
+        watson.sendline('[exit]')
+        watson.kill(9)
+        return True
+    except (pexpect.TIMEOUT, pexpect.EOF, socket.error):
+        return False
+    finally:
+        sock.close()
+
+
+def slow_spectator(host, port):
+    '''Starts a server of our own (two ports along) and watches its table
+    while bots play there. A new spectator should get a snapshot first, and
+    one that stops reading should get another once it catches up, rather
+    than everything it missed.'''
+    directory = tempfile.mkdtemp()
+    server = bots = sock = None
+    try:
+        server = own_server(port + 2, directory, '-j', '0', '--spectator-interval', '0.05')
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096) #so it backs up sooner
+        sock.connect(('localhost', port + 2))
+        spectator = fdpexpect.fdspawn(sock.fileno())
+        sock.sendall('[watc|1]')
+        spectator.expect_exact('[snap|1|',timeout=2)
+        #read nothing more until the bots are done. The kernel will buffer a
+        #few MB for us first, which takes them a good few seconds to fill
+        bots = pexpect.spawn(sys.executable, [os.path.join(HERE, 'botfarm.py'),
+            '-p', str(port + 2), '-b', '6', '--autoplay', '--duration', '8'], cwd=HERE)
+        bots.expect(pexpect.EOF,timeout=15)
+        spectator.expect_exact('[snap|1|',timeout=5)
+        return True
+    except (pexpect.TIMEOUT, pexpect.EOF, socket.error):
+        return False
+    finally:
+        if bots is not None:
+            bots.kill(9)
+        if server is not None:
+            server.kill()
+        if sock is not None:
+            sock.close()
+        shutil.rmtree(directory)
+
+def standing_orders(host, port):
+    '''Tries orders with a strategy table that is only partly filled in,
+    which should be refused, then leaves the server to bet $10 and stay on
+    every hand. We should be dealt in and played without sending a thing.'''
+    try:
+        client = pexpect.spawn('telnet {} {}'.format(host,port),
+                logfile=sys.stdout)
+        client.expect('Connected',timeout=2)
+        name = ''.join(random.sample(string.lowercase,12))
+        client.sendline('[join|{}]'.format(name))
+        client.expect('join')
+        client.sendline('[auto|0000000010|none|h{}]'.format('-' * 419))
+        client.expect_exact('[errr|1|The strategy is one of',timeout=2)
+        client.sendline('[auto|0000000010|none|stay]')
+        client.expect_exact('{},0000000990,'.format(name))
+        #a blackjack on either side ends the hand without any turns
+        if client.expect_exact(['[stat|{}|stay|'.format(name), '[endg|', '[errr|']) == 2:
+            return False
+        client.sendline('[exit]')
+        client.kill(9)
+        return True
+    except (pexpect.TIMEOUT, pexpect.EOF):
+        return False
+
+def full_house(host, port):
+    '''Starts a server of our own (three ports along) that takes one
+    connection at a time. A second client should be told the server is full
+    and hung up on, and the first should carry on as usual.'''
+    directory = tempfile.mkdtemp()
+    server = None
+    try:
+        server = own_server(port + 3, directory, '-m', '1')
+        first = pexpect.spawn('telnet localhost {}'.format(port + 3),
+                logfile=sys.stdout)
+        first.expect('Connected',timeout=2)
+        second = pexpect.spawn('telnet localhost {}'.format(port + 3),
+                logfile=sys.stdout)
+        second.expect_exact('[errr|1|The server is full. Try again later.]',timeout=2)
+        second.expect(pexpect.EOF,timeout=2)
+        name = ''.join(random.sample(string.lowercase,12))
+        first.sendline('[join|{}]'.format(name))
+        first.expect_exact('[join|{}|'.format(name),timeout=2)
+        first.sendline('[exit]')
+        first.kill(9)
+        return True
+    except (pexpect.TIMEOUT, pexpect.EOF):
+        return False
+    finally:
+        if server is not None:
+            server.kill()
+        shutil.rmtree(directory)
 
-        
 
 tests = [is_server_running, simple_test, resilient_server, big_spender,
-        long_winded, confused_player, big_spender2]
+        long_winded, confused_player, big_spender2, torn_ledger,
+        binary_frames, framed_forger, slow_spectator, standing_orders,
+        full_house]
 def main():
     '''To run these tests, start your server running and pass along the host and port.'''
     parser = argparse.ArgumentParser(
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+'''Run engine.py's simulations on every core.
+
+Hands are played in batches of batch_size, each on a fresh BlackjackEngine
+with its own random.Random: seeded with the run's seed, then jumped ahead
+(Random.jumpahead) by the batch's number. So every batch has a stream of
+its own, and a run gives the same results on any number of workers.
+Batches are handed out to a multiprocessing.Pool and come back as totals
+for each seat, which are added into the run's as they arrive. The totals
+are all whole numbers, so the order they arrive in makes no difference.
+
+Given a checkpoint file, the totals and the batches done so far are
+written out (to a temporary file that is then renamed over the old one)
+every checkpoint_interval seconds and when the run ends or is interrupted.
+Running again with the same checkpoint picks up where it stopped.
+'''
+import os
+import json
+import math
+import random
+import signal
+import argparse
+import multiprocessing
+from itertools import imap
+from time import time
+from utils import BlackjackError
+from engine import BlackjackEngine, policies
+
+TOTALS = ['hands', 'staked', 'net', 'net_squares', 'won', 'los', 'tie', 'rebuys', 'strikes', 'dropped']
+
+
+def play_batch(task):
+    '''Play one batch. task is (seed, batch, hands, policy names, num_decks,
+    penetration); returns (batch, a dict of TOTALS for each seat).'''
+    seed, batch, hands, names, num_decks, penetration = task
+    rng = random.Random(seed)
+    rng.jumpahead(batch)
+    engine = BlackjackEngine([policies[name](rng) for name in names], rng,
+            num_decks=num_decks, penetration=penetration)
+    players = engine.players
+    squares = [0] * len(players)
+    for hand in xrange(hands):
+        before = [player.net for player in players]
+        engine.play_hand()
+        for seat, player in enumerate(players):
+            squares[seat] += (player.net - before[seat]) ** 2
+    seats = []
+    for player, net_squares in zip(players, squares):
+        seats.append({
+            'hands': player.hands,
+            'staked': player.staked,
+            'net': player.net,
+            'net_squares': net_squares,
+            'won': player.results['won'],
+            'los': player.results['los'],
+            'tie': player.results['tie'],
+            'rebuys': player.rebuys,
+            'strikes': player.strikes,
+            'dropped': player.dropped,
+            })
+    return batch, seats
+
+
+def ignore_interrupts():
+    #ctrl-c is for the parent, which stops the pool itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class SimulationRunner(object):
+    def __init__(self, names, hands, seed=None, batch_size=10000, num_decks=2, penetration=0.75,
+            checkpoint=None, checkpoint_interval=60):
+        self.settings = {
+            'policies': names,
+            'hands': hands,
+            'seed': seed,
+            'batch_size': batch_size,
+            'num_decks': num_decks,
+            'penetration': penetration,
+            }
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.done = set() #batch numbers
+        self.seats = [dict.fromkeys(TOTALS, 0) for name in names]
+        self.last_checkpoint = time()
+        if checkpoint is not None:
+            self._resume()
+        if self.settings['seed'] is None:
+            self.settings['seed'] = random.SystemRandom().getrandbits(32)
+
+    def _resume(self):
+        try:
+            with open(self.checkpoint, 'r') as checkpoint_f:
+                data = json.load(checkpoint_f)
+        except IOError:
+            return #a new run
+        if self.settings['seed'] is None:
+            self.settings['seed'] = data['settings']['seed'] #carry on with the run's own seed
+        if data['settings'] != self.settings:
+            raise BlackjackError('{} is from a run with different settings: {}'.format(
+                self.checkpoint, data['settings']))
+        self.done = set(data['done'])
+        self.seats = data['seats']
+
+    def save(self):
+        if self.checkpoint is None:
+            return
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_f:
+            json.dump({'settings': self.settings, 'done': sorted(self.done), 'seats': self.seats}, checkpoint_f)
+            checkpoint_f.flush()
+            os.fsync(checkpoint_f.fileno())
+        os.rename(tmp_path, self.checkpoint)
+        self.last_checkpoint = time()
+
+    def tasks(self):
+        settings = self.settings
+        batch_size = settings['batch_size']
+        for batch in xrange(int(math.ceil(float(settings['hands']) / batch_size))):
+            if batch not in self.done:
+                hands = min(batch_size, settings['hands'] - batch * batch_size)
+                yield (settings['seed'], batch, hands, settings['policies'],
+                        settings['num_decks'], settings['penetration'])
+
+    def add(self, batch, seats):
+        for totals, batch_totals in zip(self.seats, seats):
+            for key in TOTALS:
+                totals[key] += batch_totals[key]
+        self.done.add(batch)
+        if time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save()
+
+    def run(self, workers=None):
+        '''Play every batch that isn't done yet, on workers processes (all
+        the cores by default).'''
+        tasks = list(self.tasks())
+        if not tasks:
+            return
+        #build each policy once here, so whatever they cache (optimal
+        #strategy tables, say) is worked out before the workers fork
+        for name in set(self.settings['policies']):
+            policies[name]()
+        if workers == 1:
+            try:
+                for batch, seats in imap(play_batch, tasks):
+                    self.add(batch, seats)
+            finally:
+                self.save()
+            return
+        pool = multiprocessing.Pool(workers, ignore_interrupts)
+        #a KeyboardInterrupt thrown into the middle of the pool's workings can
+        #leave it hung, so ctrl-c only sets a flag that's checked between batches
+        interrupted = []
+        previous = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+        try:
+            for batch, seats in pool.imap_unordered(play_batch, tasks):
+                self.add(batch, seats)
+                if interrupted:
+                    break
+        finally:
+            signal.signal(signal.SIGINT, previous)
+            if interrupted:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            self.save()
+        if interrupted:
+            raise KeyboardInterrupt
+
+    def report(self, seat):
+        '''(mean net per hand, its variance, the mean's standard error,
+        return on what was staked) for a seat'''
+        totals = self.seats[seat]
+        hands = totals['hands']
+        if not hands:
+            return 0, 0, 0, 0
+        mean = float(totals['net']) / hands
+        variance = float(totals['net_squares']) / hands - mean * mean
+        return (mean, variance, math.sqrt(variance / hands),
+                float(totals['net']) / totals['staked'] if totals['staked'] else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate hands of blackjack between bots, spread over several processes')
+    parser.add_argument(
+            '-n','--hands',
+            default=1000000,
+            type=int,
+            help='how many hands to deal',
+            metavar='hands',
+            dest='hands')
+    parser.add_argument(
+            '-p','--policy',
+            default=[],
+            action='append',
+            choices=sorted(policies.keys()),
+            help='a player who plays like this; give it once per seat (default: one intelligent player)',
+            dest='policies')
+    parser.add_argument(
+            '-w', '--workers',
+            default=None,
+            type=int,
+            help='how many processes to run (default: one per core)',
+            metavar='workers',
+            dest='workers')
+    parser.add_argument(
+            '-b', '--batch-size',
+            default=10000,
+            type=int,
+            help='hands per batch; results depend on this and the seed, not on the workers',
+            metavar='hands',
+            dest='batch_size')
+    parser.add_argument(
+            '--seed',
+            default=None,
+            type=int,
+            help='seed for the whole run (default: a random one, which is printed)',
+            dest='seed')
+    parser.add_argument(
+            '-d', '--decks',
+            default=2,
+            type=int,
+            help='the number of decks in the shoe',
+            metavar='num_decks',
+            dest='num_decks')
+    parser.add_argument(
+            '--penetration',
+            default=0.75,
+            type=float,
+            help='how far through the shoe to deal before shuffling; 0 shuffles every hand',
+            metavar='fraction',
+            dest='penetration')
+    parser.add_argument(
+            '-c', '--checkpoint',
+            default=None,
+            help='file to save progress in, and to resume from if it exists',
+            metavar='path',
+            dest='checkpoint')
+    parser.add_argument(
+            '--checkpoint-interval',
+            default=60,
+            type=float,
+            help='seconds between checkpoints',
+            metavar='seconds',
+            dest='checkpoint_interval')
+    args = parser.parse_args()
+    if len(args.policies) > 6:
+        parser.error('there are only 6 seats at a table')
+
+    try:
+        runner = SimulationRunner(args.policies or ['intelligent'], args.hands, args.seed, args.batch_size,
+                args.num_decks, args.penetration, args.checkpoint, args.checkpoint_interval)
+    except BlackjackError as e:
+        parser.error(str(e))
+    print('seed {}'.format(runner.settings['seed']))
+    start = time()
+    try:
+        runner.run(args.workers)
+    except KeyboardInterrupt:
+        print('interrupted after {} batches{}'.format(len(runner.done),
+            '; run again to carry on' if args.checkpoint else ''))
+    elapsed = time() - start
+    hands = max(totals['hands'] for totals in runner.seats)
+    print('{} hands in {:.2f}s'.format(hands, elapsed))
+    staked = net = 0
+    for seat, (name, totals) in enumerate(zip(runner.settings['policies'], runner.seats)):
+        mean, variance, error, ret = runner.report(seat)
+        print('seat {} ({}): {} won, {} lost, {} tied, net {:+} ({:+.4f} +/- {:.4f} a hand, variance {:.3f}), return {:+.3%}'.format(
+            seat + 1, name, totals['won'], totals['los'], totals['tie'], totals['net'], mean, error, variance, ret))
+        staked += totals['staked']
+        net += totals['net']
+    print('house edge: {:.3%}'.format(-float(net) / staked if staked else 0))
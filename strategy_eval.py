@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+'''Monte Carlo expected values for IntelligentUI-style strategy tables.
+
+Plays a large batch of hands at once with NumPy: a freshly shuffled
+two-deck shoe for every hand (the server with --penetration 0), the
+dealer's hands drawn out together, and then each round of decisions
+looked up for every hand still playing. The rules and the order of the
+cards match the server (see engine.py), and one player sits at the table. They bet one unit, never buy insurance, and settle the
+way the server does.
+
+Every hand's result counts towards each table cell it looked up. A cell
+is one (table, row, dealer card) entry, such as general 16 vs T. The
+report gives EV and standard error per unit bet, for the whole strategy,
+for each of its three tables, and for each cell.
+
+Strategies can be given as 'strategy' (strategy.py, the default),
+'IntelligentUI' (the tables inside that class), or the name of any module
+with split_strategies, ace_present_strategies and general_strategies.
+Every strategy in one run is played on the same shoes, so the difference
+between two of them is far less noisy than either EV alone.
+
+NumPy is only needed here, not by the game.
+'''
+import sys
+import json
+import argparse
+import importlib
+from time import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HITT, STAY, DOWN, SPLT = range(4)
+ACTIONS = ['hitt', 'stay', 'down', 'splt']
+TABLES = ['split', 'ace_present', 'general', 'none'] #'none' is when no table had the hand
+RANK_CHARS = ' 123456789TJQK' #a card's first character, by rank
+DEALER_CHARS = ' 123456789T' #IntelligentUI counts J, Q and K as T
+ROWS = 32 #enough for any hard total or card sum we can look up
+SHOE = [rank for rank in range(1, 14) for copy in range(4 * 2)] #two decks
+
+
+def load_strategy(name):
+    '''The three tables of the named strategy.'''
+    if name == 'IntelligentUI':
+        from client_ui import IntelligentUI as source
+    else:
+        source = importlib.import_module(name)
+    return (source.split_strategies, source.ace_present_strategies, source.general_strategies)
+
+
+class CompiledStrategy(object):
+    '''A strategy's dicts turned into arrays of action codes, so a whole
+    batch of hands can be looked up at once. -1 marks rows the dicts don't
+    have.'''
+
+    def __init__(self, name):
+        self.name = name
+        tables = load_strategy(name)
+        self.keys = [] #per table, how the dicts name each row index
+        self.actions = np.full((3, ROWS, 11), -1, dtype=np.int8)
+        for table, strategies in enumerate(tables):
+            keys = {}
+            for key, by_dealer in strategies.items():
+                row = RANK_CHARS.index(key) if table == 0 else key
+                keys[row] = key
+                for dealer in range(1, 11):
+                    self.actions[table, row, dealer] = ACTIONS.index(by_dealer[DEALER_CHARS[dealer]])
+            self.keys.append(keys)
+
+    def cell_name(self, cell):
+        table, row, dealer = np.unravel_index(cell, (len(TABLES), ROWS, 11))
+        if TABLES[table] == 'none':
+            return 'none {} vs {}'.format(row, DEALER_CHARS[dealer])
+        return '{} {} vs {}'.format(TABLES[table], self.keys[table][row], DEALER_CHARS[dealer])
+
+
+def card_values(ranks):
+    return np.minimum(ranks, 10)
+
+def hand_value(hard, aces):
+    return np.where((aces > 0) & (hard + 10 <= 21), hard + 10, hard)
+
+def score(player, dealer, bet):
+    '''utils.score, for arrays.'''
+    return np.where((player > 21) | ((dealer <= 21) & (dealer > player)), -bet,
+            np.where((player == 21) & (dealer != 21), 2.5 * bet,
+                np.where((player > dealer) | (dealer > 21), 2 * bet, 0)))
+
+
+def play_batch(strategies, num_hands, rng):
+    '''Deal num_hands shoes and play them out with every strategy. Yields
+    (net per hand, cells looked up per round) for each strategy, where a
+    cell of -1 means that hand had already finished.'''
+    shoe = np.array(SHOE, dtype=np.int8)
+    cards = shoe[rng.rand(num_hands, len(SHOE)).argsort(axis=1)]
+    hands = np.arange(num_hands)
+
+    #the dealer's hand, all drawn before anyone plays
+    up = card_values(cards[:, 0])
+    d_hard = up + card_values(cards[:, 1])
+    d_aces = (cards[:, 0] == 1).astype(np.int8) + (cards[:, 1] == 1)
+    dealer_blackjack = (up == 1) & (hand_value(d_hard, d_aces) == 21)
+    next_card = np.full(num_hands, 4)
+    while True:
+        value = hand_value(d_hard, d_aces)
+        hitting = (value <= 16) | ((d_aces > 0) & (value <= 17))
+        if not hitting.any():
+            break
+        drawn = cards[hands[hitting], next_card[hitting]]
+        d_hard[hitting] += card_values(drawn)
+        d_aces[hitting] += drawn == 1
+        next_card[hitting] += 1
+    dealer = hand_value(d_hard, d_aces)
+    dealt = next_card
+
+    for strategy in strategies:
+        next_card = dealt.copy()
+        first = cards[:, 2].astype(np.int16)
+        second = cards[:, 3].astype(np.int16)
+        hard = card_values(first) + card_values(second)
+        aces = (first == 1).astype(np.int16) + (second == 1)
+        num_cards = np.full(num_hands, 2)
+        first_turn = np.ones(num_hands, dtype=bool)
+        split_store = np.zeros(num_hands, dtype=np.int16) #the rank saved for the second half
+        bet = np.ones(num_hands)
+        result = np.zeros(num_hands)
+        forfeit = np.zeros(num_hands, dtype=bool)
+        playing = ~dealer_blackjack
+        result[dealer_blackjack] = score(hand_value(hard, aces), 21, 1)[dealer_blackjack]
+        rounds = []
+        while playing.any():
+            action, cell = decide(strategy, playing, first, second, hard, aces, up, first_turn)
+            rounds.append(cell)
+            #the server refuses these; the bot asks again and strikes out
+            refused = playing & (
+                    ((action == SPLT) & ~(first_turn & (first == second))) |
+                    ((action == DOWN) & ((num_cards > 2) | (split_store > 0))))
+            forfeit |= refused
+            playing &= ~refused
+            first_turn[:] = False
+
+            draws = playing & ((action == HITT) | (action == DOWN) | (action == SPLT))
+            drawn = cards[hands[draws], next_card[draws]].astype(np.int16)
+            next_card[draws] += 1
+            splitting = playing & (action == SPLT)
+            split_store[splitting] = second[splitting]
+            hard[splitting] -= card_values(second[splitting])
+            aces[splitting] -= second[splitting] == 1
+            num_cards[draws & ~splitting] += 1
+            bet[playing & (action == DOWN)] = 2
+            hard[draws] += card_values(drawn)
+            aces[draws] += drawn == 1
+            second[draws] = drawn
+
+            value = hand_value(hard, aces)
+            done = playing & ((action == STAY) | (action == DOWN) | ((action == HITT) & (value >= 21)))
+            result[done] += score(value, dealer, bet)[done]
+            #the second half of a split starts with the saved card and a hit
+            halves = done & (split_store > 0)
+            drawn = cards[hands[halves], next_card[halves]].astype(np.int16)
+            next_card[halves] += 1
+            first[halves] = split_store[halves]
+            second[halves] = drawn
+            hard[halves] = card_values(first[halves]) + card_values(drawn)
+            aces[halves] = (first[halves] == 1).astype(np.int16) + (drawn == 1)
+            num_cards[halves] = 2
+            split_store[halves] = 0
+            value = hand_value(hard, aces)
+            blackjack_half = halves & (value >= 21)
+            result[blackjack_half] += score(value, dealer, bet)[blackjack_half]
+            playing &= ~done | (halves & ~blackjack_half)
+
+        net = np.sign(result) * bet
+        net[forfeit] = -bet[forfeit]
+        yield net, rounds
+
+
+def decide(strategy, playing, first, second, hard, aces, up, first_turn):
+    '''IntelligentUI.strategy for a batch of hands: the action each hand
+    takes and the cell it came from (-1 for hands that aren't playing).'''
+    actions = strategy.actions
+    dealer = up.astype(np.intp)
+    value = hand_value(hard, aces)
+    action = np.full(len(playing), STAY, dtype=np.int8)
+    table = np.full(len(playing), 3, dtype=np.intp)
+    row = np.minimum(value, ROWS - 1).astype(np.intp)
+    undecided = playing.copy()
+
+    pairs = undecided & first_turn & (first == second)
+    looked_up = actions[0, first, dealer]
+    use = pairs & (looked_up >= 0)
+    action[use] = looked_up[use]
+    table[use] = 0
+    row[use] = first[use]
+    undecided &= ~use
+
+    #every ace is left out of 'other cards', however many there are
+    other = np.minimum(hard - aces, ROWS - 1).astype(np.intp)
+    looked_up = actions[1, other, dealer]
+    use = undecided & (aces > 0) & (looked_up >= 0)
+    late_double = use & ~first_turn & (looked_up == DOWN)
+    action[use] = looked_up[use]
+    action[late_double] = np.where(other[late_double] >= 7, STAY, HITT)
+    table[use] = 1
+    row[use] = other[use]
+    undecided &= ~use
+
+    looked_up = actions[2, np.minimum(value, ROWS - 1), dealer]
+    use = undecided & (looked_up >= 0)
+    action[use] = looked_up[use]
+    action[use & ~first_turn & (looked_up == DOWN)] = HITT
+    table[use] = 2
+    #anything left is a hand IntelligentUI doesn't know, and it stays
+
+    cell = np.ravel_multi_index((table, row, dealer), (len(TABLES), ROWS, 11))
+    cell[~playing] = -1
+    return action, cell
+
+
+class Tally(object):
+    '''Running sums for the EV and standard error of a strategy and its cells.'''
+    def __init__(self, strategy):
+        self.strategy = strategy
+        size = len(TABLES) * ROWS * 11
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.cell_n = np.zeros(size)
+        self.cell_total = np.zeros(size)
+        self.cell_sq = np.zeros(size)
+
+    def add(self, net, rounds):
+        self.n += len(net)
+        self.total += net.sum()
+        self.total_sq += (net * net).sum()
+        size = len(self.cell_n)
+        for cell in rounds:
+            seen = cell >= 0
+            self.cell_n += np.bincount(cell[seen], minlength=size)
+            self.cell_total += np.bincount(cell[seen], weights=net[seen], minlength=size)
+            self.cell_sq += np.bincount(cell[seen], weights=net[seen] ** 2, minlength=size)
+
+    def report(self):
+        tables = {}
+        for table, name in enumerate(TABLES):
+            cells = slice(table * ROWS * 11, (table + 1) * ROWS * 11)
+            tables[name] = ev(self.cell_n[cells].sum(), self.cell_total[cells].sum(), self.cell_sq[cells].sum())
+        cells = {}
+        for cell in np.flatnonzero(self.cell_n):
+            cells[self.strategy.cell_name(cell)] = ev(self.cell_n[cell], self.cell_total[cell], self.cell_sq[cell])
+        return {'ev': ev(self.n, self.total, self.total_sq), 'tables': tables, 'cells': cells}
+
+
+def ev(n, total, total_sq):
+    '''Mean and standard error of n results, given their sum and sum of squares.'''
+    if not n:
+        return {'n': 0, 'ev': None, 'se': None}
+    mean = total / n
+    var = max(total_sq / n - mean * mean, 0) * n / max(n - 1, 1)
+    return {'n': int(n), 'ev': mean, 'se': (var / n) ** 0.5}
+
+
+def evaluate(names, num_hands, seed=None, batch=100000):
+    rng = np.random.RandomState(seed)
+    strategies = [CompiledStrategy(name) for name in names]
+    tallies = [Tally(strategy) for strategy in strategies]
+    left = num_hands
+    while left > 0:
+        for tally, (net, rounds) in zip(tallies, play_batch(strategies, min(batch, left), rng)):
+            tally.add(net, rounds)
+        left -= batch
+    return dict((tally.strategy.name, tally.report()) for tally in tallies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Estimate the EV of strategy tables by simulating hands')
+    parser.add_argument(
+            '-s','--strategy',
+            default=[],
+            action='append',
+            help='strategy to evaluate: strategy, IntelligentUI, or a module name. Give it more than once to compare',
+            metavar='strategy',
+            dest='strategies')
+    parser.add_argument(
+            '-n','--hands',
+            default=1000000,
+            type=int,
+            help='how many hands to play with each strategy',
+            metavar='hands',
+            dest='hands')
+    parser.add_argument(
+            '--seed',
+            default=None,
+            type=int,
+            help='seed for the shoes',
+            dest='seed')
+    parser.add_argument(
+            '-c','--cells',
+            action='store_true',
+            help='list every cell, not just the totals',
+            dest='cells')
+    parser.add_argument(
+            '--json',
+            action='store_true',
+            help='print the whole report as json',
+            dest='json')
+    args = parser.parse_args()
+    if np is None:
+        sys.exit('strategy_eval.py needs numpy')
+
+    start = time()
+    reports = evaluate(args.strategies or ['strategy'], args.hands, args.seed)
+    if args.json:
+        print(json.dumps(reports, indent=2, sort_keys=True))
+        sys.exit(0)
+    line = '{:<24} {:>9} {:>+8.4f} +/- {:.4f}'
+    for name, report in sorted(reports.items()):
+        print(line.format(name, report['ev']['n'], report['ev']['ev'], report['ev']['se']))
+        for table in TABLES:
+            if report['tables'][table]['n']:
+                print(line.format('  ' + table, report['tables'][table]['n'],
+                    report['tables'][table]['ev'], report['tables'][table]['se']))
+        if args.cells:
+            for cell, stats in sorted(report['cells'].items()):
+                print(line.format('    ' + cell, stats['n'], stats['ev'], stats['se']))
+    print('{} hands per strategy in {:.1f}s'.format(args.hands, time() - start))
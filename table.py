@@ -0,0 +1,501 @@
+from utils import BlackjackShoe, BlackjackHand, CARD_NAMES, ACE, card_rank, dealer_hits, score, settle
+from collections import defaultdict
+from time import time
+import heapq
+import logging
+
+
+class BlackjackTable(object):
+    '''One table of a BlackjackServer. The server owns the sockets, the lobby
+    and the accounts; the table owns its shoe, seats, bets and hands.
+
+    play() is a generator that runs games forever. Whenever the table has to
+    wait on its players it yields the deadline it is waiting for (or None if
+    it can wait forever). The server resumes it when one of its players sends
+    something, somebody sits down or leaves, or the deadline passes, so one
+    event loop can drive any number of tables.'''
+
+    def __init__(self, server, number):
+        self.server = server
+        self.number = number
+        self.MAX_PLAYERS = server.MAX_PLAYERS
+        self.MIN_BET = server.MIN_BET
+        self.timeout = server.timeout
+        self.join_wait = server.join_wait
+
+        self.logger = logging.getLogger('blackjack.table')
+
+        self.bets = {} #sock:ante pairs. These are updated for a split or down
+        self.occupied_seats = {} #sock:seat_number pairs; the current players
+        self.seats = [None] * (self.MAX_PLAYERS + 1) #seat_number:sock, or None if the seat is free. seat 0 is the lobby
+        self.free_seats = range(1, self.MAX_PLAYERS + 1) #a heap, lowest free seat first
+        self.hands = {} #sock:BlackjackHand pairs, plus one 'dealer':BlackjackHand
+        self.insu = defaultdict(lambda: 0) #The amount of insurance we owe everyone.
+        self.results = defaultdict(lambda : 0) #a dollar score for each player.
+        #positive is a win, negative a tie
+        self.shoe = BlackjackShoe(server.num_decks, server.penetration)
+        self.state='waiting to start game'
+        self.game_in_progress = False
+        self.split_store = None #the card for the second half of a split
+        self.current_player = None #the sock whose turn it is
+        self.listed = False #whether we are in the server's open_tables heap
+        self.dealer_shown = 0 #how many of the dealer's cards everyone has seen
+        self.spectators = set() #socks watching this table, see BlackjackServer.fan_out
+        self.changes = [] #what we've broadcast since the last batch went out to them
+
+    def __repr__(self):
+        return 'table {}'.format(self.number)
+
+    def broadcast(self, msg):
+        self.server.broadcast(msg, table=self)
+
+    def id_of(self, sock):
+        return self.server.clients[sock].id_
+
+    def snapshot(self):
+        '''[snap|table|state|whose turn|dealer's cards|seat 1|...|seat 6], with
+        a seat either empty or id,cash,bet,cards, and cards as their names
+        separated by spaces: all a spectator needs to follow along from here.'''
+        accounts = self.server.accounts
+        dealer = self.hands.get('dealer')
+        msg = ['[snap', str(self.number), self.state,
+                self.id_of(self.current_player) if self.current_player is not None else '',
+                ' '.join(dealer.names()[:self.dealer_shown]) if dealer is not None else '']
+        for player in self.seats[1:]:
+            if player is None:
+                msg.append('')
+            else:
+                player_id = self.id_of(player)
+                hand = self.hands.get(player)
+                msg.append('{id_:<12},{cash:0>10},{bet:0>10},{cards}'.format(
+                    id_=player_id,
+                    cash=accounts[player_id],
+                    bet=self.bets.get(player, 0),
+                    cards=' '.join(hand.names()) if hand is not None else ''))
+        return '|'.join(msg) + ']'
+
+    def has_free_seat(self):
+        return len(self.occupied_seats) < self.MAX_PLAYERS
+
+    def players(self):
+        '''The socks at this table, in seat order.'''
+        return [sock for sock in self.seats if sock is not None]
+
+    def seat(self, sock):
+        seat_num = heapq.heappop(self.free_seats)
+        self.occupied_seats[sock] = seat_num
+        self.seats[seat_num] = sock
+        self.server.seated_at[sock] = self
+        self.server.unseated.discard(sock)
+        self.server.wake(self)
+        self.broadcast('[join|{id_}|{timeout}|{cash:0>10}|{seat_num}]'.format(
+            id_=self.id_of(sock),
+            timeout=self.timeout,
+            cash=self.server.accounts[self.id_of(sock)],
+            seat_num=seat_num))
+
+    def drop_player(self, sock):
+        '''Forget about a player who has left the server. Their bet stays with the house.'''
+        for d in [self.insu, self.bets]:
+            if sock in d:
+                del d[sock]
+        self.leave_seat(sock)
+
+    def leave_seat(self, sock):
+        if sock in self.occupied_seats:
+            seat_num = self.occupied_seats.pop(sock)
+            self.seats[seat_num] = None
+            heapq.heappush(self.free_seats, seat_num)
+            self.server.table_opened(self)
+
+    def orders_of(self, sock):
+        '''The StandingOrders of a player who sent an [auto], or None.'''
+        return self.server.clients[sock].orders
+
+    def allowed_types(self, sock):
+        allowed = ['chat','exit','auto']
+        if self.orders_of(sock) is not None:
+            pass #we make their moves for them
+        elif self.state == 'waiting for antes':
+            allowed.append('ante')
+        elif self.state == 'waiting for insurance':
+            allowed.append('insu')
+        elif self.state == 'waiting for turns' and sock == self.current_player:
+            allowed.append('turn')
+        return allowed
+
+    def play(self):
+        while True:
+            for deadline in self.wait_for_players():
+                yield deadline
+            self.game_in_progress = True
+            for deadline in self.get_antes():
+                yield deadline
+            if self.game_in_progress:
+                for deadline in self.deal():
+                    yield deadline
+            if self.game_in_progress:
+                for deadline in self.play_out_turns():
+                    yield deadline
+            if self.game_in_progress:
+                self.payout()
+            if self.game_in_progress:
+                self.drop_game()
+            #give the other tables a turn between hands
+            yield time()
+
+    def wait_for_players(self):
+        self.state = 'waiting to start game'
+        if not self.occupied_seats:
+            self.logger.info('%s: waiting for clients to join...', self)
+        while not self.occupied_seats:
+            yield None
+        self.logger.debug('%s: waiting for more players...', self)
+        deadline = time() + self.join_wait
+        while time() < deadline and self.occupied_seats and len(self.occupied_seats) < self.MAX_PLAYERS:
+            yield deadline
+
+    def get_antes(self):
+        if not self.occupied_seats:
+            self.drop_game()
+            return
+        self.state = 'waiting for antes'
+        self.logger.debug('%s state is %s', self, self.state)
+        self.broadcast('[ante|{:0>10}]'.format(self.MIN_BET))
+        deadline = time() + self.timeout
+        self.standing_antes()
+        while time() < deadline and len(self.bets) < len(self.occupied_seats):
+            yield deadline
+            self.standing_antes() #for anyone who sent an [auto] since
+        for no_ante_player in (set(self.occupied_seats.keys()) - set(self.bets.keys())):
+            self.server.drop_client(no_ante_player, reason='failed to send an ante')
+
+    def deal(self):
+        if not self.occupied_seats:
+            self.drop_game()
+            return
+        shuf = self.shoe.start_hand()
+
+        self.hands['dealer'] = BlackjackHand(self.shoe.deal(2))
+        self.dealer_shown = 1
+        msg = ['[deal']
+        msg.append(CARD_NAMES[self.hands['dealer'].cards[0]]) # only reveal one dealer card
+        msg.append('shufy' if shuf else 'shufn')
+
+        for player in self.seats[1:]:
+            if player is None:
+                msg.append('')
+            else:
+                self.hands[player] = BlackjackHand(self.shoe.deal(2))
+                player_id = self.id_of(player)
+                msg.append('{id_:<12},{cash:0>10},{cards[0]},{cards[1]}'.format(
+                    id_=player_id,
+                    cash=self.server.accounts[player_id],
+                    cards=self.hands[player].names()))
+        msg[-1] += ']' #closing brace to message
+        self.broadcast('|'.join(msg))
+        if card_rank(self.hands['dealer'].cards[0]) == ACE: #dealer has ace showing
+            for deadline in self.wait_for_insurance():
+                yield deadline
+            if self.hands['dealer'].value() == 21:
+                #game can end now
+                for player in self.occupied_seats:
+                    self.evaluate_hand(player)
+                self.payout()
+                self.drop_game()
+
+    def wait_for_insurance(self):
+        self.state='waiting for insurance'
+        self.logger.debug('%s state is %s', self, self.state)
+        deadline = time() + self.timeout
+        self.standing_insurance()
+        while time() < deadline and len(self.insu) < len(self.occupied_seats):
+            yield deadline
+            self.standing_insurance()
+
+    def standing_antes(self):
+        accounts = self.server.accounts
+        for player in self.players():
+            orders = self.orders_of(player)
+            if orders is not None and player not in self.bets:
+                if self.handle_ante(player, orders.ante(self.MIN_BET, accounts[self.id_of(player)])):
+                    self.server.forgive(player)
+
+    def standing_insurance(self):
+        accounts = self.server.accounts
+        for player in self.players():
+            orders = self.orders_of(player)
+            if orders is not None and player in self.bets and player not in self.insu:
+                if self.handle_insu(player, orders.insurance(self.bets[player], accounts[self.id_of(player)])):
+                    self.server.forgive(player)
+
+    def play_out_turns(self):
+        if not self.occupied_seats:
+            self.drop_game()
+            return
+        dealer_moves = self.play_dealer_turn() #find out what the dealer will have at the end of the game
+        #Now we can modify everyone's cash in situ, rather than waiting till the end.
+
+        self.state = 'waiting for turns'
+        for player in self.players():
+            self.player_done = False
+            self.split_store = None
+            self.current_player = player
+            first_turn = True
+            while not self.player_done and player in self.occupied_seats:
+                self.broadcast('[turn|{:<12}]'.format(self.id_of(player)))
+                deadline = time() + self.timeout
+                self.player_moved = False
+                while time() < deadline and not self.player_moved and player in self.occupied_seats:
+                    orders = self.orders_of(player)
+                    if orders is None:
+                        yield deadline
+                        continue
+                    #no need to wait on a player with standing orders
+                    action = orders.turn(self.hands[player], self.hands['dealer'].cards[0], first_turn)
+                    if self.handle_turn(player, action):
+                        self.server.forgive(player)
+                first_turn = False
+                if not self.player_moved:
+                    self.server.drop_client(player, 'timeout waiting for turn')
+        self.current_player = None
+        #disclose dealer moves here:
+        self.dealer_shown = len(self.hands['dealer'].cards)
+        for move in dealer_moves:
+            self.broadcast(move)
+
+    def play_dealer_turn(self):
+        #send the stat message for the dealer's second card
+        dealer_moves = ['[turn|SERVER      ]']
+        msg = '[stat|SERVER      |{action}|{card}|{bust}|0000000000]'
+        dealer_moves.append(msg.format(
+                action='hitt',
+                card=CARD_NAMES[self.hands['dealer'].cards[1]],
+                bust='bustn'))
+        my_hand = self.hands['dealer']
+        while True:
+            if dealer_hits(my_hand):
+                new_card = self.shoe.deal(1)[0]
+                my_hand.add(new_card)
+                val = my_hand.value()
+                dealer_moves.append('[turn|SERVER      ]')
+                dealer_moves.append(msg.format(
+                    action='hitt',
+                    card=CARD_NAMES[new_card],
+                    bust='bustn' if val <= 21 else 'busty'))
+                if val > 21:
+                    break #bust!
+            else:
+                dealer_moves.append('[turn|SERVER      ]')
+                dealer_moves.append(msg.format(
+                    action='stay',
+                    card='xx',
+                    bust='bustn'))
+                break
+        return dealer_moves
+
+    def handle_turn(self,sock,action):
+        action_handlers = {
+                'hitt':self.action_hitt,
+                'stay':self.action_stay,
+                'down':self.action_down,
+                'splt':self.action_split
+            }
+        self.player_moved = True
+        if action in action_handlers:
+            return action_handlers[action](sock)
+        else:
+            return self.server.scold(sock, 'Invalid action. Valid actions are hitt, stay, down, or splt.')
+
+    def action_hitt(self,player):
+        new_card = self.shoe.deal(1)[0]
+        player_id = self.id_of(player)
+
+        self.hands[player].add(new_card)
+
+        hand_value = self.hands[player].value()
+
+        msg = '[stat|{id_}|hitt|{card}|{bust}|{bet}]'.format(
+                id_=player_id,
+                card=CARD_NAMES[new_card],
+                bust = 'busty' if hand_value > 21 else 'bustn',
+                bet = self.bets[player])
+        self.broadcast(msg)
+        if hand_value >= 21:
+            self.player_done = True
+            self.evaluate_hand(player)
+        return True
+
+    def evaluate_hand(self,player):
+        hand_value = self.hands[player].value()
+        player_id = self.id_of(player)
+        dealer_hand = self.hands['dealer'].value()
+        self.logger.debug('player has %s dealer has %s', hand_value, dealer_hand)
+
+        result = score(hand_value, dealer_hand, self.bets[player])
+        self.results[player_id] += result
+        self.logger.debug('%s %s', player_id, 'lost' if result < 0 else 'won' if result > 0 else 'tied')
+
+        if self.split_store is not None:
+            self.player_done = False
+            self.logger.debug('player has finished the first half of a split turn.'
+                    'their hand WAS %s', self.hands[player].names())
+            self.hands[player] = BlackjackHand([self.split_store])
+            self.split_store = None
+            self.logger.debug('now it is %s', self.hands[player].names())
+            self.action_hitt(player)
+
+    def action_stay(self,player):
+        self.player_done = True
+        msg = '[stat|{id_}|stay|xx|bustn|{bet}]'.format(
+                id_=self.id_of(player),
+                bet=self.bets[player])
+        self.broadcast(msg)
+        self.evaluate_hand(player)
+        return True
+
+    def action_down(self,player):
+        if len(self.hands[player].cards) > 2 or self.split_store is not None:
+            return self.server.scold(player, 'Cannot "double" after first turn.')
+        player_id = self.id_of(player)
+        accounts = self.server.accounts
+        if accounts[player_id] < self.bets[player]:
+            return self.server.scold(player, "You don't have enough cash to double down")
+
+        new_card = self.shoe.deal(1)[0]
+        self.hands[player].add(new_card)
+        self.logger.debug('inside action_down, taking extra %s. accounts : %s -> %s',
+            self.bets[player], accounts[player_id], accounts[player_id] - self.bets[player])
+        self.server.ledger.change(player_id, -self.bets[player])
+        self.logger.debug('doubling bet: %s -> %s',
+            self.bets[player],
+            self.bets[player]*2)
+        self.bets[player] *= 2
+        msg = '[stat|{id_}|down|{card}|{bust}|{bet}]'.format(
+                id_=player_id,
+                card=CARD_NAMES[new_card],
+                bust= 'busty' if self.hands[player].value() > 21 else 'bustn',
+                bet=self.bets[player])
+        self.broadcast(msg)
+        self.player_done = True
+        self.evaluate_hand(player)
+        return True
+
+    def action_split(self,player):
+        if len(self.hands[player].cards) > 2 or self.split_store is not None:
+            return self.server.scold(player, 'Cannot "split" after first turn.')
+        if self.hands[player].pair is None:
+            return self.server.scold(player, 'Card values must be equal to split.')
+
+        player_id = self.id_of(player)
+        self.split_store = self.hands[player].split()
+        new_card = self.shoe.deal(1)[0]
+        self.hands[player].add(new_card)
+        msg = '[stat|{id_}|splt|{card}|bustn|{bet}]'.format(
+            id_=player_id,
+            card = CARD_NAMES[new_card],
+            bet = self.bets[player])
+        self.broadcast(msg)
+        return True
+
+    def payout(self):
+        accounts = self.server.accounts
+        msg = ['[endg']
+        #pay out insurance
+        for sock in self.insu:
+            if sock not in self.server.clients:
+                continue #if you leave, you lose
+            player_id = self.id_of(sock)
+            #insurance is already tripled.
+            if self.insu[sock]:
+                self.server.ledger.change(player_id, self.insu[sock])
+
+        for player in self.seats[1:]:
+            if player is None:
+                msg.append('')
+                continue
+            player_id = self.id_of(player)
+            result, winnings = settle(self.results[player_id], self.bets[player])
+            if winnings:
+                self.server.ledger.change(player_id, winnings)
+            msg.append('{id_:<12},{result},{cash:0>10}'.format(
+                id_=player_id,
+                result=result,
+                cash=accounts[player_id]))
+        msg[-1] += ']'
+        self.broadcast('|'.join(msg))
+
+    def handle_insu(self, sock, amount):
+        try:
+            amount = int(amount)
+        except:
+            return self.server.scold(sock, "That's not a number!")
+        if amount > self.bets[sock]/2:
+            return self.server.scold(sock, "Amount must be an integer, no more than half your bet, and less than or equal to your cash.")
+        player_id = self.id_of(sock)
+        if amount > self.server.accounts[player_id]:
+            return self.server.scold(sock, "You don't have enough money to buy that much insurance")
+        if amount:
+            self.server.ledger.change(player_id, -amount)
+        if len(self.hands['dealer'].cards) == 2 and self.hands['dealer'].value() == 21:
+            #this is the amount we will pay that player in insurance
+            self.insu[sock] = 3*amount
+        else:
+            self.insu[sock] = 0
+        return True
+
+    def handle_ante(self, sock, amount):
+        try:
+            amount = int(amount)
+        except ValueError:
+            return self.server.scold(sock, "amount must be an integer, at least {}, and less than or equal to your cash.".format(self.MIN_BET))
+        if amount < self.MIN_BET or amount > self.server.accounts[self.id_of(sock)]:
+            return self.server.scold(sock, "amount must be an integer, at least {}, and less than or equal to your cash.".format(self.MIN_BET))
+
+        self.bets[sock] = amount
+        self.server.ledger.change(self.id_of(sock), -amount)
+        #take the money right away. pay up if they win.
+        return True
+
+    def remove_from_game(self,player):
+        self.logger.debug('moving player %s from game to lobby', self.id_of(player))
+        for d in [self.bets, self.hands, self.insu, self.results]:
+            if player in d:
+                del d[player]
+        self.leave_seat(player)
+        self.broadcast('[join|{id_}|{timeout}|{cash:0>10}|0]'.format(
+                id_=self.id_of(player),
+                timeout=self.timeout,
+                cash=self.server.accounts[self.id_of(player)]))
+        del self.server.seated_at[player]
+        self.server.unseated.add(player)
+
+    def drop_game(self):
+        self.game_in_progress = False
+        self.logger.info('%s: starting a new game...', self)
+        self.bets = {}
+        self.hands = {}
+        self.dealer_shown = 0
+        self.insu = {}
+        self.results = defaultdict(lambda : 0)
+        self.split_store = None
+        self.current_player = None
+        self.state = 'waiting to start game'
+        accounts = self.server.accounts
+        players = self.occupied_seats.keys()
+        for player in players:
+            if accounts[self.id_of(player)] < self.MIN_BET:
+                #this player can't afford to play, but they could still watch
+                self.remove_from_game(player)
+
+        lobby = self.server.lobby
+        while self.has_free_seat() and len(lobby) > 0:
+            new_player = lobby.popleft()
+            if new_player in self.server.clients and accounts[self.id_of(new_player)] < self.MIN_BET:
+                #This player can't afford to play, but they could still watch.
+                continue
+            elif new_player not in self.server.clients:
+                #this player has disconnected
+                continue
+            self.seat(new_player)
+        self.server.table_opened(self)
@@ -1,14 +1,16 @@
 from collections import deque
 from string import maketrans
-import itertools
 import socket as s
-import re
 import logging
 import random
 import traceback
+import errno
+from array import array
+import threading
+import Queue
+from time import time
 
 READSIZE = 512
-MESS_RE = re.compile(r'\[.*?\]',re.MULTILINE) #maybe the flag is not needed?
 MAX_LEN = 512
 
 class colors(object):
@@ -46,82 +48,333 @@ class MessageBufferException(Exception):
     pass
 
 class MessageBuffer(object):
+    '''Splits the bytes coming off sock into [type|arg|arg...] messages.
+
+    Unfinished messages wait in a bytearray that is reused from one recv to
+    the next. _scanned remembers how far into it we have already looked for
+    a closing bracket, so each byte off the wire is only searched once, and
+    _strays whether anything in it needs dropping from the messages besides
+    a stray '[', so most messages are used as they are sliced out.'''
+    log_every = 1 #log every nth recv off the wire at DEBUG; 0 to log none of them
+
     def __init__(self, sock):
         self.messages = deque([])
-        self._buffer = ''
+        self._recvs = 0
+        self._buffer = bytearray()
+        self._scanned = 0 #no ']' in self._buffer before here
+        self._strays = False #whether self._buffer may hold a newline or EOT
+        self.asked_for_frames = False #set by a client that joined asking for binary frames
+        self.framed = False #whether a [bnry] has since switched the rest of the stream to them
         self.sock = sock
 
-    def update(self):
+    def _recv(self):
+        '''The next bytes off the socket, or None if there were none to read.'''
         try:
             new_data = self.sock.recv(READSIZE)
+        except s.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None #non-blocking socket with nothing to read after all
+            logger.error(traceback.format_exc())
+            raise MessageBufferException('socket appears to be closed')
         except:
             logger.error(traceback.format_exc())
             raise MessageBufferException('socket appears to be closed')
-        logger.debug('just off the wire: "{}" (length of {})'.format(new_data, len(new_data)))
+        self._recvs += 1
+        if self.log_every and self._recvs % self.log_every == 0:
+            logger.debug('just off the wire: %r (length of %d)', new_data, len(new_data))
+        return new_data
+
+    def update(self):
+        new_data = self._recv()
+        if new_data is None:
+            return
         if len(new_data) == 0 or new_data[0] == '\x04': #0x04 is EOT
             self.sock.close()
             raise MessageBufferException('here in MessageBuffer, we believe the socket is closed')
-        new_data = new_data.translate(None,'\r\n\x04') #0x04 is EOT
         self._buffer += new_data
-        new_messages = re.findall(MESS_RE, self._buffer)
-        for message in new_messages:
-            mess_args = message.translate(None,'[]').split('|')
-            m_type, mess_args = mess_args[0], mess_args[1:]
-            self.messages.append([m_type,mess_args])
-
-        self._buffer = ''.join(itertools.dropwhile(lambda x: x != '[', 
-                re.sub(MESS_RE, '', self._buffer)))
-        if len(self._buffer) > MAX_LEN:
-            self._buffer = '' #ignore messages longer than MAX_LEN
+        if not self._strays:
+            self._strays = '\n' in new_data or '\r' in new_data or '\x04' in new_data
+        self._parse()
+        if len(self._buffer) > MAX_LEN and not self.framed:
+            del self._buffer[:] #ignore messages longer than MAX_LEN
+            self._scanned = 0
+            self._strays = False
             raise MessageBufferException('This socket is sending waaay too much data.')
 
+    def _parse(self):
+        buf = self._buffer
+        start = buf.find('[')
+        while start != -1:
+            end = buf.find(']', max(start + 1, self._scanned))
+            if end == -1:
+                break
+            #newlines (from telnet) and EOTs are dropped here rather than off
+            #the whole recv, which may run on into binary frames after a [bnry]
+            message = str(buf[start + 1:end])
+            if self._strays or '[' in message:
+                message = message.translate(None, '[\r\n\x04')
+            mess_args = message.split('|')
+            self.messages.append([mess_args[0], mess_args[1:]])
+            if mess_args[0] == 'bnry' and self.asked_for_frames:
+                #the rest is binary frames (see wire.py); leave them for the FrameBuffer taking over
+                del buf[:end + 1]
+                self._scanned = 0
+                self.framed = True
+                return
+            start = buf.find('[', end + 1)
+        #anything before the next '[' is junk, or belongs to messages we've handled
+        if start == -1:
+            del buf[:]
+            self._strays = False
+        else:
+            del buf[:start]
+        self._scanned = len(buf)
+
 
 class ChatHandler(logging.Handler):
-    def __init__(self, broadcast, name=None):
+    def __init__(self, broadcast, name=None, rate=None, burst=None):
+        '''If rate is given, at most that many records a second (in bursts of
+        up to burst) are relayed. The rest are counted, and the count is
+        tacked onto the next record that does get through.'''
         logging.Handler.__init__(self)
         self.broadcast = broadcast
         self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.allowance = self.burst
+        self.last_emit = time()
+        self.skipped = 0
 
     def emit(self, record):
-        contents = self.format(record).translate(escape_chars)
+        if self.rate is not None:
+            now = time()
+            self.allowance = min(self.burst, self.allowance + (now - self.last_emit) * self.rate)
+            self.last_emit = now
+            if self.allowance < 1:
+                self.skipped += 1
+                return
+            self.allowance -= 1
+        contents = self.format(record)
+        if self.skipped:
+            contents += ' ({} more notices skipped)'.format(self.skipped)
+            self.skipped = 0
+        contents = contents.translate(escape_chars)
         if self.name:
             self.broadcast('[chat|{:<12}|{}]'.format(self.name, contents))
         else:
             self.broadcast('[chat|{}]'.format(contents))
 
+class QueueHandler(logging.Handler):
+    '''Passes records to a background thread, which formats them and hands
+    them to the wrapped handlers, so slow disks and terminals don't hold up
+    the caller. If the queue is full, records are dropped and counted.'''
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+#Cards are ints from 0 to 51: rank * 4 + suit, where rank 0 is an ace and
+#12 a king. The two character names are only for the wire and the screen.
+RANK_CHARS = '123456789TJQK'
+SUIT_CHARS = 'HSCD'
+CARD_NAMES = [rank + suit for rank in RANK_CHARS for suit in SUIT_CHARS]
+CARD_CODES = dict((name, card) for card, name in enumerate(CARD_NAMES))
+CARD_VALUES = [min(card // 4 + 1, 10) for card in range(52)]
+ACE = 0 #rank
+
+def card_rank(card):
+    return card >> 2
+
 class BlackjackPlayer(object):
     def __init__(self, id, cards, cash, seat):
         self.id_ = id
         self.hand = BlackjackHand(cards)
         self.cash = cash
         self.seat = seat
-        self.split_store = False
+        self.split_store = None
+
+class BlackjackShoe(object):
+    '''num_decks decks in one array, dealt from front to back. The cut card
+    goes penetration of the way in, and the shoe is shuffled at the start
+    of the first hand after it comes out. With a penetration of 0 that is
+    every hand.
+
+    If a hand runs the shoe dry, the cards from earlier hands are shuffled
+    back in with any left undealt, and dealing carries on; the cards on the
+    table stay where they are.'''
 
-class BlackjackDeck(object):
-    def __init__(self):
-        self.values = map(str, range(1,10)) + ['T','J','Q','K']
-        self.suits = ['H','S','C','D']
-        self.num_decks = 2
+    def __init__(self, num_decks=2, penetration=0.75, rng=random):
+        self.cards = array('b', range(52) * num_decks)
+        self.rng = rng #anything with a shuffle method, so simulations can seed their own
+        self.cut = int(len(self.cards) * penetration)
+        self.next = 0 #index of the next card to deal
+        self.hand_start = 0 #index of the first card of this hand
+        self.shuffled = False #shuffled since the last hand started
         self.shuffle()
+
     def shuffle(self):
-        self.cards = deque( map(lambda tup: ''.join(tup) ,itertools.product(self.values, self.suits)) * self.num_decks )
-        random.shuffle(self.cards)
-    def deal(self,n):
-        return [self.cards.popleft() for x in range(n)]
+        self.rng.shuffle(self.cards)
+        self.next = self.hand_start = 0
+        self.shuffled = True
+
+    def start_hand(self):
+        '''Call before dealing a hand. Returns whether the shoe was shuffled
+        since the last one, which it is for the first hand out of a new shoe.'''
+        if self.next >= self.cut:
+            self.shuffle()
+        shuffled, self.shuffled = self.shuffled, False
+        self.hand_start = self.next
+        return shuffled
+
+    def deal(self, n):
+        if self.next + n > len(self.cards):
+            self.shuffle_discards()
+        start = self.next
+        self.next += n
+        return self.cards[start:self.next].tolist()
+
+    def shuffle_discards(self):
+        in_play = self.cards[self.hand_start:self.next]
+        rest = self.cards[:self.hand_start] + self.cards[self.next:]
+        if not rest:
+            raise BlackjackError('every card in the shoe is on the table')
+        self.rng.shuffle(rest)
+        self.cards[:] = in_play + rest
+        self.hand_start = 0
+        self.next = len(in_play)
+
+HI_LO = [None, -1, 1, 1, 1, 1, 1, 0, 0, 0, -1] #by card value
+
+class ShoeTracker(object):
+    '''What is left in a shoe of num_decks decks, going by the cards seen
+    since it was last shuffled. remaining counts the cards of each value
+    (aces first, tens together, as a dealer_odds composition) and
+    running_count is the Hi-Lo count, both kept up to date one card at a
+    time. Someone who sits down part way through a shoe only knows about
+    the cards since then, so their counts are rough until the next shuffle.'''
+
+    def __init__(self, num_decks=2):
+        self.num_decks = num_decks
+        self.reset()
+
+    def reset(self):
+        '''The shoe was shuffled.'''
+        self.remaining = [4 * self.num_decks] * 9 + [16 * self.num_decks]
+        self.cards_left = 52 * self.num_decks
+        self.running_count = 0
+
+    def see(self, card):
+        value = CARD_VALUES[card]
+        if not self.remaining[value - 1]:
+            #more of these than the shoe holds: a hand ran it dry and the
+            #discards were shuffled back in, which nobody is told about
+            self.reset()
+        self.remaining[value - 1] -= 1
+        self.cards_left -= 1
+        self.running_count += HI_LO[value]
+
+    def true_count(self):
+        '''The running count per deck left.'''
+        if not self.cards_left:
+            return 0.0
+        return self.running_count * 52.0 / self.cards_left
+
+    def composition(self):
+        return tuple(self.remaining)
 
 class BlackjackHand(object):
-    def __init__(self, cards):
-        self.cards=cards
+    '''Cards as ints, with the hard total (aces count 1), the number of aces,
+    and the rank of a two card pair (or None) kept up to date as cards come
+    and go, so value() never has to look at the cards.'''
+    __slots__ = ['cards', 'hard', 'aces', 'pair']
+
+    def __init__(self, cards=()):
+        self.cards = []
+        self.hard = 0
+        self.aces = 0
+        self.pair = None
+        for card in cards:
+            self.add(card)
+
+    def add(self, card):
+        cards = self.cards
+        cards.append(card)
+        self.hard += CARD_VALUES[card]
+        if card < 4: #an ace
+            self.aces += 1
+        if len(cards) == 2 and cards[0] >> 2 == card >> 2:
+            self.pair = card >> 2
+        else:
+            self.pair = None
+
+    def split(self):
+        '''Take the second card back out, and return it.'''
+        card = self.cards.pop()
+        self.hard -= CARD_VALUES[card]
+        if card < 4:
+            self.aces -= 1
+        self.pair = None
+        return card
+
     def value(self):
-        val = 0
-        ace_present = False
-        for card in self.cards:
-            if card[0] == '1':
-                ace_present = True
-            val += 10 if card[0] in ['T','J','Q','K'] else int(card[0])
-        if ace_present and val + 10 <= 21:
-            val += 10
-        return val
+        if self.aces and self.hard <= 11:
+            return self.hard + 10
+        return self.hard
+
+    def names(self):
+        return [CARD_NAMES[card] for card in self.cards]
+
+def dealer_hits(hand):
+    '''The dealer hits on 16 and below, and on 17 with an ace.'''
+    value = hand.value()
+    return value <= 16 or (hand.aces and value <= 17)
+
+def score(hand_value, dealer_value, bet):
+    '''How a finished hand counts towards a player's result.'''
+    if hand_value > 21 or (dealer_value <= 21 and dealer_value > hand_value): #lose!
+        return -bet
+    elif hand_value == 21 and dealer_value != 21:
+        #from spec: "If a player gets a blackjack (and beat the dealer) they win 1.5x their initial bet in addition to their initial bet"
+        return 2.5*bet
+    elif hand_value > dealer_value or dealer_value > 21:
+        return 2*bet
+    return 0 #tie
+
+def settle(result, bet):
+    '''(won/los/tie, what to pay the player) for a player's summed scores.
+    Their bet has already been taken.'''
+    if result > 0:
+        return 'won', 2*bet
+    elif result < 0:
+        return 'los', 0
+    return 'tie', bet
 
 class BlackjackError(Exception):
     pass
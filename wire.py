@@ -0,0 +1,319 @@
+'''The binary framing a client can ask for instead of bracket text.
+
+A client that joins with [join|id|bnry] gets a [bnry|number] back, in
+text, once the join has gone through; number is the one the server gave
+their id. Everything after that, both ways, is frames:
+
+    length (2 bytes) | type (1 byte) | fields
+
+length counts the type byte and the fields. Numbers are big endian.
+Every player id is a 2 byte number (0 is the dealer), cards are one byte
+(the ints of utils.CARD_NAMES, 255 for none), actions one byte, and cash
+and bets 4 bytes. A bust rides in the top bit of the action, a shuffle
+in that of the dealer's card, and DEAL and ENDG have a byte with a bit
+for each seat that has someone in it, rather than sending empty ones. A
+NAME frame tells the client which id a number stands for: one comes for
+everybody already connected right after the [bnry], and another whenever
+somebody joins. Anything the server has no frame for, or whose cash
+doesn't fit in 4 bytes, goes out as a TEXT frame holding the bracket
+message.
+
+The server makes its messages as text, as it always has, and encode turns
+them into frames; a broadcast is encoded once however many clients read
+frames. FrameBuffer turns frames back into [type, args] lists, like
+MessageBuffer, with the args ready to use rather than strings to parse.
+'''
+import struct
+from utils import MessageBuffer, MessageBufferException, CARD_CODES, MAX_LEN, escape_chars, logger
+
+DEALER = 'SERVER      '
+DEALER_NUMBER = 0
+NO_NUMBER = 0xffff #an id we don't know, like that of a client who left before joining
+NO_CARD = 255
+TOP_BIT = 0x80
+ACTIONS = ['hitt', 'stay', 'down', 'splt']
+RESULTS = ['won', 'los', 'tie']
+
+#frame types
+TEXT, NAME, JOIN, ANTE, DEAL, TURN, STAT, ENDG, EXIT, ERRR, CHAT, INSU = range(12)
+TYPE_NAMES = ['text', 'name', 'join', 'ante', 'deal', 'turn', 'stat', 'endg', 'exit', 'errr', 'chat', 'insu']
+
+LENGTH = struct.Struct('>H')
+NUMBER = struct.Struct('>BH') #type, number: turn and exit
+NAME_FRAME = struct.Struct('>BH12s')
+JOIN_FRAME = struct.Struct('>BH12sHIB') #type, number, id, timeout, cash, seat
+AMOUNT = struct.Struct('>BI') #type, amount: ante and insu
+DEAL_HEAD = struct.Struct('>BBBB') #type, dealer card (and shuffled), seats, taken seats
+DEAL_SEAT = struct.Struct('>HIBB') #number, cash, card, card
+STAT_FRAME = struct.Struct('>BHBBI') #type, number, action (and busted), card, bet
+ENDG_HEAD = struct.Struct('>BBB') #type, seats, taken seats
+ENDG_SEAT = struct.Struct('>HBI') #number, result, cash
+ACTION = struct.Struct('>BB')
+STRIKE = struct.Struct('>BB')
+
+ACTION_CODES = dict((action, code) for code, action in enumerate(ACTIONS))
+RESULT_CODES = dict((result, code) for code, result in enumerate(RESULTS))
+CARD_BYTES = dict(CARD_CODES, xx=NO_CARD)
+
+
+def frame(body):
+    return LENGTH.pack(len(body)) + body
+
+
+def encode(data, numbers):
+    '''Frames for data, one or more bracket messages from the server.
+    numbers is id:number for everyone connected.'''
+    frames = []
+    for message in data.strip('[]').split(']['):
+        try:
+            body = encode_message(message, numbers.get)
+        except struct.error: #more cash than 4 bytes hold
+            body = chr(TEXT) + '[' + message + ']'
+        body = body[:0xffff] #only chat and the like get that long
+        frames.append(LENGTH.pack(len(body)) + body)
+    return ''.join(frames)
+
+
+def encode_message(message, get):
+    fields = message.split('|')
+    m_type = fields[0]
+    if m_type == 'stat':
+        id_, action, card, bust, bet = fields[1:]
+        return STAT_FRAME.pack(STAT, get(id_, NO_NUMBER),
+                ACTION_CODES[action] | (TOP_BIT if bust == 'busty' else 0), CARD_BYTES[card], int(bet))
+    elif m_type == 'turn':
+        return NUMBER.pack(TURN, get(fields[1], NO_NUMBER))
+    elif m_type == 'deal':
+        seats = fields[3:]
+        body = ['']
+        taken = 0
+        for seat, info in enumerate(seats):
+            if info:
+                taken |= 1 << seat
+                id_, cash, card1, card2 = info.split(',')
+                body.append(DEAL_SEAT.pack(get(id_, NO_NUMBER), int(cash), CARD_CODES[card1], CARD_CODES[card2]))
+        body[0] = DEAL_HEAD.pack(DEAL, CARD_CODES[fields[1]] | (TOP_BIT if fields[2] == 'shufy' else 0),
+                len(seats), taken)
+        return ''.join(body)
+    elif m_type == 'endg':
+        seats = fields[1:]
+        body = ['']
+        taken = 0
+        for seat, info in enumerate(seats):
+            if info:
+                taken |= 1 << seat
+                id_, result, cash = info.split(',')
+                body.append(ENDG_SEAT.pack(get(id_, NO_NUMBER), RESULT_CODES[result], int(cash)))
+        body[0] = ENDG_HEAD.pack(ENDG, len(seats), taken)
+        return ''.join(body)
+    elif m_type == 'ante':
+        return AMOUNT.pack(ANTE, int(fields[1]))
+    elif m_type == 'join':
+        id_, timeout, cash, seat = fields[1:]
+        return JOIN_FRAME.pack(JOIN, get(id_, NO_NUMBER), id_, int(timeout), int(cash), int(seat))
+    elif m_type == 'exit':
+        return NUMBER.pack(EXIT, get(fields[1], NO_NUMBER))
+    elif m_type == 'chat' and len(fields) == 3:
+        return NUMBER.pack(CHAT, get(fields[1], NO_NUMBER)) + fields[2]
+    elif m_type == 'errr':
+        return STRIKE.pack(ERRR, int(fields[1])) + '|'.join(fields[2:])
+    return chr(TEXT) + '[' + message + ']'
+
+
+def name_frame(number, id_):
+    return frame(NAME_FRAME.pack(NAME, number, id_))
+
+
+def client_frame(m_type, arg=None):
+    '''The frame for a message from a client: ('ante', amount),
+    ('turn', action), ('insu', amount), ('chat', text), ('exit',), or
+    ('text', a bracket message) for the likes of [auto] that have no frame.'''
+    if m_type == 'turn':
+        return frame(ACTION.pack(TURN, ACTION_CODES[arg]))
+    elif m_type in ('ante', 'insu'):
+        return frame(AMOUNT.pack(TYPE_NAMES.index(m_type), int(arg)))
+    elif m_type == 'chat':
+        return frame(chr(CHAT) + arg)
+    elif m_type == 'exit':
+        return frame(chr(EXIT))
+    elif m_type == 'text':
+        return frame(chr(TEXT) + arg)
+    raise ValueError('clients have no {} frame'.format(m_type))
+
+
+class FrameBuffer(MessageBuffer):
+    '''MessageBuffer for a socket that has switched to frames. Messages come
+    out as [type, args] like MessageBuffer's, but the args are already
+    ints and such rather than the strings of the text messages:
+
+        join    id, timeout, cash, seat
+        ante    min_bet (or amount, from a client)
+        deal    dealer card, shuffled, [(id, cash, card, card) or None per seat]
+        turn    id (or action, from a client)
+        stat    id, action, card or None, busted, bet
+        endg    [(id, result, cash) or None per seat]
+        insu    amount
+        exit    id (nothing, from a client)
+        chat    id, text (just text, from a client)
+        errr    strike, reason
+
+    A TEXT frame, either way, comes out the way MessageBuffer would have it.
+
+    from_server says which way the frames are going. names is number:id,
+    from the NAME and JOIN frames seen so far. data is whatever came off
+    the socket after the [bnry], which is frames too.'''
+
+    def __init__(self, sock, data='', from_server=True):
+        MessageBuffer.__init__(self, sock)
+        self.from_server = from_server
+        self.names = {DEALER_NUMBER: DEALER, NO_NUMBER: ''}
+        self._decoders = self._server_decoders if from_server else self._client_decoders
+        self._buffer += data
+        self._parse()
+
+    def update(self):
+        new_data = self._recv()
+        if new_data is None:
+            return
+        if len(new_data) == 0:
+            self.sock.close()
+            raise MessageBufferException('here in FrameBuffer, we believe the socket is closed')
+        self._buffer += new_data
+        self._parse()
+
+    def _parse(self):
+        buf = self._buffer
+        data = str(buf)
+        start = 0
+        end = len(data)
+        decoders = self._decoders
+        append = self.messages.append
+        while end - start >= 2:
+            length = (ord(data[start]) << 8) | ord(data[start + 1])
+            if length > MAX_LEN and not self.from_server:
+                del buf[:]
+                raise MessageBufferException('This socket is sending waaay too much data.')
+            if end - start - 2 < length:
+                break
+            body = data[start + 2:start + 2 + length]
+            start += 2 + length
+            if not body:
+                continue
+            try:
+                message = decoders[ord(body[0])](self, body)
+            except (struct.error, IndexError, KeyError, ValueError):
+                logger.debug('could not decode frame %r', body)
+                message = ['????', []] #gets the sender scolded, like any other junk
+            if message is not None:
+                append(message)
+        del buf[:start]
+
+    #from the server
+
+    def _decode_stat(self, body):
+        _, number, action, card, bet = STAT_FRAME.unpack(body)
+        return ['stat', [self.names[number], ACTIONS[action & ~TOP_BIT],
+            None if card == NO_CARD else card, action >= TOP_BIT, bet]]
+
+    def _decode_turn(self, body):
+        return ['turn', [self.names[NUMBER.unpack(body)[1]]]]
+
+    def _decode_deal(self, body):
+        _, dealer_card, seats, taken = DEAL_HEAD.unpack_from(body)
+        names = self.names
+        infos = [None] * seats
+        offset = DEAL_HEAD.size
+        for seat in range(seats):
+            if taken & 1 << seat:
+                number, cash, card1, card2 = DEAL_SEAT.unpack_from(body, offset)
+                offset += DEAL_SEAT.size
+                infos[seat] = (names[number], cash, card1, card2)
+        return ['deal', [dealer_card & ~TOP_BIT, dealer_card >= TOP_BIT, infos]]
+
+    def _decode_endg(self, body):
+        _, seats, taken = ENDG_HEAD.unpack_from(body)
+        names = self.names
+        infos = [None] * seats
+        offset = ENDG_HEAD.size
+        for seat in range(seats):
+            if taken & 1 << seat:
+                number, result, cash = ENDG_SEAT.unpack_from(body, offset)
+                offset += ENDG_SEAT.size
+                infos[seat] = (names[number], RESULTS[result], cash)
+        return ['endg', [infos]]
+
+    def _decode_ante(self, body):
+        return ['ante', [AMOUNT.unpack(body)[1]]]
+
+    def _decode_join(self, body):
+        _, number, id_, timeout, cash, seat = JOIN_FRAME.unpack(body)
+        self.names[number] = id_
+        return ['join', [id_, timeout, cash, seat]]
+
+    def _decode_name(self, body):
+        _, number, id_ = NAME_FRAME.unpack(body)
+        self.names[number] = id_
+        return None
+
+    def _decode_exit(self, body):
+        return ['exit', [self.names.get(NUMBER.unpack(body)[1], '')]]
+
+    def _decode_chat(self, body):
+        return ['chat', [self.names[NUMBER.unpack_from(body)[1]], body[NUMBER.size:]]]
+
+    def _decode_errr(self, body):
+        return ['errr', [STRIKE.unpack_from(body)[1], body[STRIKE.size:]]]
+
+    def _decode_text(self, body):
+        fields = body[2:-1].split('|')
+        return [fields[0], fields[1:]]
+
+    #from a client
+
+    def _decode_amount(self, body):
+        m_type, amount = AMOUNT.unpack(body)
+        return [TYPE_NAMES[m_type], [amount]]
+
+    def _decode_action(self, body):
+        return ['turn', [ACTIONS[ACTION.unpack(body)[1]]]]
+
+    def _decode_leave(self, body):
+        if len(body) != 1:
+            return self._decode_junk(body)
+        return ['exit', []]
+
+    def _decode_text_only(self, body):
+        #the server puts chat into a bracket message for everyone on text,
+        #where a ']' or '|' in it would end the message or start a field
+        return ['chat', [body[1:].translate(escape_chars)]]
+
+    def _decode_junk(self, body):
+        m_type = ord(body[0])
+        return [TYPE_NAMES[m_type] if m_type < len(TYPE_NAMES) else '????', []]
+
+
+def _decoder_table(decoders):
+    '''A list indexed by type byte, so junk types get scolded like junk text.'''
+    return [decoders.get(m_type, FrameBuffer._decode_junk).im_func for m_type in range(256)]
+
+FrameBuffer._server_decoders = _decoder_table({
+    TEXT: FrameBuffer._decode_text,
+    NAME: FrameBuffer._decode_name,
+    JOIN: FrameBuffer._decode_join,
+    ANTE: FrameBuffer._decode_ante,
+    DEAL: FrameBuffer._decode_deal,
+    TURN: FrameBuffer._decode_turn,
+    STAT: FrameBuffer._decode_stat,
+    ENDG: FrameBuffer._decode_endg,
+    EXIT: FrameBuffer._decode_exit,
+    ERRR: FrameBuffer._decode_errr,
+    CHAT: FrameBuffer._decode_chat,
+    })
+FrameBuffer._client_decoders = _decoder_table({
+    TEXT: FrameBuffer._decode_text,
+    ANTE: FrameBuffer._decode_amount,
+    INSU: FrameBuffer._decode_amount,
+    TURN: FrameBuffer._decode_action,
+    EXIT: FrameBuffer._decode_leave,
+    CHAT: FrameBuffer._decode_text_only,
+    })
@@ -0,0 +1,182 @@
+'''Running the server as several processes that share one port.
+
+run_workers forks one BlackjackServer per worker. Each binds the port with
+SO_REUSEPORT, so the kernel spreads new connections between them, and each
+runs its own tables. The parent process stays behind as the
+AccountCoordinator: it keeps the AccountLedger, and a worker has to claim a
+player's account when they join and hand it back when they leave. That
+keeps one balance per player id, and stops the same id from playing on two
+workers at once. Workers pass every change to a balance on to the
+coordinator, which logs it like a single server would.
+
+Workers talk to the coordinator in the same bracket format as the game:
+    [clam|id]       worker wants the account for id
+    [cash|id|cash]  it's yours, with this balance
+    [used|id]       another worker has that player
+    [chng|id|amnt]  add amnt (negative for a debit) to id's balance
+    [free|id]       worker is done with id
+    [sync]          worker wants everything it has sent so far on disk
+    [synd]          it is
+A worker's commit waits for the [synd], so like a single server's it
+doesn't tell anyone a balance the coordinator could still lose.
+'''
+import os
+import sys
+import signal
+import socket as s
+import logging
+from reactor import Reactor
+from ledger import AccountLedger
+from utils import MessageBuffer, MessageBufferException
+from time import time
+
+logger = logging.getLogger('blackjack.workers')
+
+
+class AccountLink(object):
+    '''A worker's end of its connection to the AccountCoordinator. It stands
+    in for the AccountLedger a single server would have, but only holds the
+    accounts of players connected to this worker. Claims wait for the
+    coordinator's answer, which is only ever a unix socket away.'''
+
+    def __init__(self, sock, commit_interval=0.01):
+        self.sock = sock
+        self.mbuffer = MessageBuffer(sock)
+        self.accounts = {} #id:cash pairs for the players we have claimed
+        self.pending = [] #changes for the coordinator, sent on commit
+        self.commit_interval = commit_interval
+        self.last_commit = 0
+
+    def claim(self, id_):
+        '''The balance for id_, or None if another worker has that player.'''
+        self.sock.sendall('[clam|{}]'.format(id_))
+        m_type, mess_args = self.reply()
+        if m_type != 'cash':
+            return None
+        self.accounts[id_] = int(mess_args[1])
+        return self.accounts[id_]
+
+    def reply(self):
+        '''The coordinator's answer to what we just sent. Nothing else comes
+        our way, and we wait on every answer, so it's the next message.'''
+        while not self.mbuffer.messages:
+            self.mbuffer.update()
+        return self.mbuffer.messages.popleft()
+
+    def release(self, id_):
+        del self.accounts[id_]
+        #their changes go before the [free]; another worker may want them straight away
+        self.commit(force=True)
+        self.sock.sendall('[free|{}]'.format(id_))
+
+    def change(self, id_, amount):
+        self.accounts[id_] += amount
+        self.pending.append('[chng|{}|{}]'.format(id_, amount))
+
+    def due(self):
+        if not self.pending:
+            return None
+        return self.last_commit + self.commit_interval
+
+    def commit(self, force=False):
+        '''Send the pending changes and wait until the coordinator has
+        committed them, unless we did so less than commit_interval ago.'''
+        if not self.pending or (not force and time() < self.due()):
+            return
+        self.sock.sendall(''.join(self.pending) + '[sync]')
+        self.pending = []
+        self.reply() #the [synd]
+        self.last_commit = time()
+
+    def close(self):
+        for id_ in self.accounts.keys():
+            self.release(id_)
+
+
+class AccountCoordinator(object):
+    def __init__(self, links):
+        self.ledger = AccountLedger()
+        self.owners = {} #id:sock pairs, which worker has each player
+        self.links = {} #sock:MessageBuffer pairs, one per worker
+        self.reactor = Reactor()
+        for sock in links:
+            self.links[sock] = MessageBuffer(sock)
+            self.reactor.add_reader(sock, lambda sock=sock: self.process_messages(sock))
+
+    def process_messages(self, sock):
+        mbuffer = self.links[sock]
+        try:
+            mbuffer.update()
+        except MessageBufferException:
+            return self.drop_worker(sock)
+        while mbuffer.messages:
+            m_type, mess_args = mbuffer.messages.popleft()
+            if m_type == 'clam':
+                self.handle_clam(sock, *mess_args)
+            elif m_type == 'chng':
+                self.ledger.change(mess_args[0], int(mess_args[1]))
+            elif m_type == 'free':
+                self.handle_free(sock, *mess_args)
+            elif m_type == 'sync':
+                self.ledger.commit(force=True)
+                sock.sendall('[synd]')
+            else:
+                logger.error('unknown message from worker: %s %s', m_type, mess_args)
+
+    def handle_clam(self, sock, id_):
+        if self.owners.get(id_, sock) is not sock:
+            return sock.sendall('[used|{}]'.format(id_))
+        self.owners[id_] = sock
+        sock.sendall('[cash|{}|{:0>10}]'.format(id_, self.ledger.claim(id_)))
+
+    def handle_free(self, sock, id_):
+        if self.owners.get(id_) is sock:
+            del self.owners[id_]
+
+    def drop_worker(self, sock):
+        '''A worker has gone away. Its players keep every change it sent us.'''
+        self.reactor.remove(sock)
+        del self.links[sock]
+        for id_, owner in self.owners.items():
+            if owner is sock:
+                del self.owners[id_]
+
+    def serve(self):
+        while self.links:
+            due = self.ledger.due()
+            self.reactor.poll(None if due is None else max(due - time(), 0))
+            self.ledger.commit()
+        self.ledger.close()
+
+
+def run_workers(server_class, num_workers, server_args):
+    '''Fork num_workers servers and coordinate their accounts until they all exit.'''
+    links = []
+    pids = []
+    for worker in range(num_workers):
+        ours, theirs = s.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            ours.close()
+            for sock in links:
+                sock.close()
+            server_class(coordinator=AccountLink(theirs), **server_args).serve()
+            sys.exit(0)
+        theirs.close()
+        links.append(ours)
+        pids.append(pid)
+
+    def sighandler(signum, frame):
+        #the workers hand back their accounts as they shut down, and then the
+        #coordinator's loop runs out of links and saves everything
+        print('Shutting down workers...')
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass #already gone
+    signal.signal(signal.SIGINT, sighandler)
+
+    AccountCoordinator(links).serve()
+    for pid in pids:
+        os.waitpid(pid, 0)